@@ -0,0 +1,87 @@
+import argparse
+import json
+import time
+import torch
+
+from code_encoder import CodeEncoder
+from code_sim_calculator import CodeSimCalculator
+from run_com_exp import get_code_data_objs
+
+
+def naive_get_embeds(calculator: CodeSimCalculator, texts, max_length):
+    '''Encode texts one by one with max_length padding, the way get_embeds worked before batching.'''
+    embeds = []
+    for text in texts:
+        encoded = calculator.tokenizer(text, padding='max_length', truncation=True, max_length=max_length,
+                                       return_tensors="pt").to(calculator.device)
+        output = calculator.model.encoder(encoded.input_ids, attention_mask=encoded.attention_mask,
+                                          return_dict=True)
+        embed = torch.nn.functional.normalize(
+            calculator.model.proj(output.last_hidden_state[:, 0, :]), dim=-1)
+        embeds.append(embed.detach())
+
+    return torch.cat(embeds, dim=0)
+
+
+def load_codes(args):
+    if args.parse_out_path != "":
+        codes = [obj['code']
+                 for obj in get_code_data_objs(args.parse_out_path)]
+    elif args.code_file_path != "":
+        with open(args.code_file_path, "r") as f:
+            codes = [json.loads(line)['code'] for line in f]
+    else:
+        raise Exception("Either parse_out_path or code_file_path is required.")
+
+    return codes[:args.count]
+
+
+def main(args):
+    torch.set_num_threads(args.num_threads)
+
+    calculator = CodeSimCalculator()
+    calculator.device = torch.device('cpu')
+    calculator.model = calculator.model.to(calculator.device)
+
+    codes = load_codes(args)
+    print(f"Number of code snippets: {len(codes)}")
+
+    start_time = time.time()
+    naive_embeds = naive_get_embeds(calculator, codes, args.max_code_len)
+    naive_time = time.time() - start_time
+    print(f"naive: {round(len(codes) / naive_time, 2)} snippets/s")
+
+    for batch_size in args.batch_sizes:
+        encoder = CodeEncoder(calculator.model, calculator.tokenizer,
+                              calculator.device, batch_size)
+
+        start_time = time.time()
+        embeds = encoder.encode(codes, args.max_code_len)
+        cold_time = time.time() - start_time
+
+        start_time = time.time()
+        encoder.encode(codes, args.max_code_len)
+        warm_time = time.time() - start_time
+
+        # dynamic padding should not change embeddings
+        max_diff = (embeds - naive_embeds).abs().max().item()
+        print(f"batch_size={batch_size}: {round(len(codes) / cold_time, 2)} snippets/s, "
+              f"speedup {round(naive_time / cold_time, 2)}x, "
+              f"cached {round(len(codes) / max(warm_time, 1e-6), 2)} snippets/s, "
+              f"max abs diff {round(max_diff, 6)}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--parse_out_path', default="", type=str,
+                        help='take method bodies from a parse output file')
+    parser.add_argument('--code_file_path', default="", type=str,
+                        help='jsonl file with a `code` field per line')
+    parser.add_argument('--count', default=512, type=int)
+    parser.add_argument('--max_code_len', default=512, type=int)
+    parser.add_argument('--batch_sizes', default=[8, 32, 64],
+                        type=int, nargs='+')
+    parser.add_argument('--num_threads', default=4, type=int)
+
+    main(parser.parse_args())
@@ -0,0 +1,212 @@
+import argparse
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dotenv import load_dotenv
+
+from calc_metrics import count_correct_prefix, get_true_path_arr
+from generation_backend import GenerationBackend, create_backend, get_backend_name
+from metrics import MetricsRecorder, metrics_context
+from retriever import Retriever
+from run_eval_ret import group_by_repo
+from sim_retriever import SimRetriever
+from single_flight import SingleFlight
+from summarizer import Summarizer
+from text_sim_calculator import TextSimCalculator
+
+
+def summarize_dir_cost(metrics_path: str) -> dict:
+    '''return: {call_count, token_count, latency_sum} of directory summarization calls in the metrics records'''
+    cost = {'call_count': 0, 'token_count': 0, 'latency_sum': 0.0}
+    with open(metrics_path, "r") as f_metrics:
+        for line in f_metrics:
+            rec = json.loads(line)
+            if rec.get('node_type') != 'directory' or 'latency' not in rec:
+                continue
+            cost['call_count'] += 1
+            cost['token_count'] += rec.get('prompt_tokens', 0) + \
+                rec.get('completion_tokens', 0)
+            cost['latency_sum'] += rec['latency']
+
+    cost['latency_sum'] = round(cost['latency_sum'], 2)
+    return cost
+
+
+def bench_summarize(args, label: str, fast_dir_depths: str, method_backend: GenerationBackend,
+                    chat_backend: GenerationBackend, text_sim_calculator: TextSimCalculator,
+                    single_flight: SingleFlight, repo_name: str) -> dict:
+    parse_out_path = os.path.join(
+        args.sum_result_root_path, repo_name, f"parse_out_{repo_name}.json")
+    metrics_path = os.path.join(
+        args.output_dir, f"sum_metrics_{label}_{repo_name}.jsonl")
+    if os.path.exists(metrics_path):
+        os.remove(metrics_path)
+
+    metrics = MetricsRecorder(metrics_path)
+    method_backend.metrics = metrics
+    chat_backend.metrics = metrics
+
+    logger = logging.getLogger(f"bench_sum_{label}_{repo_name}")
+    logger.addHandler(logging.NullHandler())
+    logger.propagate = False
+
+    with open(parse_out_path, "r") as f_parse_out:
+        parse_obj = json.load(f_parse_out)
+
+    summarizer = Summarizer(logger, method_backend, chat_backend, metrics, args.pack_methods,
+                            fast_dir_depths=fast_dir_depths, text_sim_calculator=text_sim_calculator)
+    # method and file prompts do not depend on the tier, they are paid once in the warm-up pass
+    summarizer.single_flight = single_flight
+    start_time = time.time()
+    repo_sum_obj = summarizer.summarize_repo(parse_obj)
+    time_cost = time.time() - start_time
+
+    metrics.close()
+    method_backend.metrics = None
+    chat_backend.metrics = None
+
+    with open(os.path.join(args.output_dir, f"sum_out_{label}_{repo_name}.json"), "w") as f_sum_out:
+        json.dump(repo_sum_obj, f_sum_out)
+
+    return {
+        'time_cost': round(time_cost, 2),
+        'extractive_dir_count': summarizer.extractive_dir_count,
+        'gen_err_count': summarizer.gen_err_count,
+        'dir_cost': summarize_dir_cost(metrics_path),
+    }, repo_sum_obj
+
+
+def bench_retrieve(args, chat_backend: GenerationBackend, text_sim_calculator: TextSimCalculator,
+                   repo_sum_obj: dict, data_objs: list) -> dict:
+    logger = logging.getLogger("bench_ret")
+    logger.addHandler(logging.NullHandler())
+    logger.propagate = False
+
+    # retriever keeps per-query state, so each thread has its own one
+    thread_local = threading.local()
+
+    def retrieve_one(data_obj: dict) -> dict:
+        true_path_arr = get_true_path_arr(repo_sum_obj, data_obj['path'])
+        if true_path_arr == None or len(true_path_arr) == 0:
+            return None
+
+        if not hasattr(thread_local, 'retriever'):
+            thread_local.retriever = SimRetriever(text_sim_calculator) if args.sim \
+                else Retriever(chat_backend, text_sim_calculator)
+        with metrics_context(query_id=data_obj['id']):
+            is_error, res_obj = thread_local.retriever.retrieve(
+                data_obj['query'], repo_sum_obj, logger)
+        if is_error:
+            return None
+
+        correct_count = count_correct_prefix(res_obj['path'], true_path_arr)
+        return {
+            'is_recalled': correct_count == len(true_path_arr),
+            'iou': correct_count / len(true_path_arr),
+            'ret_times': res_obj['ret_times'],
+        }
+
+    start_time = time.time()
+    with ThreadPoolExecutor(max_workers=args.ret_workers) as executor:
+        results = list(executor.map(retrieve_one, data_objs))
+    time_cost = time.time() - start_time
+
+    # queries whose path is not in the tree or whose retrieval failed are not scored
+    results = [x for x in results if x != None]
+    return {
+        'query_count': len(data_objs),
+        'scored_count': len(results),
+        'recalled_count': sum(x['is_recalled'] for x in results),
+        'iou_sum': round(sum(x['iou'] for x in results), 4),
+        'ret_times_sum': sum(x['ret_times'] for x in results),
+        'time_cost': round(time_cost, 2),
+    }
+
+
+def main(args):
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    method_backend = create_backend(get_backend_name('method', 'ie'))
+    chat_backend = create_backend(get_backend_name('chat', 'openai'))
+    text_sim_calculator = TextSimCalculator()
+
+    with open(args.data_file_path, "r") as f_data:
+        repo_dict = group_by_repo([json.loads(line) for line in f_data])
+    repo_names = [x for x in repo_dict if os.path.exists(os.path.join(
+        args.sum_result_root_path, x, f"parse_out_{x}.json"))]
+    if args.repo_count > 0:
+        repo_names = repo_names[:args.repo_count]
+    warmup_single_flights = {x: SingleFlight() for x in repo_names}
+
+    # warm up the method and file summaries with all directories extractive, so time of the tiers
+    # differs only in directory summarization
+    for repo_name in repo_names:
+        print(f"Warming up {repo_name}...")
+        bench_summarize(args, "warmup", "0+", method_backend, chat_backend, text_sim_calculator,
+                        warmup_single_flights[repo_name], repo_name)
+
+    report = {'config': vars(args), 'tiers': {}}
+    for fast_dir_depths in args.fast_dir_depths:
+        label = fast_dir_depths if fast_dir_depths != "" else "none"
+        tier_report = {'repos': {}}
+        for repo_name in repo_names:
+            print(f"Benchmarking {repo_name} with fast directory depths: {label}...")
+            # each tier starts from the warm-up, so directory calls of other tiers are not reused
+            sum_report, repo_sum_obj = bench_summarize(
+                args, label, fast_dir_depths, method_backend, chat_backend, text_sim_calculator,
+                warmup_single_flights[repo_name].fork(), repo_name)
+            ret_report = bench_retrieve(
+                args, chat_backend, text_sim_calculator, repo_sum_obj, repo_dict[repo_name])
+            tier_report['repos'][repo_name] = {
+                'summarize': sum_report, 'retrieve': ret_report}
+
+        repo_reports = tier_report['repos'].values()
+        scored_count = sum(x['retrieve']['scored_count'] for x in repo_reports)
+        tier_report['total'] = {
+            'dir_call_count': sum(x['summarize']['dir_cost']['call_count'] for x in repo_reports),
+            'dir_token_count': sum(x['summarize']['dir_cost']['token_count'] for x in repo_reports),
+            'dir_latency_sum': round(sum(x['summarize']['dir_cost']['latency_sum'] for x in repo_reports), 2),
+            'extractive_dir_count': sum(x['summarize']['extractive_dir_count'] for x in repo_reports),
+            'sum_time_cost': round(sum(x['summarize']['time_cost'] for x in repo_reports), 2),
+            'scored_count': scored_count,
+            'recall': round(sum(x['retrieve']['recalled_count'] for x in repo_reports) / scored_count * 100.0, 2)
+            if scored_count > 0 else None,
+            'iou': round(sum(x['retrieve']['iou_sum'] for x in repo_reports) / scored_count, 4)
+            if scored_count > 0 else None,
+            'ret_times': round(sum(x['retrieve']['ret_times_sum'] for x in repo_reports) / scored_count, 2)
+            if scored_count > 0 else None,
+        }
+        report['tiers'][label] = tier_report
+
+    with open(os.path.join(args.output_dir, "report_dir_tier.json"), "w") as f_report:
+        json.dump(report, f_report, indent=2)
+
+    for label, tier_report in report['tiers'].items():
+        print(f"fast directory depths {label}: {tier_report['total']}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Compare directory summary tiers: cost of summarization against recall of retrieval.")
+
+    parser.add_argument('--fast_dir_depths', nargs='+', default=["", "2+", "1+"],
+                        help='one config per value, e.g. "" (all directories by GPT), "2+", "1,3", see summarizer.is_depth_selected')
+    parser.add_argument('--repo_count', default=0, type=int,
+                        help='first repos of the data file with a parse output, 0 means all')
+    parser.add_argument('--data_file_path',
+                        default="./eval_data/filtered/data_final.jsonl", type=str)
+    parser.add_argument('--sum_result_root_path',
+                        default="./eval_data/sum_result", type=str,
+                        help='parse outputs are read from <sum_result_root_path>/<repo>/parse_out_<repo>.json')
+    parser.add_argument('--output_dir', default="./bench_result/dir_tier", type=str)
+    parser.add_argument('--ret_workers', default=4, type=int)
+    parser.add_argument('--pack_methods', action='store_true',
+                        help='summarize small methods of one class in one request')
+    parser.add_argument('--sim', action='store_true',
+                        help='use SimRetriever(ablation experiment)')
+
+    load_dotenv()
+    main(parser.parse_args())
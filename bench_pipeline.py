@@ -0,0 +1,304 @@
+import argparse
+import json
+import logging
+import os
+import random
+import resource
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
+
+from constants import NO_SUMMARY
+from generation_backend import GenerationBackend, create_backend
+from metrics import MetricsRecorder, metrics_context
+from mock_llm_server import EndpointProfile, MockLLMServer
+from retriever import Retriever
+from summarizer import Summarizer
+from text_sim_calculator import TextSimCalculator
+
+
+def calc_percentiles(values: List[float], percents: List[int] = [50, 95, 99]) -> dict:
+    '''Nearest-rank percentiles, return: {p<percent>: value}'''
+    if len(values) == 0:
+        return {f"p{p}": None for p in percents}
+
+    values = sorted(values)
+    return {
+        f"p{p}": round(values[min(len(values) - 1, max(0, int(len(values) * p / 100 + 0.5) - 1))], 4)
+        for p in percents
+    }
+
+
+def get_peak_rss_mb() -> float:
+    # ru_maxrss is in kilobytes on Linux
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+def summarize_latencies(metrics_path: str) -> dict:
+    '''return: {event: {count, error_count, p50, p95, p99}} of latencies in the metrics records'''
+    latencies = {}
+    error_counts = {}
+    with open(metrics_path, "r") as f_metrics:
+        for line in f_metrics:
+            rec = json.loads(line)
+            event = rec['event']
+            if rec.get('status', 'ok') != 'ok':
+                error_counts[event] = error_counts.get(event, 0) + 1
+            elif 'latency' in rec:
+                latencies.setdefault(event, []).append(rec['latency'])
+
+    return {
+        event: {
+            'count': len(latencies.get(event, [])),
+            'error_count': error_counts.get(event, 0),
+            **calc_percentiles(latencies.get(event, [])),
+        }
+        for event in sorted(set(latencies) | set(error_counts))
+    }
+
+
+def collect_methods(dir_sum_obj: dict) -> List[dict]:
+    methods = []
+    for file_sum_obj in dir_sum_obj['files']:
+        methods.extend(file_sum_obj['methods'])
+    for sub_dir_sum_obj in dir_sum_obj['subdirectories']:
+        methods.extend(collect_methods(sub_dir_sum_obj))
+
+    return methods
+
+
+def load_queries(query_file_path: str, repo_name: str, count: int) -> List[str]:
+    '''Queries of the repo in a file in the format of data_final.jsonl, e.g. made by synthetic_repo.py'''
+    queries = []
+    with open(query_file_path, "r") as f_queries:
+        for line in f_queries:
+            data_obj = json.loads(line)
+            if data_obj['repo'].split('/')[-1] == repo_name:
+                queries.append(data_obj['query'])
+
+    return queries[:count]
+
+
+def make_queries(repo_sum_obj: dict, count: int, seed: int) -> List[str]:
+    '''Queries are summaries of randomly picked methods, so that each has a target in the repo.'''
+    # methods without body have no summary
+    methods = [x for x in collect_methods(repo_sum_obj)
+               if x['summary'] != NO_SUMMARY]
+    random.Random(seed).shuffle(methods)
+
+    return [x['summary'] for x in methods[:count]]
+
+
+def set_client_env(args, server: MockLLMServer):
+    '''Point clients to the stand-in endpoints, they read their configuration from env.'''
+    os.environ['IE_URL'] = server.ie_url
+    os.environ['IE_TOKEN'] = "mock"
+    os.environ['IE_MODEL_NAME'] = args.ie_model_name
+    os.environ['IE_MAX_NUMBER_OF_TOKENS'] = str(args.ie_max_number_of_tokens)
+    os.environ['IE_MAX_BATCH_SIZE'] = str(args.ie_max_batch_size)
+    os.environ['OPENAI_URL'] = server.openai_url
+    os.environ['OPENAI_TOKEN'] = "mock"
+    os.environ['OPENAI_MODEL_NAME'] = args.openai_model_name
+    os.environ['OPENAI_MAX_NUMBER_OF_TOKENS'] = str(
+        args.openai_max_number_of_tokens)
+
+
+def bench_summarize(args, method_backend: GenerationBackend, chat_backend: GenerationBackend, parse_out_path: str,
+                    repo_name: str) -> dict:
+    metrics_path = os.path.join(args.output_dir, f"sum_metrics_{repo_name}.jsonl")
+    if os.path.exists(metrics_path):
+        os.remove(metrics_path)
+
+    metrics = MetricsRecorder(metrics_path)
+    method_backend.metrics = metrics
+    chat_backend.metrics = metrics
+
+    logger = logging.getLogger(f"bench_sum_{repo_name}")
+    logger.addHandler(logging.NullHandler())
+    logger.propagate = False
+
+    with open(parse_out_path, "r") as f_parse_out:
+        parse_obj = json.load(f_parse_out)
+
+    summarizer = Summarizer(logger, method_backend, chat_backend,
+                            metrics, args.pack_methods)
+    start_time = time.time()
+    repo_sum_obj = summarizer.summarize_repo(parse_obj)
+    time_cost = time.time() - start_time
+
+    metrics.close()
+    method_backend.metrics = None
+    chat_backend.metrics = None
+
+    with open(os.path.join(args.output_dir, f"sum_out_{repo_name}.json"), "w") as f_sum_out:
+        json.dump(repo_sum_obj, f_sum_out)
+
+    return {
+        'node_count': parse_obj['nodeCount'],
+        'time_cost': round(time_cost, 2),
+        'nodes_per_sec': round(parse_obj['nodeCount'] / time_cost, 2),
+        'gen_err_count': summarizer.gen_err_count,
+        'token_used_count': summarizer.token_used_count,
+        'collapsed_request_count': summarizer.single_flight.collapsed_count,
+        'pack_saved_request_count': summarizer.packed_method_count - summarizer.pack_request_count,
+        'pack_saved_token_count': summarizer.pack_saved_token_count,
+        'pack_fallback_count': summarizer.pack_fallback_count,
+        'latency': summarize_latencies(metrics_path),
+    }, repo_sum_obj
+
+
+def bench_retrieve(args, chat_backend: GenerationBackend, text_sim_calculator: TextSimCalculator,
+                   repo_sum_obj: dict, repo_name: str) -> dict:
+    metrics_path = os.path.join(args.output_dir, f"ret_metrics_{repo_name}.jsonl")
+    if os.path.exists(metrics_path):
+        os.remove(metrics_path)
+
+    metrics = MetricsRecorder(metrics_path)
+    chat_backend.metrics = metrics
+
+    logger = logging.getLogger(f"bench_ret_{repo_name}")
+    logger.addHandler(logging.NullHandler())
+    logger.propagate = False
+
+    # retriever keeps per-query state, so each thread has its own one
+    thread_local = threading.local()
+
+    def retrieve_one(query_idx: int, query: str) -> bool:
+        if not hasattr(thread_local, 'retriever'):
+            thread_local.retriever = Retriever(
+                chat_backend, text_sim_calculator, metrics=metrics)
+        with metrics_context(query_id=query_idx):
+            is_error, res_obj = thread_local.retriever.retrieve(
+                query, repo_sum_obj, logger)
+        return not is_error and res_obj['is_found']
+
+    if args.query_file_path != "":
+        queries = load_queries(args.query_file_path,
+                               repo_name, args.query_count)
+    else:
+        queries = make_queries(repo_sum_obj, args.query_count, args.seed)
+    start_time = time.time()
+    with ThreadPoolExecutor(max_workers=args.ret_workers) as executor:
+        found = list(executor.map(retrieve_one, range(len(queries)), queries))
+    time_cost = time.time() - start_time
+
+    metrics.close()
+    chat_backend.metrics = None
+
+    return {
+        'query_count': len(queries),
+        'found_count': sum(found),
+        'time_cost': round(time_cost, 2),
+        'queries_per_sec': round(len(queries) / time_cost, 2) if time_cost > 0 else None,
+        'latency': summarize_latencies(metrics_path),
+    }
+
+
+def main(args):
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    ie_profile = EndpointProfile(args.ie_latency, args.ie_latency_sigma,
+                                 args.ie_error_rate, args.ie_max_concurrency, args.ie_token_latency)
+    openai_profile = EndpointProfile(args.openai_latency, args.openai_latency_sigma,
+                                     args.openai_error_rate, args.openai_max_concurrency, args.openai_token_latency)
+
+    report = {'config': vars(args), 'repos': {}}
+    with MockLLMServer(ie_profile, openai_profile, seed=args.seed) as server:
+        set_client_env(args, server)
+        # methods can be summarized by an in-process model instead of the IE stand-in
+        method_backend = create_backend(args.method_backend)
+        chat_backend = create_backend('openai')
+        if args.method_backend == 'ie':
+            method_backend.retry_wait_range = (args.retry_wait, args.retry_wait)
+        chat_backend.retry_wait_range = (args.retry_wait, args.retry_wait)
+
+        text_sim_calculator = TextSimCalculator() if args.query_count > 0 else None
+
+        for parse_out_path in args.parse_out_paths:
+            repo_name = os.path.splitext(os.path.basename(parse_out_path))[0]
+            if repo_name.startswith("parse_out_"):
+                repo_name = repo_name[len("parse_out_"):]
+            print(f"Benchmarking {repo_name}...")
+
+            sum_report, repo_sum_obj = bench_summarize(
+                args, method_backend, chat_backend, parse_out_path, repo_name)
+            report['repos'][repo_name] = {'summarize': sum_report}
+
+            if args.query_count > 0:
+                report['repos'][repo_name]['retrieve'] = bench_retrieve(
+                    args, chat_backend, text_sim_calculator, repo_sum_obj, repo_name)
+
+        report['endpoints'] = server.get_stats()
+
+    report['peak_rss_mb'] = get_peak_rss_mb()
+
+    with open(os.path.join(args.output_dir, "report.json"), "w") as f_report:
+        json.dump(report, f_report, indent=2)
+
+    for repo_name, repo_report in report['repos'].items():
+        sum_report = repo_report['summarize']
+        print(f"{repo_name}: {sum_report['node_count']} nodes, {sum_report['nodes_per_sec']} nodes/s, "
+              f"{sum_report['gen_err_count']} generation errors, "
+              f"{sum_report['collapsed_request_count']} collapsed requests, "
+              f"{sum_report['pack_saved_request_count']} requests saved by packing")
+        for event, latency in sum_report['latency'].items():
+            print(f"\t{event}: {latency}")
+        if 'retrieve' in repo_report:
+            ret_report = repo_report['retrieve']
+            print(f"\tretrieve: {ret_report['query_count']} queries, {ret_report['queries_per_sec']} queries/s, "
+                  f"{ret_report['found_count']} found")
+            for event, latency in ret_report['latency'].items():
+                print(f"\t{event}: {latency}")
+    for name, stats in report['endpoints'].items():
+        print(f"{name} endpoint: {stats}")
+    print(f"peak RSS: {report['peak_rss_mb']} MB")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark summarization and retrieval against local stand-ins of the LLM endpoints.")
+
+    parser.add_argument('--parse_out_paths', nargs='+', required=True,
+                        help='fixture repos, outputs of java-repo-parser')
+    parser.add_argument('--query_count', default=20, type=int,
+                        help='queries retrieved per repo, 0 to skip retrieval')
+    parser.add_argument('--query_file_path', default="", type=str,
+                        help='queries in the format of data_final.jsonl, e.g. made by synthetic_repo.py, '
+                        'by default summaries of random methods are used')
+    parser.add_argument('--ret_workers', default=4, type=int)
+    parser.add_argument('--pack_methods', action='store_true',
+                        help='summarize small methods of one class in one request')
+    parser.add_argument('--method_backend', default="ie", choices=['ie', 'local'],
+                        help='local: summarize methods by the in-process model configured by env LOCAL_*')
+    parser.add_argument('--output_dir', default="./bench_result", type=str)
+    parser.add_argument('--seed', default=0, type=int)
+    parser.add_argument('--retry_wait', default=0.1, type=float,
+                        help='seconds waited before clients retry a failed request')
+
+    parser.add_argument('--ie_latency', default=1.0, type=float,
+                        help='median latency in seconds')
+    parser.add_argument('--ie_latency_sigma', default=0.5, type=float)
+    parser.add_argument('--ie_token_latency', default=0.0, type=float,
+                        help='seconds to generate each output word after the latency')
+    parser.add_argument('--ie_error_rate', default=0.0, type=float)
+    parser.add_argument('--ie_max_concurrency', default=0, type=int,
+                        help='requests beyond it are rejected, 0 means no limit')
+    parser.add_argument('--ie_model_name',
+                        default="codellama/CodeLlama-7b-Instruct-hf", type=str)
+    parser.add_argument('--ie_max_number_of_tokens', default=4096, type=int)
+    parser.add_argument('--ie_max_batch_size', default=8, type=int)
+
+    parser.add_argument('--openai_latency', default=1.5, type=float,
+                        help='median latency in seconds')
+    parser.add_argument('--openai_latency_sigma', default=0.5, type=float)
+    parser.add_argument('--openai_token_latency', default=0.0, type=float,
+                        help='seconds to generate each output word after the latency')
+    parser.add_argument('--openai_error_rate', default=0.0, type=float)
+    parser.add_argument('--openai_max_concurrency', default=0, type=int,
+                        help='requests beyond it are rejected, 0 means no limit')
+    parser.add_argument('--openai_model_name',
+                        default="gpt-3.5-turbo", type=str)
+    parser.add_argument('--openai_max_number_of_tokens', default=4096, type=int)
+
+    main(parser.parse_args())
@@ -0,0 +1,72 @@
+import argparse
+import time
+import torch
+
+import code_sim_calculator
+import text_sim_calculator
+from code_sim_calculator import CodeSimCalculator
+from text_sim_calculator import TextSimCalculator
+
+
+def time_calc(calculator, query, items, repeat) -> float:
+    '''return: mean seconds per calc_similarities call'''
+    calculator.calc_similarities(query, items)  # warm up
+
+    start_time = time.time()
+    for _ in range(repeat):
+        # embedding cache would hide the cost of encoding
+        if isinstance(calculator, CodeSimCalculator):
+            calculator.encoder.clear_cache()
+        calculator.calc_similarities(query, items)
+
+    return (time.time() - start_time) / repeat
+
+
+def get_ranking(similarities):
+    return sorted(range(len(similarities)), key=lambda x: similarities[x], reverse=True)
+
+
+def report(name, calculator_cls, query, items, configs, repeat):
+    print(f"{name}:")
+
+    base_sims = None
+    base_time = None
+    for backend, quantize in configs:
+        calculator = calculator_cls(backend=backend, quantize=quantize)
+        sims = calculator.calc_similarities(query, items)
+        mean_time = time_calc(calculator, query, items, repeat)
+
+        if base_sims == None:
+            base_sims = sims
+            base_time = mean_time
+
+        max_diff = max(abs(a - b) for a, b in zip(sims, base_sims))
+        same_ranking = get_ranking(sims) == get_ranking(base_sims)
+        config_name = f"{backend}{'-int8' if quantize else ''}"
+        print(f"\t{config_name:<16} {round(mean_time * 1000, 2):>8} ms/call, "
+              f"speedup {round(base_time / mean_time, 2)}x, "
+              f"max sim diff {round(max_diff, 3)}, same ranking: {same_ranking}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--backends', default=['eager', 'torchscript', 'onnx'],
+                        type=str, nargs='+')
+    parser.add_argument('--repeat', default=20, type=int)
+    parser.add_argument('--num_threads', default=4, type=int)
+    args = parser.parse_args()
+
+    torch.set_num_threads(args.num_threads)
+
+    # plain eager PyTorch is the reference
+    configs = [('eager', False)]
+    for backend in args.backends:
+        if backend != 'eager':
+            configs.append((backend, False))
+        configs.append((backend, True))
+
+    report("all-MiniLM-L6-v2", TextSimCalculator, text_sim_calculator.EXAMPLE_QUERY,
+           [info['summary'] for info in text_sim_calculator.EXAMPLE_INFOS], configs, args.repeat)
+    report("codet5p-220m-bimodal", CodeSimCalculator, code_sim_calculator.EXAMPLE_QUERY,
+           [info['code'] for info in code_sim_calculator.EXAMPLE_INFOS], configs, args.repeat)
@@ -0,0 +1,86 @@
+import json
+import mmap
+import os
+from typing import Iterator, Tuple
+
+
+def get_index_path(blob_path: str) -> str:
+    '''e.g. bodies_repo.bin -> bodies_repo.idx.json'''
+    return f"{os.path.splitext(blob_path)[0]}.idx.json"
+
+
+def iter_methods(dir_obj: dict) -> Iterator[dict]:
+    '''Methods of a parse tree or summary tree directory, in the order of the tree.'''
+    for sub_dir_obj in dir_obj['subdirectories']:
+        yield from iter_methods(sub_dir_obj)
+    for file_obj in dir_obj['files']:
+        yield from file_obj['methods']
+
+
+def write_body_store(parse_obj: dict, blob_path: str):
+    '''
+        Write method bodies of a parse tree into one blob, and an index of {method id: [offset, length]} in bytes.
+        Trees refer to bodies by method id, so they need not carry the code.
+    '''
+    index = {}
+    temp_blob_path = f"{blob_path}.{os.getpid()}.tmp"
+    index_path = get_index_path(blob_path)
+    temp_index_path = f"{index_path}.{os.getpid()}.tmp"
+
+    with open(temp_blob_path, "wb") as f_blob:
+        offset = 0
+        for method_obj in iter_methods(parse_obj['mainDirectory']):
+            data = method_obj['body'].encode()
+            f_blob.write(data)
+            index[method_obj['id']] = [offset, len(data)]
+            offset += len(data)
+    with open(temp_index_path, "w") as f_index:
+        json.dump(index, f_index)
+
+    # the index is replaced last, so an index never points into a partial blob
+    os.replace(temp_blob_path, blob_path)
+    os.replace(temp_index_path, index_path)
+
+
+class BodyStore:
+    '''
+        Read-only access to method bodies written by write_body_store, the blob is memory-mapped
+        so only the bodies that are read are loaded.
+        Usage: with BodyStore(blob_path) as body_store: body_store.get(method_id)
+    '''
+
+    def __init__(self, blob_path: str):
+        with open(get_index_path(blob_path), "r") as f_index:
+            self.index = {int(key): value for key, value in json.load(f_index).items()}
+
+        self.f_blob = open(blob_path, "rb")
+        # an empty file cannot be mapped
+        self.blob = mmap.mmap(self.f_blob.fileno(), 0, access=mmap.ACCESS_READ) \
+            if os.path.getsize(blob_path) > 0 else b""
+
+    def has(self, method_id: int) -> bool:
+        return method_id in self.index
+
+    def get_range(self, method_id: int) -> Tuple[int, int]:
+        '''return: (offset, length) in bytes'''
+        return tuple(self.index[method_id])
+
+    def get(self, method_id: int) -> str:
+        '''Body of the method, "" if it is not in the store.'''
+        if method_id not in self.index:
+            return ""
+
+        offset, length = self.index[method_id]
+        return self.blob[offset:offset + length].decode()
+
+    def close(self):
+        if isinstance(self.blob, mmap.mmap):
+            self.blob.close()
+        self.f_blob.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
@@ -56,6 +56,41 @@ def get_true_path_arr(sum_obj, true_path_str) -> List[str]:
     return true_path_arr
 
 
+def count_correct_prefix(result_path: List[str], true_path_arr: List[str]) -> int:
+    '''Number of leading nodes of the retrieved path that match the true path.'''
+    correct_count = 0
+    for i in range(len(true_path_arr)):
+        if i < len(result_path) and result_path[i] == true_path_arr[i]:
+            correct_count += 1
+        else:
+            break
+
+    return correct_count
+
+
+# serving cost fields of a result line, written by run_eval_ret.py
+COST_FIELDS = ['wall_time', 'llm_time', 'embedding_time', 'tokens', 'llm_call_count', 'backtrack_count']
+
+
+def get_cost(result_obj: dict) -> dict:
+    '''Serving cost of a query, None for results written before costs were recorded.'''
+    if 'wall_time' not in result_obj:
+        return None
+
+    cost = {key: result_obj[key] for key in COST_FIELDS if key in result_obj}
+    cost['tokens'] = result_obj['prompt_tokens'] + \
+        result_obj['completion_tokens']
+    return cost
+
+
+def format_percentiles(values: List[float]) -> str:
+    if len(values) == 0:
+        return "N/A"
+
+    p50, p95, p99 = np.percentile(values, [50, 95, 99])
+    return f"p50: {round(p50, 3)}, p95: {round(p95, 3)}, p99: {round(p99, 3)}, mean: {round(np.mean(values), 3)}"
+
+
 if __name__ == "__main__":
     data_file_path = "./eval_data/filtered/data_final.jsonl"
     ret_result_file_path = "./eval_data/ret_result.jsonl"
@@ -72,6 +107,7 @@ if __name__ == "__main__":
         global_precision_arr = []
         global_iou_arr = []
         global_efficiency_arr = []
+        global_cost_arrs = {key: [] for key in COST_FIELDS}
 
         for result_obj in result_objs:
             # get corresponding data object
@@ -105,16 +141,20 @@ if __name__ == "__main__":
                         'recall_arr': [],
                         'precision_arr': [],
                         'iou_arr': [],
-                        'efficiency_arr': []
+                        'efficiency_arr': [],
+                        'cost_arrs': {key: [] for key in COST_FIELDS},
                     }
 
+                # collect serving cost of the query
+                cost = get_cost(result_obj)
+                if cost != None:
+                    for key, value in cost.items():
+                        repo_stats[repo_name]['cost_arrs'][key].append(value)
+                        global_cost_arrs[key].append(value)
+
                 # calculate recall & efficiency & iou
-                correct_count = 0
-                for i in range(len(true_path_arr)):
-                    if i < len(result_obj['path']) and result_obj['path'][i] == true_path_arr[i]:
-                        correct_count += 1
-                    else:
-                        break
+                correct_count = count_correct_prefix(
+                    result_obj['path'], true_path_arr)
                 if correct_count == len(true_path_arr):
                     repo_stats[repo_name]['recall_arr'].append(1)
                     repo_stats[repo_name]['precision_arr'].append(1)
@@ -153,6 +193,8 @@ if __name__ == "__main__":
             print(f"Precision: {precision}")
             print(f"IoU: {iou}")
             print(f"Efficiency: {efficiency}")
+            for key in COST_FIELDS:
+                print(f"{key}: {format_percentiles(stats['cost_arrs'][key])}")
             print('-' * 20)
 
         # Print the global statistics
@@ -166,5 +208,7 @@ if __name__ == "__main__":
         print(f"Precision: {global_precision}")
         print(f"IoU: {global_iou}")
         print(f"Efficiency: {global_efficiency}")
+        for key in COST_FIELDS:
+            print(f"{key}: {format_percentiles(global_cost_arrs[key])}")
 
     logging.shutdown()
@@ -0,0 +1,247 @@
+import atexit
+import io
+import json
+import os
+import threading
+from typing import List
+from urllib.parse import urlparse
+import requests
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+
+from single_flight import get_request_key
+
+
+CASSETTE_MODES = ['record', 'replay', 'auto']
+
+
+class CassetteMissError(Exception):
+    '''A request has no recorded response in replay mode, retrying cannot help.'''
+    pass
+
+
+def get_index_path(cassette_path: str) -> str:
+    '''e.g. llm.cassette.jsonl -> llm.cassette.idx.json'''
+    return f"{os.path.splitext(cassette_path)[0]}.idx.json"
+
+
+class Cassette:
+    '''
+        HTTP exchanges of LLM endpoints in one JSONL file, one line per response, with an index of
+        {request key: [[offset, length]]} in bytes so replay reads only the responses that are requested.
+        Requests are keyed by method, URL path and body, so host, port and tokens may differ between runs.
+        Sampled completions of one request may differ, all of them are kept and replayed in recorded order,
+        the last one is reused once they are used up.
+        modes:
+            record: send every request and append its response
+            replay: serve recorded responses only, raise CassetteMissError for others
+            auto: serve recorded responses, send and record the others
+    '''
+
+    def __init__(self, path: str, mode: str):
+        if mode not in CASSETTE_MODES:
+            raise Exception(f"Unknown cassette mode: {mode}")
+        if mode == 'replay' and not os.path.exists(path):
+            raise Exception(f"Cassette does not exist: {path}")
+
+        self.path = path
+        self.mode = mode
+        self.lock = threading.Lock()
+        self.index = self._load_index()
+        self.replay_counts = {}  # key -> number of responses served in this run
+
+        self.hit_count = 0
+        self.miss_count = 0
+        self.recorded_count = 0
+
+        self.f_cassette = open(path, "ab+")
+
+    def _load_index(self) -> dict:
+        '''Index saved by close, rebuilt by scanning the cassette if it is stale, e.g. after a crash.'''
+        if not os.path.exists(self.path):
+            return {}
+
+        size = os.path.getsize(self.path)
+        index_path = get_index_path(self.path)
+        if os.path.exists(index_path):
+            with open(index_path, "r") as f_index:
+                index_obj = json.load(f_index)
+            if index_obj['size'] == size:
+                return index_obj['entries']
+
+        index = {}
+        with open(self.path, "rb") as f_cassette:
+            offset = 0
+            for line in f_cassette:
+                # ignore a partially written last line
+                if line.endswith(b"\n"):
+                    index.setdefault(json.loads(line)['key'], []).append(
+                        [offset, len(line)])
+                offset += len(line)
+
+        return index
+
+    @staticmethod
+    def get_key(request: requests.PreparedRequest) -> str:
+        body = request.body if request.body != None else b""
+        if isinstance(body, str):
+            body = body.encode()
+
+        return get_request_key(request.method, urlparse(request.url).path, body)
+
+    def get(self, key: str) -> dict:
+        '''Next recorded response of the key, None if it has none.'''
+        with self.lock:
+            entries = self.index.get(key)
+            if entries == None:
+                self.miss_count += 1
+                return None
+
+            count = self.replay_counts.get(key, 0)
+            self.replay_counts[key] = count + 1
+            self.hit_count += 1
+            offset, length = entries[min(count, len(entries) - 1)]
+            self.f_cassette.seek(offset)
+            data = self.f_cassette.read(length)
+
+        return json.loads(data)
+
+    def put(self, key: str, request: requests.PreparedRequest, status_code: int, headers: dict, body: str):
+        line = (json.dumps({
+            'key': key,
+            'method': request.method,
+            'path': urlparse(request.url).path,
+            'status_code': status_code,
+            'headers': headers,
+            'body': body,
+        }, ensure_ascii=False) + "\n").encode()
+
+        with self.lock:
+            self.f_cassette.seek(0, os.SEEK_END)
+            offset = self.f_cassette.tell()
+            self.f_cassette.write(line)
+            self.f_cassette.flush()
+            self.index.setdefault(key, []).append([offset, len(line)])
+            self.recorded_count += 1
+
+    def close(self):
+        '''Save the index, so the next run need not scan the cassette.'''
+        with self.lock:
+            if self.f_cassette.closed:
+                return
+            self.f_cassette.flush()
+            size = self.f_cassette.seek(0, os.SEEK_END)
+            self.f_cassette.close()
+
+            index_path = get_index_path(self.path)
+            temp_index_path = f"{index_path}.{os.getpid()}.tmp"
+            with open(temp_index_path, "w") as f_index:
+                json.dump({'size': size, 'entries': self.index}, f_index)
+            os.replace(temp_index_path, index_path)
+
+    def get_stats(self) -> dict:
+        return {
+            'hit_count': self.hit_count,
+            'miss_count': self.miss_count,
+            'recorded_count': self.recorded_count,
+        }
+
+
+class CassetteAdapter(HTTPAdapter):
+    '''
+        Transport adapter of requests serving responses from a cassette.
+        Streamed responses are read completely when recorded and are replayed as one buffer,
+        so the client still parses them event by event and may close them early.
+    '''
+
+    # headers needed to parse a replayed response
+    KEPT_HEADERS = ['Content-Type']
+
+    def __init__(self, cassette: Cassette):
+        super().__init__()
+        self.cassette = cassette
+
+    def _build_response(self, request: requests.PreparedRequest, obj: dict) -> requests.Response:
+        response = requests.Response()
+        response.status_code = obj['status_code']
+        response.headers = CaseInsensitiveDict(obj['headers'])
+        response.raw = io.BytesIO(obj['body'].encode())
+        response.encoding = 'utf-8'
+        response.url = request.url
+        response.request = request
+        response.reason = "Replayed"
+
+        return response
+
+    def send(self, request: requests.PreparedRequest, stream: bool = False, timeout=None, verify=True,
+             cert=None, proxies=None) -> requests.Response:
+        key = Cassette.get_key(request)
+
+        if self.cassette.mode != 'record':
+            obj = self.cassette.get(key)
+            if obj != None:
+                return self._build_response(request, obj)
+            if self.cassette.mode == 'replay':
+                raise CassetteMissError(
+                    f"No recorded response of {request.method} {urlparse(request.url).path}")
+
+        live_response = super().send(request, stream=False, timeout=timeout,
+                                     verify=verify, cert=cert, proxies=proxies)
+        headers = {x: live_response.headers[x]
+                   for x in self.KEPT_HEADERS if x in live_response.headers}
+        body = live_response.content.decode('utf-8', errors='replace')
+        # failed requests are retried by clients, only successful responses are worth replaying
+        if live_response.status_code == 200:
+            self.cassette.put(key, request, live_response.status_code, headers, body)
+
+        return self._build_response(request, {
+            'status_code': live_response.status_code, 'headers': headers, 'body': body})
+
+
+# cassettes opened by this process, shared by all clients
+_cassettes = {}
+_cassettes_lock = threading.Lock()
+
+
+def get_cassette(path: str, mode: str) -> Cassette:
+    with _cassettes_lock:
+        if len(_cassettes) == 0:
+            # indexes are saved even if the script does not close the cassettes
+            atexit.register(close_cassettes)
+        if path not in _cassettes:
+            _cassettes[path] = Cassette(path, mode)
+        elif _cassettes[path].mode != mode:
+            raise Exception(
+                f"Cassette {path} is already opened in mode {_cassettes[path].mode}")
+        return _cassettes[path]
+
+
+def close_cassettes() -> List[dict]:
+    '''Close the cassettes opened by this process, return: stats of each one.'''
+    with _cassettes_lock:
+        stats = []
+        for path, cassette in _cassettes.items():
+            cassette.close()
+            stats.append({'path': path, 'mode': cassette.mode, **cassette.get_stats()})
+        _cassettes.clear()
+
+    return stats
+
+
+def get_http_client():
+    '''
+        What clients send requests with: the requests module, or a session served by the cassette
+        given by env LLM_CASSETTE_PATH and LLM_CASSETTE_MODE(record, replay or auto, default: replay).
+        A cassette is written by one process only, e.g. give each worker of run_sum_driver.py its own one.
+    '''
+    path = os.getenv('LLM_CASSETTE_PATH', '')
+    if path == '':
+        return requests
+
+    session = requests.Session()
+    adapter = CassetteAdapter(get_cassette(
+        path, os.getenv('LLM_CASSETTE_MODE', 'replay')))
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+
+    return session
@@ -0,0 +1,95 @@
+from collections import OrderedDict
+from typing import Callable, List
+import torch
+
+
+class CodeEncoder:
+    '''
+        Encode texts or code snippets into normalized embeddings in batches.
+        Texts are sorted by token length and each batch is only padded to its longest item,
+        embeddings of encoded texts are cached.
+    '''
+
+    def __init__(self, model, tokenizer, device: torch.device, batch_size: int = 32,
+                 embed_fn: Callable = None, cache_size: int = 100000):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.device = device
+        self.batch_size = batch_size
+        self.cache_size = cache_size
+        self.cache = OrderedDict()  # (max_length, text) -> embedding on cpu
+
+        # embed_fn(input_ids, attention_mask) -> embeddings
+        # default to the encoder + projection of CodeT5+ bimodal model
+        self.embed_fn = embed_fn if embed_fn != None else self._bimodal_embed
+
+        self.hit_count = 0  # number of texts served from cache
+        self.encode_count = 0  # number of texts passed through the model
+
+    def _bimodal_embed(self, input_ids: torch.Tensor, attention_mask: torch.Tensor) -> torch.Tensor:
+        output = self.model.encoder(input_ids, attention_mask=attention_mask,
+                                    return_dict=True)
+        return torch.nn.functional.normalize(
+            self.model.proj(output.last_hidden_state[:, 0, :]), dim=-1)
+
+    def _add_to_cache(self, key: tuple, embed: torch.Tensor):
+        self.cache[key] = embed
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+    def clear_cache(self):
+        self.cache.clear()
+
+    @torch.inference_mode()
+    def _encode_uncached(self, texts: List[str], max_length: int) -> List[torch.Tensor]:
+        '''Encode texts in length-sorted batches with dynamic padding.'''
+        encoded = self.tokenizer(texts, truncation=True, max_length=max_length)
+        input_ids = encoded['input_ids']
+
+        order = sorted(range(len(texts)), key=lambda x: len(input_ids[x]))
+        embeds = [None] * len(texts)
+
+        for start in range(0, len(order), self.batch_size):
+            batch_idxs = order[start:start + self.batch_size]
+            batch = self.tokenizer.pad(
+                {'input_ids': [input_ids[i] for i in batch_idxs]},
+                padding='longest', return_tensors="pt").to(self.device)
+
+            batch_embeds = self.embed_fn(
+                batch['input_ids'], batch['attention_mask']).float().cpu()
+            for i, embed in zip(batch_idxs, batch_embeds):
+                embeds[i] = embed
+
+        self.encode_count += len(texts)
+
+        return embeds
+
+    def encode(self, texts: List[str], max_length: int) -> torch.Tensor:
+        '''return: embeddings in the same order as texts, shape (len(texts), dim)'''
+        if len(texts) == 0:
+            return torch.empty(0)
+
+        # look up cache, collect texts that have not been encoded (deduplicated)
+        embeds = {}
+        uncached_keys = []
+        for text in texts:
+            key = (max_length, text)
+            if key in embeds:
+                continue
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                embeds[key] = self.cache[key]
+            else:
+                embeds[key] = None
+                uncached_keys.append(key)
+
+        self.hit_count += len(texts) - len(uncached_keys)
+
+        if len(uncached_keys) > 0:
+            new_embeds = self._encode_uncached(
+                [key[1] for key in uncached_keys], max_length)
+            for key, embed in zip(uncached_keys, new_embeds):
+                embeds[key] = embed
+                self._add_to_cache(key, embed)
+
+        return torch.stack([embeds[(max_length, text)] for text in texts]).to(self.device)
@@ -19,6 +19,22 @@ SUM_METHOD = {
     "system_prompt": "Summarize the Java method provided to you in about 40 words.",
     "max_output_length": 80,
 }
+# directories of the fast tier are summarized without GPT, from names and summaries of their children
+SUM_DIR_EXTRACTIVE = {
+    "max_name_count": 12,  # max number of listed subdirectory and file names
+    "max_summary_count": 3,  # number of child summaries whose first sentence is included
+    "max_sentence_length": 50,  # max number of words of each included sentence
+}
+# small methods of one class summarized in one request
+SUM_METHOD_PACKED = {
+    "system_prompt": '''You will be provided with several Java methods of a class, each method starts with a line "Method <NUMBER>:".
+Summarize each Java method in about 40 words.
+You need to answer one line for each method in order as follows:
+<NUMBER>: <SUMMARY>''',
+    "max_output_length_per_method": 80,
+    "max_method_length": 256,  # methods with more tokens are summarized alone
+    "max_method_count": 8,  # max number of methods in one request
+}
 
 # variables for query expansion
 EXP_MAX_REF_COUNT = 3  # max reference summary count per node
@@ -35,11 +51,13 @@ RET_MAX_OUTPUT_LENGTH = 50
 RET_MAX_BACKTRACK_COUNT = 2
 RET_DIR_MAX_INFO_LENGTH = 8
 RET_FILE_MAX_INFO_LENGTH = 12
+# weight of BM25 score over names, signatures and summaries when fused with text similarity
+RET_LEXICAL_WEIGHT = 0.3
 
 # prompt of different hierarchies during retrieval
 RET_DIR_SYSTEM_PROMPT = '''You will be provided with a description of a Java method in a code repository, and an information list of directories or Java class files in this repository in JSON format as follows:
 {"id": <PLACEHOLDER>, "name": <PLACEHOLDER>, "similarity": <PLACEHOLDER>, "summary": <PLACEHOLDER>}
-NOTE: The `similarity` field represents the text similarity between the summary and the method description.
+NOTE: The `similarity` field represents the relevance between the item and the method description, combining the text similarity of the summary and keyword matching.
 A directory contains Java class files and subdirectories, a Java class contains methods.
 You need to follow the steps below:
 - Step 1: Calculate the probability that these directories or Java class files contain this method directly or indirectly.
@@ -48,7 +66,7 @@ You need to return a JSON object as follows:
 {"ids": [<PLACEHOLDER>...]}'''
 RET_FILE_SYSTEM_PROMPT = '''You will be provided with a description of a Java method in a code repository, and an information list of methods in this code repository in JSON format as follows:
 {"id": <PLACEHOLDER>, "signature": <PLACEHOLDER>, "similarity": <PLACEHOLDER>, "summary": <PLACEHOLDER>}
-NOTE: The `similarity` field represents the text similarity between the summary and the method description.
+NOTE: The `similarity` field represents the relevance between the item and the method description, combining the text similarity of the summary and keyword matching.
 You need to infer whether the provided description points to one of these methods. If so, answer the id of the method. Otherwise, the answer id is -1.
 You need to return a JSON object as follows:
 {"id": <PLACEHOLDER>}'''
@@ -0,0 +1,88 @@
+import json
+from typing import Callable, List, Tuple
+
+from generation_backend import GenerationBackend
+
+
+# a packed summary keeps at least this many tokens, unless it is shorter
+CONTEXT_MIN_TEXT_LENGTH = 24
+
+
+def encode_info(info: dict) -> str:
+    '''One line of compact JSON, e.g. {"id":3,"name":"core","similarity":0.42,"summary":"..."}'''
+    return json.dumps(info, ensure_ascii=False, separators=(',', ':')) + "\n"
+
+
+class ContextPacker:
+    '''
+        Fit a ranked list of items into a token budget.
+        Each item is rendered by encode(item, text) where text is its (possibly truncated) summary:
+        items are taken in order while each fits with a minimum share of its summary,
+        then all taken summaries are cut at one common length, the largest that fits the budget,
+        so long summaries are shortened before any item is dropped.
+    '''
+
+    def __init__(self, backend: GenerationBackend, min_text_length: int = CONTEXT_MIN_TEXT_LENGTH):
+        self.backend = backend
+        self.min_text_length = min_text_length
+
+    def _render(self, items: List[dict], encode: Callable, texts: List[str], text_lengths: List[int],
+                count: int, max_text_length: int) -> Tuple[str, int]:
+        '''return: (context text, number of truncated summaries)'''
+        lines = []
+        truncated_count = 0
+        for item, text, text_length in zip(items[:count], texts, text_lengths):
+            if text_length > max_text_length:
+                text = self.backend.truncate(text, max_text_length)
+                truncated_count += 1
+            lines.append(encode(item, text))
+
+        return "".join(lines), truncated_count
+
+    def pack(self, items: List[dict], budget: int, encode: Callable, text_key: str = 'summary') -> Tuple[str, int, int]:
+        '''
+            items: ranked from the most to the least important
+            return: (context text, number of packed items, number of truncated summaries)
+        '''
+        texts = [item[text_key] for item in items]
+        text_lengths = [self.backend.count_tokens(x) for x in texts]
+        base_lengths = [self.backend.count_tokens(
+            encode(item, "")) for item in items]
+
+        # take items in order while they fit with a minimum share of their summaries
+        count = 0
+        total_length = 0
+        for base_length, text_length in zip(base_lengths, text_lengths):
+            length = base_length + min(text_length, self.min_text_length)
+            if total_length + length > budget:
+                break
+            total_length += length
+            count += 1
+
+        if count == 0:
+            return "", 0, 0
+
+        # the largest common summary length within the budget
+        fixed_length = sum(base_lengths[:count])
+        low = min(self.min_text_length, max(text_lengths[:count]))
+        high = max(text_lengths[:count])
+        while low < high:
+            mid = (low + high + 1) // 2
+            if fixed_length + sum(min(x, mid) for x in text_lengths[:count]) <= budget:
+                low = mid
+            else:
+                high = mid - 1
+        max_text_length = low
+
+        # token counts of parts are not exactly additive, shrink until the whole context fits
+        while True:
+            context, truncated_count = self._render(
+                items, encode, texts, text_lengths, count, max_text_length)
+            if self.backend.count_tokens(context) <= budget or count == 0:
+                return context, count, truncated_count
+
+            if max_text_length > self.min_text_length:
+                max_text_length = max(self.min_text_length,
+                                      max_text_length * 9 // 10)
+            else:
+                count -= 1
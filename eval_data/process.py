@@ -1,16 +1,18 @@
 import json
 import os
-import random
 import re
-from time import sleep
+import shutil
+import sys
+import zipfile
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from multiprocessing import Pool
 from tqdm import tqdm
 
 import requests
 
-
-def parse_repo(repo_path, output_path) -> int:
-    return os.system(
-        f"java -jar ../java-repo-parser.jar -r={repo_path} -o={output_path}")
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from parse_cache import ParseCache  # noqa: E402
+from repo_info_store import RepoInfoStore  # noqa: E402
 
 
 exclude_repo_set = set([
@@ -113,164 +115,208 @@ exclude_repo_set = set([
 ])
 
 
-def filter_data1(raw_dir_path, output_file_path):
-    res = []
-    filtered_repo_data = []  # list contains filtered data in one repo
-    cur_repo = ''
-    cur_repo_path_set = set()  # use to ignore same path data in one repo
-    repo_set = set()  # use to calculate repo count, there has discontinuous data in one repo
-
-    for filename in tqdm(os.listdir(raw_dir_path)):
-        if not filename.endswith('.jsonl'):
-            continue
-
-        with open(os.path.join(raw_dir_path, filename), 'r') as jsonl_f:
-            for line in jsonl_f:
-                obj = json.loads(line)
-
-                # exclude repos(can't be parsed / too large / renamed / difficult to understand)
-                if obj['repo'] in exclude_repo_set:
-                    continue
-
-                # exclude repos
-
-                if obj['repo'] + obj['sha'] != cur_repo:
-                    # limitation for data count in one repo
-                    if len(filtered_repo_data) >= 100:
-                        res.extend(filtered_repo_data)
-                        repo_set.add(cur_repo)
-
-                    filtered_repo_data = []
-                    cur_repo = obj['repo'] + obj['sha']
-                    cur_repo_path_set.clear()
-
-                # limitation for whether the file equals to the class name
-                if obj['path'].split('/')[-1].split('.')[0] != obj['func_name'].split('.')[0]:
-                    continue
-
-                # limitation for same path(file path + method name) in one repo
-                if obj['path'] + '/' + obj['func_name'].split('.')[1] in cur_repo_path_set:
-                    continue
-
-                # limitation for directory hierarchy in path field
-                # if obj['path'].count('/') < 3 or obj['path'].count('/') > 15:
-                #     continue
-
-                # limitation for query's token count in docstring_tokens field
-                # if len(obj['docstring_tokens']) < 10:
-                #     continue
-
-                # limitation for content of query in docstring field
-                if not obj['docstring'].isascii():
-                    continue
-                if "(non-Javadoc)" in obj['docstring']:
-                    continue
-
-                # handle content of query in docstring field
-                query = obj['docstring']
-
-                query = re.sub(r'\{@link([^\}]*)\}', r'\1', query)
-                query = re.sub(r'\{@code([^\}]*)\}', r'\1', query)
-                query = re.sub(r'$\{([^\}]*)\}', r'\1', query)
-
-                query = re.sub(r'https?:\/\/[^\s]*', '', query)
-                query = re.sub(r'<[^>]*>', '', query)
-                query = re.sub(r'@.*', '', query)
-                query = re.sub(r'\(e\.g\.[^\)]*\)', '', query)
-                query = re.sub(r'\(i\.e\.[^\)]*\)', '', query)
-
-                query = re.sub(r'/\*.*', '', query)
-                query = query.split('.')[0] + '.'
-                query = query.replace('\n', ' ')
-                query = re.sub(r'\s+', ' ', query)
-                query = query.strip()
-
-                # ignore query which is too short or too long
-                if len(query) < 40 or len(query) > 200:
-                    continue
-
-                # ignore duplicate query in one repo
-                if query in [item['query'] for item in filtered_repo_data]:
-                    continue
-
-                path = obj['path'] + '/' + obj['func_name'].split('.')[1]
-                filtered_repo_data.append({
-                    'repo': obj['repo'],
-                    'query': query,
-                    'path': path,
-                    'sha': obj['sha'],
-                })
-
-                cur_repo_path_set.add(path)
-
-    with open(output_file_path, 'w') as out_f:
-        for obj in res:
-            json.dump(obj, out_f)
-            out_f.write('\n')
-
-
-def get_repo_info_by_api(repo_name: str):
-    for _ in range(3):
-        try:
-            res = requests.get(
-                f"https://api.github.com/repos/{repo_name}")
-
-            if res.status_code != 200:
-                raise Exception(
-                    f"Status code: {res.status_code}, {res.json()}")
-
-            return res.json()
-        except Exception as e:
-            print(f'Error: {repo_name}')
-            print(e)
-            sleep(random.randint(10, 20))
-            continue
-
-    return None
-
+# patterns used to clean docstring into query, in order
+QUERY_SUB_PATTERNS = [
+    (re.compile(r'\{@link([^\}]*)\}'), r'\1'),
+    (re.compile(r'\{@code([^\}]*)\}'), r'\1'),
+    (re.compile(r'$\{([^\}]*)\}'), r'\1'),
+    (re.compile(r'https?:\/\/[^\s]*'), ''),
+    (re.compile(r'<[^>]*>'), ''),
+    (re.compile(r'@.*'), ''),
+    (re.compile(r'\(e\.g\.[^\)]*\)'), ''),
+    (re.compile(r'\(i\.e\.[^\)]*\)'), ''),
+    (re.compile(r'/\*.*'), ''),
+]
+WHITESPACE_PATTERN = re.compile(r'\s+')
+
+
+def clean_query(docstring: str) -> str:
+    query = docstring
+    for pattern, repl in QUERY_SUB_PATTERNS:
+        query = pattern.sub(repl, query)
+
+    query = query.split('.')[0] + '.'
+    query = query.replace('\n', ' ')
+    query = WHITESPACE_PATTERN.sub(' ', query)
+
+    return query.strip()
+
+
+class RepoRun:
+    '''Filtered data of consecutive lines with the same repo + sha, deduplicated by path and query.'''
+
+    def __init__(self, key: str):
+        self.key = key
+        self.items = []
+        self.path_set = set()  # use to ignore same path data in one repo
+        self.query_set = set()  # use to ignore duplicate query in one repo
+
+    def add(self, item: dict):
+        if item['path'] in self.path_set or item['query'] in self.query_set:
+            return
+        self.items.append(item)
+        self.path_set.add(item['path'])
+        self.query_set.add(item['query'])
+
+
+def get_candidate(obj: dict) -> dict:
+    '''
+        Apply the filters which depend on the line only.
+        return: the data of the line, None if it is filtered out
+    '''
+    # limitation for whether the file equals to the class name
+    if obj['path'].split('/')[-1].split('.')[0] != obj['func_name'].split('.')[0]:
+        return None
+
+    # limitation for directory hierarchy in path field
+    # if obj['path'].count('/') < 3 or obj['path'].count('/') > 15:
+    #     return None
+
+    # limitation for query's token count in docstring_tokens field
+    # if len(obj['docstring_tokens']) < 10:
+    #     return None
+
+    # limitation for content of query in docstring field
+    if not obj['docstring'].isascii():
+        return None
+    if "(non-Javadoc)" in obj['docstring']:
+        return None
+
+    # handle content of query in docstring field
+    query = clean_query(obj['docstring'])
+
+    # ignore query which is too short or too long
+    if len(query) < 40 or len(query) > 200:
+        return None
+
+    return {
+        'repo': obj['repo'],
+        'query': query,
+        'path': obj['path'] + '/' + obj['func_name'].split('.')[1],
+        'sha': obj['sha'],
+    }
+
+
+def filter_shard(file_path: str) -> list:
+    '''
+        Filter one raw jsonl shard by the filters which depend on the line only.
+        Same path and duplicate query are not ignored here, since a repo may continue across shards.
+        return: a list of (repo + sha, candidate data) of consecutive lines, in the order of lines
+    '''
+    runs = []
+
+    with open(file_path, 'r') as jsonl_f:
+        for line in jsonl_f:
+            obj = json.loads(line)
+
+            # exclude repos(can't be parsed / too large / renamed / difficult to understand)
+            if obj['repo'] in exclude_repo_set:
+                continue
 
-def filter_repo1(data_file_path, repo_file_path, output_file_path):
+            key = obj['repo'] + obj['sha']
+            if len(runs) == 0 or runs[-1][0] != key:
+                runs.append((key, []))
+
+            candidate = get_candidate(obj)
+            if candidate != None:
+                runs[-1][1].append(candidate)
+
+    return runs
+
+
+def iter_repo_runs(shard_runs_iter):
+    '''
+        Merge runs of the same repo that continue across shards, and deduplicate their data by path and query
+        in the order of lines.
+        shard_runs_iter: results of filter_shard in the order of shards
+        return: RepoRun of each repo, including the last one
+    '''
+    cur_run = None
+    for runs in shard_runs_iter:
+        for key, candidates in runs:
+            if cur_run is None or key != cur_run.key:
+                if cur_run is not None:
+                    yield cur_run
+                cur_run = RepoRun(key)
+            for candidate in candidates:
+                cur_run.add(candidate)
+
+    if cur_run is not None:
+        yield cur_run
+
+
+def write_repo_runs(repo_runs, out_f) -> int:
+    '''Write data of repos with at least 100 data, return: count of written data.'''
+    data_count = 0
+    pending_run = None
+    for run in repo_runs:
+        # limitation for data count in one repo
+        if pending_run is not None and len(pending_run.items) >= 100:
+            for obj in pending_run.items:
+                json.dump(obj, out_f)
+                out_f.write('\n')
+            data_count += len(pending_run.items)
+        pending_run = run
+
+    # same as before, data of the last repo is not written
+    return data_count
+
+
+def filter_data1(raw_dir_path, output_file_path, workers=4):
+    '''
+        Shards are filtered in parallel and streamed back in order, then deduplicated in one ordered pass.
+        Runs of the same repo that continue across shards are merged, repos with at least 100 data are kept.
+    '''
+    filenames = sorted([filename for filename in os.listdir(
+        raw_dir_path) if filename.endswith('.jsonl')])
+    file_paths = [os.path.join(raw_dir_path, filename)
+                  for filename in filenames]
+
+    with Pool(processes=workers) as pool, open(output_file_path, 'w') as out_f:
+        data_count = write_repo_runs(iter_repo_runs(
+            tqdm(pool.imap(filter_shard, file_paths), total=len(file_paths))), out_f)
+
+    print(f'Filtered data count: {data_count}')
+
+
+def filter_repo1(data_file_path, repo_file_path, output_file_path, api_url="https://api.github.com", workers=8):
     respos = []
-    repo_set = set()
+    repo_objs = {}  # repo -> first data object of the repo
 
-    with open(data_file_path, 'r') as f_data, open(repo_file_path, 'r') as f_repo_info:
-        data_objs = [json.loads(line) for line in f_data]
-        repo_infos = [json.loads(line) for line in f_repo_info]
+    with open(data_file_path, 'r') as f_data:
+        for line in f_data:
+            data_obj = json.loads(line)
+            if data_obj['repo'] not in repo_objs:
+                repo_objs[data_obj['repo']] = data_obj
+
+    # get repo info, repos not in repo_file_path are fetched concurrently
+    repo_info_store = RepoInfoStore(repo_file_path, api_url,
+                                    token=os.getenv('GITHUB_TOKEN'), workers=workers)
+    repo_infos = repo_info_store.fetch_many(list(repo_objs.keys()))
+
+    for repo, data_obj in tqdm(repo_objs.items()):
+        repo_info = repo_infos[repo]
+        if repo_info is None:
+            print(f'Cannot get repo info: {repo}')
+            continue
 
-        for data_obj in tqdm(data_objs):
-            if data_obj['repo'] in repo_set:
-                continue
-            repo_set.add(data_obj['repo'])
-
-            # get repo info
-            repo_info = next(
-                filter(lambda x: x['name'] == data_obj['repo'].split('/')[-1], repo_infos), None)
-            if repo_info is None:
-                repo_info = get_repo_info_by_api(data_obj['repo'])
-                if repo_info is None:
-                    print(f'Cannot get repo info: {data_obj["repo"]}')
-                    return
-
-                with open(repo_file_path, 'a') as f_out:
-                    f_out.write(json.dumps(repo_info) + '\n')
-
-            # # limitation for star count
-            if repo_info['stargazers_count'] < 50:
-                continue
+        # # limitation for star count
+        if repo_info['stargazers_count'] < 50:
+            continue
 
-            github_url = f"https://github.com/{data_obj['repo']}/blob/{data_obj['sha']}"
-            # cancat zip url
-            # https://github.com/soimort/you-get/archive/b746ac01c9f39de94cac2d56f665285b0523b974.zip
-            zip_url = f"https://github.com/{data_obj['repo']}/archive/{data_obj['sha']}.zip"
+        github_url = f"https://github.com/{data_obj['repo']}/blob/{data_obj['sha']}"
+        # cancat zip url
+        # https://github.com/soimort/you-get/archive/b746ac01c9f39de94cac2d56f665285b0523b974.zip
+        zip_url = f"https://github.com/{data_obj['repo']}/archive/{data_obj['sha']}.zip"
 
-            respos.append({
-                'repo': data_obj['repo'],
-                'sha': data_obj['sha'],
-                'star': repo_info['stargazers_count'],
-                'description': repo_info['description'],
-                'github_url': github_url,
-                'zip_url': zip_url,
-            })
+        respos.append({
+            'repo': data_obj['repo'],
+            'sha': data_obj['sha'],
+            'star': repo_info['stargazers_count'],
+            'description': repo_info['description'],
+            'github_url': github_url,
+            'zip_url': zip_url,
+        })
 
     print(f'Filtered repo count: {len(respos)}')
 
@@ -278,55 +324,53 @@ def filter_repo1(data_file_path, repo_file_path, output_file_path):
         json.dump(respos, out_f)
 
 
-def filter_repo2(repo_file_path, repo_root_path, output_file_path):
+def filter_repo2(repo_file_path, repo_root_path, output_file_path, parse_cache: ParseCache, parse_workers=4):
     repos = []
-    temp_dir_path = './parse_temp'
-    temp_file_list = os.listdir(temp_dir_path)
 
     with open(repo_file_path, 'r') as f_repo:
         repo_objs = json.load(f_repo)
 
-        for repo_obj in tqdm(repo_objs):
-            repo_dir_name = f"{repo_obj['repo'].split('/')[-1]}-{repo_obj['sha']}"
-            repo_dir_path = os.path.join(repo_root_path, repo_dir_name)
-
-            parse_out_path = os.path.join(
-                temp_dir_path, f"parse_out_{repo_dir_name}.json")
-
-            # if repo is already parsed, skip it
-            if f"parse_out_{repo_dir_name}.json" not in temp_file_list:
-                if (0 != parse_repo(repo_dir_path, parse_out_path)):
-                    print(f"Failed to parse repo: {repo_obj['repo']}")
-                    continue
-
-            with open(parse_out_path, 'r') as f_parse_out:
-                try:
-                    parse_obj = json.loads(f_parse_out.read())
-                except Exception as e:
-                    print(f"Failed to parse json: {parse_out_path}")
-                    print(e)
-                    return
-                node_count = parse_obj['nodeCount']
-                max_sub_dir_count = parse_obj['maxSubDirCount']
-                max_file_count = parse_obj['maxFileCount']
-                max_sub_dir_and_file_count = parse_obj['maxSubDirAndFileCount']
-                # print(
-                #     f"Repo: {repo_obj['repo']}, Node count: {node_count}")
-                if node_count > 3000:
-                    continue
-
-                # if max_sub_dir_count > 6 or max_sub_dir_count < 2:
-                #     continue
-
-                if max_sub_dir_and_file_count > 50:
-                    continue
-
-                repo_obj['node_count'] = node_count
-                repo_obj['max_sub_dir_count'] = max_sub_dir_count
-                repo_obj['max_file_count'] = max_file_count
-                repo_obj['max_sub_dir_and_file_count'] = max_sub_dir_and_file_count
-
-                repos.append(repo_obj)
+    # parse all repos concurrently, repos parsed before are taken from cache
+    parse_out_paths = parse_cache.parse_many([
+        (repo_obj['repo'], repo_obj['sha'], os.path.join(
+            repo_root_path, f"{repo_obj['repo'].split('/')[-1]}-{repo_obj['sha']}"))
+        for repo_obj in repo_objs
+    ], parse_workers)
+
+    for repo_obj in tqdm(repo_objs):
+        parse_out_path = parse_out_paths[(repo_obj['repo'], repo_obj['sha'])]
+        if parse_out_path is None:
+            print(f"Failed to parse repo: {repo_obj['repo']}")
+            continue
+
+        with open(parse_out_path, 'r') as f_parse_out:
+            try:
+                parse_obj = json.loads(f_parse_out.read())
+            except Exception as e:
+                print(f"Failed to parse json: {parse_out_path}")
+                print(e)
+                return
+            node_count = parse_obj['nodeCount']
+            max_sub_dir_count = parse_obj['maxSubDirCount']
+            max_file_count = parse_obj['maxFileCount']
+            max_sub_dir_and_file_count = parse_obj['maxSubDirAndFileCount']
+            # print(
+            #     f"Repo: {repo_obj['repo']}, Node count: {node_count}")
+            if node_count > 3000:
+                continue
+
+            # if max_sub_dir_count > 6 or max_sub_dir_count < 2:
+            #     continue
+
+            if max_sub_dir_and_file_count > 50:
+                continue
+
+            repo_obj['node_count'] = node_count
+            repo_obj['max_sub_dir_count'] = max_sub_dir_count
+            repo_obj['max_file_count'] = max_file_count
+            repo_obj['max_sub_dir_and_file_count'] = max_sub_dir_and_file_count
+
+            repos.append(repo_obj)
 
     print(f'Filtered repo count: {len(repos)}')
 
@@ -334,36 +378,44 @@ def filter_repo2(repo_file_path, repo_root_path, output_file_path):
         json.dump(repos, out_f)
 
 
-def has_true_path_arr(parse_obj, true_path_str) -> bool:
-    def get_method_path(file_obj, path_str):
-        if path_str[0] == '/':
-            path_str = path_str[1:]
+def get_method_path_set(parse_obj) -> set:
+    '''Paths(file path + method name, without repo directory) of all methods in the parse tree.'''
+    def traverse_dir(dir_obj, path_prefix):
+        for sub_dir_obj in dir_obj['subdirectories']:
+            traverse_dir(sub_dir_obj, path_prefix + sub_dir_obj['name'] + '/')
 
-        for method_obj in file_obj['methods']:
-            if path_str == method_obj['name']:
-                return True
+        for file_obj in dir_obj['files']:
+            for method_obj in file_obj['methods']:
+                method_path_set.add(
+                    path_prefix + file_obj['name'] + '/' + method_obj['name'])
 
-        return False
+    method_path_set = set()
+    traverse_dir(parse_obj['mainDirectory'], '')
 
-    def get_file_path(dir_obj, path_str):
-        if path_str[0] == '/':
-            path_str = path_str[1:]
+    return method_path_set
 
-        for sub_dir_obj in dir_obj['subdirectories']:
-            if path_str.startswith(sub_dir_obj['name']):
-                return get_file_path(sub_dir_obj, path_str[len(sub_dir_obj['name']):])
 
-        for file_obj in dir_obj['files']:
-            if path_str.startswith(file_obj['name']):
-                return get_method_path(file_obj, path_str[len(file_obj['name']):])
+def has_true_path_arr(method_path_set, true_path_str) -> bool:
+    return true_path_str.lstrip('/') in method_path_set
 
-        return False
 
-    return get_file_path(parse_obj['mainDirectory'], true_path_str)
+def check_repo_paths(args) -> list:
+    '''
+        Load the parse tree of a repo once and check all paths of its data.
+        args: (parse_out_path, [true_path_str])
+        return: a list of bool, None if the parse output does not exist
+    '''
+    parse_out_path, true_path_strs = args
+    if not os.path.exists(parse_out_path):
+        return None
 
+    with open(parse_out_path, 'r') as parse_f:
+        method_path_set = get_method_path_set(json.load(parse_f))
 
-def filter_data2(repo_file_path, data_file_path, output_file_path):
-    res = []
+    return [has_true_path_arr(method_path_set, x) for x in true_path_strs]
+
+
+def filter_data2(repo_file_path, data_file_path, output_file_path, parse_cache: ParseCache, workers=4):
     repo_set = set()
     no_true_path_count = 0
 
@@ -372,28 +424,40 @@ def filter_data2(repo_file_path, data_file_path, output_file_path):
         for repo_obj in repo_objs:
             repo_set.add(repo_obj['repo'])
 
+    # group data by repo + sha, keep the original order for output
+    data_objs = []
+    group_dict = {}  # (repo, sha) -> indexes of data_objs
     with open(data_file_path, 'r') as data_f:
-        data_objs = [json.loads(line) for line in data_f]
-        for data_obj in tqdm(data_objs):
+        for line in data_f:
+            data_obj = json.loads(line)
             if data_obj['repo'] not in repo_set:
                 continue
 
-            # java-repo-parser ignores the dir of test / tests / testing / doc / docs / example / examples / smaple / smaples / demo / demos
-            # and the method of getter / setter / equals / toString / hashCode
-            # so we need to filter them out
-            parse_out_path = os.path.join(
-                './parse_temp', f"parse_out_{data_obj['repo'].split('/')[-1]}-{data_obj['sha']}.json")
-            if not os.path.exists(parse_out_path):
-                print(f'Parse out file not exists: {parse_out_path}')
+            group_dict.setdefault(
+                (data_obj['repo'], data_obj['sha']), []).append(len(data_objs))
+            data_objs.append(data_obj)
+
+    # java-repo-parser ignores the dir of test / tests / testing / doc / docs / example / examples / smaple / smaples / demo / demos
+    # and the method of getter / setter / equals / toString / hashCode
+    # so we need to filter them out
+    keys = list(group_dict.keys())
+    tasks = [(parse_cache.get_path(repo, sha), [data_objs[idx]['path'] for idx in group_dict[(repo, sha)]])
+             for repo, sha in keys]
+
+    is_kept = [False] * len(data_objs)
+    with Pool(processes=workers) as pool:
+        for key, task, results in tqdm(zip(keys, tasks, pool.imap(check_repo_paths, tasks)), total=len(tasks)):
+            if results is None:
+                print(f'Parse out file not exists: {task[0]}')
                 continue
-            with open(parse_out_path, 'r') as parse_f:
-                parse_obj = json.load(parse_f)
 
-                if not has_true_path_arr(parse_obj, data_obj['path']):
+            for idx, result in zip(group_dict[key], results):
+                if result:
+                    is_kept[idx] = True
+                else:
                     no_true_path_count += 1
-                    continue
 
-                res.append(data_obj)
+    res = [data_obj for idx, data_obj in enumerate(data_objs) if is_kept[idx]]
 
     # print(f'No true path count: {no_true_path_count}')
     print(f'Filtered data count: {len(res)}')
@@ -433,32 +497,130 @@ def filter_data3(repo_file_path, data_file_path, output_file_path):
             out_f.write('\n')
 
 
-def download_repos(repo_file_path, repo_dir_path, start_idx=0):
-    repo_dir_name_list = os.listdir(repo_dir_path)
+def download_zip(zip_url, zip_path, chunk_size=1 << 20, timeout=60):
+    '''
+        Stream an archive to zip_path, resume from a partial `.part` file with HTTP range request.
+        raise Exception if the archive is incomplete.
+    '''
+    part_path = zip_path + '.part'
+    downloaded_size = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+
+    headers = {'Range': f'bytes={downloaded_size}-'} if downloaded_size > 0 else {}
+    with requests.get(zip_url, headers=headers, stream=True, timeout=timeout) as response:
+        if response.status_code == 416:
+            # range not satisfiable, the part file is already complete or broken, restart
+            os.remove(part_path)
+            return download_zip(zip_url, zip_path, chunk_size, timeout)
+        if response.status_code not in (200, 206):
+            raise Exception(
+                f"Status code: {response.status_code}, {zip_url}")
+
+        # server ignored range request, download from the beginning
+        if response.status_code == 200:
+            downloaded_size = 0
+
+        expected_size = None
+        if 'Content-Length' in response.headers:
+            expected_size = downloaded_size + \
+                int(response.headers['Content-Length'])
+
+        with open(part_path, 'ab' if downloaded_size > 0 else 'wb') as zip_f:
+            for chunk in response.iter_content(chunk_size=chunk_size):
+                zip_f.write(chunk)
+
+    # verify completeness
+    if expected_size is not None and os.path.getsize(part_path) != expected_size:
+        raise Exception(
+            f"Incomplete download: {os.path.getsize(part_path)} / {expected_size} bytes, {zip_url}")
+    if not zipfile.is_zipfile(part_path):
+        os.remove(part_path)
+        raise Exception(f"Downloaded file is not a zip archive: {zip_url}")
+
+    os.replace(part_path, zip_path)
+
+
+def extract_zip(zip_path, repo_dir_path, repo_dir_name):
+    '''
+        Verify and extract an archive whose top level directory is repo_dir_name, then remove the archive.
+        The directory appears in repo_dir_path only after it is completely extracted.
+    '''
+    extract_dir_path = os.path.join(repo_dir_path, f".extract_{repo_dir_name}")
+    if os.path.exists(extract_dir_path):
+        shutil.rmtree(extract_dir_path)
+
+    with zipfile.ZipFile(zip_path, 'r') as zip_f:
+        bad_file = zip_f.testzip()
+        if bad_file is not None:
+            os.remove(zip_path)
+            raise Exception(f"Corrupted file in archive: {bad_file}")
+        zip_f.extractall(extract_dir_path)
+
+    extracted_path = os.path.join(extract_dir_path, repo_dir_name)
+    if not os.path.isdir(extracted_path):
+        shutil.rmtree(extract_dir_path)
+        raise Exception(
+            f"Archive does not contain directory {repo_dir_name}: {zip_path}")
+
+    os.replace(extracted_path, os.path.join(repo_dir_path, repo_dir_name))
+    shutil.rmtree(extract_dir_path)
+    os.remove(zip_path)
+
+
+def download_repos(repo_file_path, repo_dir_path, start_idx=0, download_workers=8, extract_workers=4):
+    '''
+        Download repos concurrently and extract them in a process pool.
+        Partial downloads are kept in repo_dir_path/.download and resumed on the next run.
+        return: a list of repos which failed
+    '''
+    download_dir_path = os.path.join(repo_dir_path, '.download')
+    os.makedirs(download_dir_path, exist_ok=True)
+    repo_dir_name_set = set(os.listdir(repo_dir_path))
 
     with open(repo_file_path, 'r') as json_f:
         repo_objs = json.load(json_f)
 
-        for i, repo_obj in enumerate(tqdm(repo_objs[start_idx:])):
-            # if repo is already downloaded, skip it
-            repo_dir_name = f"{repo_obj['repo'].split('/')[-1]}-{repo_obj['sha']}"
-            if repo_dir_name in repo_dir_name_list:
-                continue
+    # if repo is already downloaded, skip it
+    todo_objs = []
+    for repo_obj in repo_objs[start_idx:]:
+        repo_dir_name = f"{repo_obj['repo'].split('/')[-1]}-{repo_obj['sha']}"
+        if repo_dir_name not in repo_dir_name_set:
+            todo_objs.append((repo_obj, repo_dir_name))
+
+    def download(todo_obj):
+        repo_obj, repo_dir_name = todo_obj
+        zip_path = os.path.join(download_dir_path, f"{repo_dir_name}.zip")
+        # a complete archive left by a previous run only needs extraction
+        if not os.path.exists(zip_path):
+            download_zip(repo_obj['zip_url'], zip_path)
+        return zip_path
+
+    failed_repos = []
+    with ThreadPoolExecutor(max_workers=download_workers) as download_executor, \
+            ProcessPoolExecutor(max_workers=extract_workers) as extract_executor:
+        download_futures = {download_executor.submit(
+            download, todo_obj): todo_obj for todo_obj in todo_objs}
+
+        extract_futures = {}
+        for future in tqdm(as_completed(download_futures), total=len(download_futures), desc='Downloading'):
+            repo_obj, repo_dir_name = download_futures[future]
+            try:
+                zip_path = future.result()
+                extract_futures[extract_executor.submit(
+                    extract_zip, zip_path, repo_dir_path, repo_dir_name)] = repo_obj
+            except Exception as e:
+                print(e)
+                failed_repos.append(repo_obj['repo'])
 
+        for future in tqdm(as_completed(extract_futures), total=len(extract_futures), desc='Extracting'):
             try:
-                response = requests.get(repo_obj['zip_url'])
-                with open(os.path.join(repo_dir_path, 'temp.zip'), 'wb') as zip_f:
-                    zip_f.write(response.content)
-
-                # unzip & remove temp.zip
-                os.system(
-                    'unzip -q -d {} {}'.format(repo_dir_path, os.path.join(repo_dir_path, 'temp.zip')))
-                os.system(
-                    'rm -rf {}'.format(os.path.join(repo_dir_path, 'temp.zip')))
+                future.result()
             except Exception as e:
                 print(e)
-                print(f'Stop at {i + start_idx}')
-                return
+                failed_repos.append(extract_futures[future]['repo'])
+
+    print(f'Failed repo count: {len(failed_repos)}')
+
+    return failed_repos
 
 
 if __name__ == "__main__":
@@ -474,14 +636,18 @@ if __name__ == "__main__":
     repo_final_file_path = os.path.join(filtered_dir_path, 'repo_final.json')
     data3_file_path = os.path.join(filtered_dir_path, 'data3.jsonl')
 
+    # shared with run_eval_sum.py, so each repo is parsed once
+    parse_cache = ParseCache(os.path.join(os.getcwd(), 'parse_cache'),
+                             os.path.join(os.path.dirname(os.getcwd()), 'java-repo-parser.jar'))
+
     # filter_data1(raw_dir_path, data1_file_path)
 
     # filter_repo1(data1_file_path, repo_info_file_path, repo1_file_path)
 
     # download_repos(repo1_file_path, repo_dir_path, 0)
 
-    # filter_repo2(repo1_file_path, repo_dir_path, repo2_file_path)
+    # filter_repo2(repo1_file_path, repo_dir_path, repo2_file_path, parse_cache)
 
-    # filter_data2(repo2_file_path, data1_file_path, data2_file_path)
+    # filter_data2(repo2_file_path, data1_file_path, data2_file_path, parse_cache)
 
     filter_data3(repo_final_file_path, data2_file_path, data3_file_path)
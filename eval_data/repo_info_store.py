@@ -0,0 +1,159 @@
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List
+
+import requests
+from tqdm import tqdm
+
+
+class RateLimiter:
+    '''Pause all workers when GitHub API reports the rate limit is exhausted.'''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.resume_time = 0.0
+
+    def wait(self):
+        while True:
+            with self.lock:
+                delay = self.resume_time - time.time()
+            if delay <= 0:
+                return
+            time.sleep(min(delay, 5))
+
+    def _pause_until(self, resume_time: float):
+        with self.lock:
+            if resume_time > self.resume_time:
+                print(
+                    f"Rate limit reached, pause for {round(resume_time - time.time())}s")
+                self.resume_time = resume_time
+
+    def update(self, response: requests.Response):
+        headers = response.headers
+        now = time.time()
+
+        if response.status_code in (403, 429):
+            if 'Retry-After' in headers:
+                self._pause_until(now + int(headers['Retry-After']))
+            elif headers.get('X-RateLimit-Remaining') == '0' and 'X-RateLimit-Reset' in headers:
+                self._pause_until(int(headers['X-RateLimit-Reset']) + 1)
+            else:
+                # secondary rate limit without hint
+                self._pause_until(now + 60)
+        elif headers.get('X-RateLimit-Remaining') == '0' and 'X-RateLimit-Reset' in headers:
+            self._pause_until(int(headers['X-RateLimit-Reset']) + 1)
+
+
+class RepoInfoStore:
+    '''
+        Repo metadata from GitHub API, stored in a jsonl file and indexed by repo name(owner/name) in memory.
+        Each record is the API response plus `_repo`(requested repo name) and `_etag`.
+        Missing repos are fetched concurrently, refreshes use conditional requests(ETag).
+    '''
+
+    def __init__(self, file_path: str, api_url: str = "https://api.github.com", token: str = None,
+                 workers: int = 8, max_retries: int = 3):
+        self.file_path = file_path
+        self.api_url = api_url.rstrip('/')
+        self.token = token
+        self.workers = workers
+        self.max_retries = max_retries
+
+        self.index: Dict[str, dict] = {}
+        self.file_lock = threading.Lock()
+        self.rate_limiter = RateLimiter()
+
+        self._load()
+
+    def _load(self):
+        if not os.path.exists(self.file_path):
+            return
+
+        with open(self.file_path, 'r') as f_repo_info:
+            for line in f_repo_info:
+                try:
+                    repo_info = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                # records written before the index existed only have full_name
+                repo = repo_info.get('_repo', repo_info.get('full_name'))
+                if repo is not None:
+                    self.index[repo] = repo_info
+
+    def get(self, repo: str) -> dict:
+        '''return: repo info, None if it is not in store'''
+        return self.index.get(repo)
+
+    def _append(self, repo_info: dict):
+        with self.file_lock:
+            self.index[repo_info['_repo']] = repo_info
+            with open(self.file_path, 'a') as f_repo_info:
+                f_repo_info.write(json.dumps(repo_info) + '\n')
+
+    def _fetch(self, repo: str) -> dict:
+        '''return: repo info, None if it can't be fetched'''
+        headers = {'Accept': 'application/vnd.github+json'}
+        if self.token is not None:
+            headers['Authorization'] = f"Bearer {self.token}"
+
+        cached_info = self.index.get(repo)
+        if cached_info is not None and cached_info.get('_etag') is not None:
+            headers['If-None-Match'] = cached_info['_etag']
+
+        for _ in range(self.max_retries):
+            self.rate_limiter.wait()
+            try:
+                res = requests.get(
+                    f"{self.api_url}/repos/{repo}", headers=headers, timeout=20)
+            except Exception as e:
+                print(f'Error: {repo}\n{e}')
+                continue
+
+            self.rate_limiter.update(res)
+
+            # not modified, conditional requests do not count against the rate limit
+            if res.status_code == 304:
+                return cached_info
+            if res.status_code == 200:
+                repo_info = res.json()
+                repo_info['_repo'] = repo
+                repo_info['_etag'] = res.headers.get('ETag')
+                self._append(repo_info)
+                return repo_info
+            if res.status_code == 404:
+                print(f'Repo not found: {repo}')
+                return None
+
+            print(f'Error: {repo}, status code: {res.status_code}')
+
+        return None
+
+    def fetch_many(self, repos: List[str], refresh: bool = False) -> Dict[str, dict]:
+        '''
+            Fetch repos which are not in store(or all repos if refresh) concurrently.
+            return: {repo: repo info | None}
+        '''
+        todo_repos = [repo for repo in dict.fromkeys(repos)
+                      if refresh or repo not in self.index]
+
+        if len(todo_repos) > 0:
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                list(tqdm(executor.map(self._fetch, todo_repos),
+                     total=len(todo_repos), desc='Fetching repo info'))
+
+            if refresh:
+                self.compact()
+
+        return {repo: self.index.get(repo) for repo in repos}
+
+    def compact(self):
+        '''Rewrite the file with the latest record of each repo.'''
+        with self.file_lock:
+            temp_file_path = self.file_path + '.tmp'
+            with open(temp_file_path, 'w') as f_repo_info:
+                for repo_info in self.index.values():
+                    f_repo_info.write(json.dumps(repo_info) + '\n')
+            os.replace(temp_file_path, self.file_path)
@@ -0,0 +1,108 @@
+import os
+from abc import ABC, abstractmethod
+from typing import Tuple
+
+
+GEN_BACKENDS = ['ie', 'openai', 'local']
+
+
+def build_llama_prompt(system_input_text: str, user_input_text: str) -> str:
+    '''Prompt in the chat format of (Code)Llama instruct models.'''
+    return f"<s>[INST]<<SYS>>\n{system_input_text}\n<</SYS>>\n{user_input_text}\n[/INST]"
+
+
+class GenerationBackend(ABC):
+    '''
+        Interface of text generation used by Summarizer and Retriever.
+        Implementations: IEClient(Inference Endpoints), OpenAIClient(chat completions), LocalBackend(in-process model).
+        Attributes:
+            model_name: str
+            max_number_of_tokens: int, context window = max_input_length + max_output_length
+            max_batch_size: int, number of requests worth sending concurrently
+            limiter: context manager bounding concurrent requests, or None
+            metrics: MetricsRecorder, or None
+    '''
+    model_name = ""
+    max_number_of_tokens = 0
+    max_batch_size = 1
+    limiter = None
+    metrics = None
+
+    # number of tokens added by build_prompt besides the inputs
+    PROMPT_SPECIAL_TOKEN_NUM = 30
+
+    def check_health(self) -> bool:
+        return True
+
+    @abstractmethod
+    def count_tokens(self, text: str) -> int:
+        pass
+
+    @abstractmethod
+    def truncate(self, text: str, max_length: int) -> str:
+        '''Keep the first max_length tokens of text.'''
+        pass
+
+    def build_prompt(self, system_input_text: str, user_input_text: str) -> str:
+        '''Raw prompt passed to generate.'''
+        return build_llama_prompt(system_input_text, user_input_text)
+
+    @abstractmethod
+    def generate(self, input_text: str, max_output_length: int) -> str:
+        '''
+            Complete a raw prompt, e.g. made by build_prompt.
+            raise Exception if error occurs.
+        '''
+        pass
+
+    def chat(self, system_input_text: str, user_input_text: str, max_output_length: int) -> Tuple[int, str]:
+        '''
+            return: (total_tokens, output_text)
+            raise Exception if error occurs.
+        '''
+        input_text = self.build_prompt(system_input_text, user_input_text)
+        output_text = self.generate(input_text, max_output_length)
+
+        return self.count_tokens(input_text) + self.count_tokens(output_text), output_text
+
+    def chat_until(self, system_input_text: str, user_input_text: str, max_output_length: int,
+                   stop_detector) -> Tuple[int, str]:
+        '''
+            Like chat, but generation may stop as soon as stop_detector.feed(piece of output) returns True,
+            e.g. JsonObjectDetector. Backends without streaming generate the whole output.
+            return: (total_tokens, output_text)
+            raise Exception if error occurs.
+        '''
+        total_tokens, output_text = self.chat(
+            system_input_text, user_input_text, max_output_length)
+        stop_detector.reset()
+        stop_detector.feed(output_text)
+
+        return total_tokens, output_text
+
+
+def get_backend_name(role: str, default: str) -> str:
+    '''
+        Backend of a role given by env <ROLE>_BACKEND, e.g. METHOD_BACKEND=local.
+        roles: 'method'(method summarization), 'chat'(file and directory summarization, retrieval)
+    '''
+    name = os.getenv(f"{role.upper()}_BACKEND", default)
+    if name not in GEN_BACKENDS:
+        raise Exception(f"Unknown generation backend: {name}")
+
+    return name
+
+
+def create_backend(name: str) -> GenerationBackend:
+    '''Create a backend configured by .env, raise Exception if its configuration is missing.'''
+    if name == 'ie':
+        from ie_client import IEClient
+        return IEClient()
+    if name == 'openai':
+        from openai_client import OpenAIClient
+        return OpenAIClient()
+    if name == 'local':
+        from local_backend import LocalBackend
+        return LocalBackend()
+
+    raise Exception(f"Unknown generation backend: {name}")
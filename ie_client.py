@@ -1,11 +1,17 @@
 import os
 import random
+import time
+from contextlib import nullcontext
 from time import sleep
-import requests
 from dotenv import load_dotenv
 
+from cassette import CassetteMissError, get_http_client
+from generation_backend import GenerationBackend
+
+
+class IEClient(GenerationBackend):
+    '''Model served by Hugging Face Inference Endpoints(text-generation-inference API).'''
 
-class IEClient:
     def __init__(self):
         token = os.getenv('IE_TOKEN')
         url = os.getenv('IE_URL')
@@ -27,43 +33,93 @@ class IEClient:
         else:
             self.max_batch_size = 1
 
+        # context manager bounding concurrent requests, e.g. shared by worker processes
+        self.limiter = None
+        # MetricsRecorder, a record is made for each call of generate
+        self.metrics = None
+        # range of seconds waited before retrying a failed request
+        self.retry_wait_range = (5, 15)
+        # requests module, or a session replaying recorded responses, see cassette.py
+        self.http = get_http_client()
+
+        self._tokenizer = None
+
+    @property
+    def tokenizer(self):
+        '''tokenizer of the served model, loaded on first use'''
+        if self._tokenizer == None:
+            from transformers import AutoTokenizer
+            self._tokenizer = AutoTokenizer.from_pretrained(self.model_name)
+        return self._tokenizer
+
+    def count_tokens(self, text: str) -> int:
+        return len(self.tokenizer.encode(
+            text, add_special_tokens=False, padding=False, truncation=False))
+
+    def truncate(self, text: str, max_length: int) -> str:
+        encoded = self.tokenizer.encode(
+            text, add_special_tokens=False, padding=False, truncation=True, max_length=max_length)
+        return self.tokenizer.decode(encoded, skip_special_tokens=False)
+
     def check_health(self) -> bool:
-        res = requests.get(self.url + '/health')
+        res = self.http.get(self.url + '/health')
         return res.status_code == 200
 
     def generate(self, input_text: str, max_output_length: int) -> str:
         '''raise Exception if error occurs.'''
         error_msg = ""
-        for _ in range(5):
+        queue_wait = 0.0
+        for retries in range(5):
             try:
-                res = requests.post(self.url,
-                                    timeout=20,
-                                    headers={
-                                        "Authorization": f"Bearer {self.token}",
-                                        "Content-Type": "application/json"
-                                    },
-                                    json={
-                                        "inputs": input_text,
-                                        "parameters": {
-                                            "max_new_tokens": max_output_length,
-                                            "do_sample": True,
-                                            "temperature": 0.2,
-                                            "top_p": 0.9,
-                                            "num_return_sequences": 1
-                                        }
-                                    })
+                wait_start_time = time.time()
+                with self.limiter if self.limiter != None else nullcontext():
+                    request_start_time = time.time()
+                    queue_wait += request_start_time - wait_start_time
+                    res = self.http.post(self.url,
+                                         timeout=20,
+                                         headers={
+                                             "Authorization": f"Bearer {self.token}",
+                                             "Content-Type": "application/json"
+                                         },
+                                         json={
+                                             "inputs": input_text,
+                                             "parameters": {
+                                                 "max_new_tokens": max_output_length,
+                                                 "do_sample": True,
+                                                 "temperature": 0.2,
+                                                 "top_p": 0.9,
+                                                 "num_return_sequences": 1,
+                                                 "details": True
+                                             }
+                                         })
+                    latency = time.time() - request_start_time
 
                 # if request failed, retry
                 if res.status_code != 200 or len(res.json()) == 0:
                     raise Exception(res.json())
 
-                return res.json()[0]['generated_text']
+                output_text = res.json()[0]['generated_text']
+                if self.metrics != None:
+                    details = res.json()[0].get('details') or {}
+                    self.metrics.record('ie_generate', status='ok', queue_wait=queue_wait, latency=latency,
+                                        retries=retries, prompt_tokens=self.count_tokens(input_text),
+                                        completion_tokens=details.get('generated_tokens', 0))
+
+                return output_text
+            except CassetteMissError as e:
+                # a response that was not recorded is not found by retrying
+                error_msg = e
+                break
             except Exception as e:
                 error_msg = e
                 # wait random time to reduce pressure on server
-                sleep(random.randint(5, 15))
+                sleep(random.uniform(*self.retry_wait_range))
                 continue
 
+        if self.metrics != None:
+            self.metrics.record('ie_generate', status='error',
+                                queue_wait=queue_wait, retries=5)
+
         raise Exception(error_msg)
 
 
@@ -9,6 +9,7 @@ import com.summarizer.pojo.*;
 
 import java.io.File;
 import java.util.*;
+import java.util.function.Consumer;
 
 public class JavaRepoParser {
     private ParserConfiguration.LanguageLevel languageLevel;
@@ -18,16 +19,42 @@ public class JavaRepoParser {
     private int maxSubDirAndFileCount = 0; // max number of subdirectories and files in a directory
     private int totalDirCount = 0; // total number of directories
     private int totalFileCount = 0; // total number of files
+    private Consumer<Map<String, Object>> recordConsumer = null; // receives records of files and directories as they are parsed
+
     public JavaRepoParser(ParserConfiguration.LanguageLevel languageLevel) {
         this.languageLevel = languageLevel;
     }
 
+    public void setRecordConsumer(Consumer<Map<String, Object>> recordConsumer) {
+        this.recordConsumer = recordConsumer;
+    }
+
+    private void emitRecord(String type, Map<String, Object> fields) {
+        if (recordConsumer == null)
+            return;
+
+        Map<String, Object> record = new LinkedHashMap<>();
+        record.put("type", type);
+        record.putAll(fields);
+        recordConsumer.accept(record);
+    }
+
     public JRepo extractRepo(File dir) throws Exception {
         if (!dir.isDirectory())
             throw new IllegalArgumentException("param is not a directory");
 
         JDirectory jDirectory = extractDirectory(dir, dir.getName());
 
+        // children are emitted before their parents, the repo record is the last one
+        Map<String, Object> fields = new LinkedHashMap<>();
+        fields.put("mainDirectory", jDirectory == null ? null : jDirectory.getId());
+        fields.put("nodeCount", nodeCount);
+        fields.put("maxSubDirCount", maxSubDirCount);
+        fields.put("maxFileCount", maxFileCount);
+        fields.put("maxSubDirAndFileCount", maxSubDirAndFileCount);
+        fields.put("totalDirCount", totalDirCount);
+        fields.put("totalFileCount", totalFileCount);
+        emitRecord("repo", fields);
 
         return new JRepo(
                 jDirectory,
@@ -81,12 +108,22 @@ public class JavaRepoParser {
         maxSubDirCount = Math.max(maxSubDirCount, subJDirectories.size());
         maxFileCount = Math.max(maxFileCount, jFiles.size());
         maxSubDirAndFileCount = Math.max(maxSubDirAndFileCount, subJDirectories.size() + jFiles.size());
-        return new JDirectory(
+        JDirectory jDirectory = new JDirectory(
                 nodeCount,
                 dirName,
                 jFiles,
                 subJDirectories
         );
+
+        // files and subdirectories were emitted before, they are referred to by id
+        Map<String, Object> fields = new LinkedHashMap<>();
+        fields.put("id", jDirectory.getId());
+        fields.put("name", jDirectory.getName());
+        fields.put("files", jFiles.stream().map(JFile::getId).toList());
+        fields.put("subdirectories", subJDirectories.stream().map(JDirectory::getId).toList());
+        emitRecord("directory", fields);
+
+        return jDirectory;
     }
 
     public JFile extractFile(File file) {
@@ -149,12 +186,21 @@ public class JavaRepoParser {
             return null;
 
         nodeCount++;
-        return new JFile(
+        JFile jFile = new JFile(
                 nodeCount,
                 file.getName(),
                 jClassContainer.signature,
                 jClassContainer.methods
         );
+
+        Map<String, Object> fields = new LinkedHashMap<>();
+        fields.put("id", jFile.getId());
+        fields.put("name", jFile.getName());
+        fields.put("signature", jFile.getSignature());
+        fields.put("methods", jFile.getMethods());
+        emitRecord("file", fields);
+
+        return jFile;
     }
 
     public List<JMethod> extractMethods(TypeDeclaration td) {
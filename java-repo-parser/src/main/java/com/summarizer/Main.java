@@ -9,8 +9,11 @@ import picocli.CommandLine;
 import picocli.CommandLine.Command;
 import picocli.CommandLine.Option;
 
+import java.io.BufferedWriter;
 import java.io.File;
 import java.io.FileWriter;
+import java.io.IOException;
+import java.io.UncheckedIOException;
 
 @Command(name = "JavaRepoParser", mixinStandardHelpOptions = true, version = "JavaRepoParser 1.0")
 public class Main implements Runnable {
@@ -20,6 +23,8 @@ public class Main implements Runnable {
     private String outputPath = "./parse_output.json";
     @Option(names = {"-v", "--lang-version"}, description = "Version of the Java language", defaultValue = "17")
     private String langVersion = "17";
+    @Option(names = {"-s", "--stream"}, description = "Write one JSON record per line as files and directories are parsed")
+    private boolean stream = false;
 
     public static void main(String[] args) {
         int exitCode = new CommandLine(new Main()).execute(args);
@@ -38,6 +43,11 @@ public class Main implements Runnable {
 
         JavaRepoParser parser = new JavaRepoParser(getLanguageLevel());
 
+        if (stream) {
+            runStream(parser, dir);
+            return;
+        }
+
         // parse and write result
         try {
             JRepo jRepo = parser.extractRepo(dir);
@@ -55,6 +65,25 @@ public class Main implements Runnable {
         }
     }
 
+    // records are flushed one by one, so a reader of the output can start before parsing ends
+    private void runStream(JavaRepoParser parser, File dir) {
+        try (BufferedWriter bw = new BufferedWriter(new FileWriter(outputPath))) {
+            parser.setRecordConsumer(record -> {
+                try {
+                    bw.write(JSON.toJSONString(record));
+                    bw.write("\n");
+                    bw.flush();
+                } catch (IOException e) {
+                    throw new UncheckedIOException(e);
+                }
+            });
+            parser.extractRepo(dir);
+        } catch (Exception e) {
+            e.printStackTrace();
+            System.exit(1);
+        }
+    }
+
     public ParserConfiguration.LanguageLevel getLanguageLevel() {
         return switch (langVersion) {
             case "1.0" -> ParserConfiguration.LanguageLevel.JAVA_1_0;
@@ -0,0 +1,63 @@
+import json
+
+
+class JsonObjectDetector:
+    '''
+        Find the first complete JSON object in text given piece by piece, e.g. a streamed completion,
+        so that generation can stop as soon as the answer is parsed.
+        Usage:
+            detector.reset()
+            for piece in stream:
+                if detector.feed(piece): break
+            detector.obj  # parsed object, None if not found
+    '''
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.text = ""
+        self.obj = None
+        self.pos = 0  # next position to scan
+        self.start = -1  # position of '{' opening the current object
+        self.depth = 0
+        self.in_string = False
+        self.escaped = False
+
+    def feed(self, piece: str) -> bool:
+        '''return: True if a JSON object is complete.'''
+        if self.obj != None:
+            return True
+
+        self.text += piece
+        while self.pos < len(self.text):
+            c = self.text[self.pos]
+            self.pos += 1
+
+            # quotes are only tracked inside an object, text around it is free-form
+            if self.in_string:
+                if self.escaped:
+                    self.escaped = False
+                elif c == '\\':
+                    self.escaped = True
+                elif c == '"':
+                    self.in_string = False
+            elif c == '"' and self.depth > 0:
+                self.in_string = True
+            elif c == '{':
+                if self.depth == 0:
+                    self.start = self.pos - 1
+                self.depth += 1
+            elif c == '}' and self.depth > 0:
+                self.depth -= 1
+                if self.depth == 0:
+                    try:
+                        obj = json.loads(self.text[self.start:self.pos])
+                    except ValueError:
+                        # not JSON, e.g. braces of code, look for the next object
+                        continue
+                    if isinstance(obj, dict):
+                        self.obj = obj
+                        return True
+
+        return False
@@ -0,0 +1,190 @@
+import math
+import re
+import time
+from collections import Counter
+from typing import Dict, List
+
+from constants import NO_SUMMARY
+
+
+STOP_WORDS = set([
+    'a', 'an', 'the', 'of', 'to', 'in', 'on', 'for', 'and', 'or', 'is', 'are', 'be', 'by', 'with',
+    'as', 'at', 'it', 'this', 'that', 'from', 'if', 'not', 'no', 'all', 'any', 'its', 'into', 'java',
+])
+
+WORD_PATTERN = re.compile(r'[A-Za-z][A-Za-z0-9]*')
+CAMEL_PATTERN = re.compile(r'[A-Z]+(?=[A-Z][a-z])|[A-Z]?[a-z]+|[A-Z]+|[0-9]+')
+
+
+def tokenize(text: str) -> List[str]:
+    '''
+        Split text into lowercase terms.
+        Identifiers are kept as a whole and also split by camel case, e.g. parseList -> parselist, parse, list.
+    '''
+    terms = []
+    for word in WORD_PATTERN.findall(text):
+        lower_word = word.lower()
+        if lower_word not in STOP_WORDS:
+            terms.append(lower_word)
+
+        parts = CAMEL_PATTERN.findall(word)
+        if len(parts) > 1:
+            for part in parts:
+                lower_part = part.lower()
+                if len(lower_part) > 1 and lower_part not in STOP_WORDS:
+                    terms.append(lower_part)
+
+    return terms
+
+
+class LexicalIndex:
+    '''
+        BM25 inverted index over nodes of a summary tree.
+        Method document: name + signature + summary.
+        File document: name + summary + names and signatures of its methods.
+        Directory document: name + summary + names of all files and methods below it.
+    '''
+
+    def __init__(self, repo_sum_obj: dict, k1: float = 1.2, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+
+        self.postings: Dict[str, Dict[int, int]] = {}  # term -> {node id -> tf}
+        self.doc_lens: Dict[int, int] = {}  # node id -> number of terms
+
+        self._index_dir(repo_sum_obj)
+
+        doc_count = len(self.doc_lens)
+        self.avg_doc_len = sum(self.doc_lens.values()) / max(doc_count, 1)
+        self.idfs = {
+            term: math.log(1 + (doc_count - len(posting) + 0.5) / (len(posting) + 0.5))
+            for term, posting in self.postings.items()
+        }
+
+    def _add_doc(self, node_id: int, terms: List[str]):
+        self.doc_lens[node_id] = len(terms)
+        for term, tf in Counter(terms).items():
+            self.postings.setdefault(term, {})[node_id] = tf
+
+    def _summary_terms(self, sum_obj: dict) -> List[str]:
+        if sum_obj['summary'] == NO_SUMMARY:
+            return []
+        return tokenize(sum_obj['summary'])
+
+    def _index_file(self, file_sum_obj: dict) -> List[str]:
+        '''return: identifier terms of the file, used by its ancestors'''
+        class_terms = tokenize(file_sum_obj['name'].split('.')[0])
+        identifier_terms = list(class_terms)
+        signature_terms = []
+
+        for method_sum_obj in file_sum_obj['methods']:
+            method_identifier_terms = tokenize(method_sum_obj['name'])
+            method_signature_terms = tokenize(method_sum_obj['signature'])
+            self._add_doc(method_sum_obj['id'],
+                          method_identifier_terms + method_signature_terms +
+                          self._summary_terms(method_sum_obj))
+
+            identifier_terms.extend(method_identifier_terms)
+            signature_terms.extend(method_signature_terms)
+
+        self._add_doc(file_sum_obj['id'],
+                      class_terms + signature_terms + self._summary_terms(file_sum_obj))
+
+        return identifier_terms
+
+    def _index_dir(self, dir_sum_obj: dict) -> List[str]:
+        '''return: identifier terms of the directory, used by its ancestors'''
+        identifier_terms = tokenize(dir_sum_obj['name'])
+
+        for sub_dir_sum_obj in dir_sum_obj['subdirectories']:
+            identifier_terms.extend(self._index_dir(sub_dir_sum_obj))
+        for file_sum_obj in dir_sum_obj['files']:
+            identifier_terms.extend(self._index_file(file_sum_obj))
+
+        self._add_doc(dir_sum_obj['id'],
+                      identifier_terms + self._summary_terms(dir_sum_obj))
+
+        return identifier_terms
+
+    def calc_scores(self, query: str, node_ids: List[int]) -> List[float]:
+        '''BM25 scores of query against the given nodes, divided by the max score among them.'''
+        if len(node_ids) == 0:
+            return []
+
+        query_terms = set(tokenize(query))
+        scores = []
+        for node_id in node_ids:
+            doc_len = self.doc_lens.get(node_id, 0)
+            norm = self.k1 * (1 - self.b + self.b * doc_len / self.avg_doc_len)
+
+            score = 0.0
+            for term in query_terms:
+                tf = self.postings.get(term, {}).get(node_id, 0)
+                if tf != 0:
+                    score += self.idfs[term] * tf * (self.k1 + 1) / (tf + norm)
+            scores.append(score)
+
+        max_score = max(scores)
+        if max_score == 0:
+            return [0.0] * len(scores)
+
+        return [score / max_score for score in scores]
+
+
+def fuse_similarities(similarities: List[float], lexical_scores: List[float], lexical_weight: float) -> List[float]:
+    '''Linear fusion of embedding similarities and normalized lexical scores.'''
+    return [round((1 - lexical_weight) * sim + lexical_weight * score, 3)
+            for sim, score in zip(similarities, lexical_scores)]
+
+
+def calc_hybrid_similarities(text_sim_calculator, lexical_index: LexicalIndex, lexical_weight: float,
+                             query: str, infos: List[dict]) -> List[float]:
+    '''
+        Similarities between query and infos({id: int, summary: str, embedding: List[float] | None}).
+        An info with an embedding, e.g. of an extractive directory summary, is compared by it instead of its summary.
+        Embedding similarities of summaries are fused with lexical scores if lexical_index is given.
+    '''
+    similarities = text_sim_calculator.calc_similarities(
+        query, [info['summary'] for info in infos], [info.get('embedding') for info in infos])
+
+    if lexical_index == None or lexical_weight == 0:
+        return similarities
+
+    lexical_scores = lexical_index.calc_scores(
+        query, [info['id'] for info in infos])
+
+    return fuse_similarities(similarities, lexical_scores, lexical_weight)
+
+
+class HybridSimilarityMixin:
+    '''
+        Ranking of retrievers by hybrid similarity, shared by Retriever and SimRetriever.
+        The retriever sets text_sim_calculator and query, calls _init_lexical_index in __init__
+        and resets embedding_time(seconds spent in similarity) for each query.
+    '''
+
+    def _init_lexical_index(self, lexical_weight: float):
+        self.lexical_weight = lexical_weight
+        self.lexical_index = None
+        self.indexed_repo_sum_obj = None  # repo which lexical_index is built for
+        self.embedding_time = 0.0
+
+    def _load_lexical_index(self, repo_sum_obj: dict):
+        '''Build lexical index for the repo, reuse it if the repo is the same as last time.'''
+        if self.lexical_weight == 0:
+            return
+
+        if self.indexed_repo_sum_obj is not repo_sum_obj:
+            self.lexical_index = LexicalIndex(repo_sum_obj)
+            self.indexed_repo_sum_obj = repo_sum_obj
+
+    def _sort_by_similarity(self, infos: List[dict]):
+        '''Calculate similarity between query and infos, and sort infos according to similarity.'''
+        start_time = time.time()
+        similarities = calc_hybrid_similarities(
+            self.text_sim_calculator, self.lexical_index, self.lexical_weight, self.query, infos)
+        self.embedding_time += time.time() - start_time
+
+        for i, info in enumerate(infos):
+            info['similarity'] = similarities[i]
+        infos.sort(key=lambda x: x['similarity'], reverse=True)
@@ -0,0 +1,206 @@
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from contextlib import nullcontext
+from typing import List
+import torch
+from dotenv import load_dotenv
+from transformers import AutoModelForCausalLM, AutoTokenizer
+
+from generation_backend import GenerationBackend, build_llama_prompt
+
+
+class _GenerationRequest:
+    __slots__ = ('input_ids', 'max_output_length', 'future')
+
+    def __init__(self, input_ids: List[int], max_output_length: int):
+        self.input_ids = input_ids
+        self.max_output_length = max_output_length
+        self.future = Future()
+
+
+class LocalBackend(GenerationBackend):
+    '''
+        Hugging Face causal LM running in this process on CPU, no network is needed.
+        Concurrent calls of generate are collected by a worker thread and decoded as one batch:
+        prompts are left-padded with an attention mask, and the KV cache is reused across decoding steps.
+        Configured by .env: LOCAL_MODEL_NAME, LOCAL_MAX_NUMBER_OF_TOKENS, LOCAL_MAX_BATCH_SIZE(default 4),
+        LOCAL_BATCH_WAIT(seconds to wait for a batch to fill, default 0.02), LOCAL_THREADS(default: torch default)
+    '''
+
+    def __init__(self):
+        model_name = os.getenv('LOCAL_MODEL_NAME')
+        max_number_of_tokens = os.getenv('LOCAL_MAX_NUMBER_OF_TOKENS')
+        if model_name == None or max_number_of_tokens == None:
+            raise Exception("Cannot get value in .env file.")
+
+        self.model_name = model_name
+        # = context window = max_input_length + max_output_length
+        self.max_number_of_tokens = int(max_number_of_tokens)
+        # = number of requests decoded in one batch
+        self.max_batch_size = int(os.getenv('LOCAL_MAX_BATCH_SIZE', '4'))
+        self.batch_wait = float(os.getenv('LOCAL_BATCH_WAIT', '0.02'))
+        if os.getenv('LOCAL_THREADS') != None:
+            torch.set_num_threads(int(os.getenv('LOCAL_THREADS')))
+
+        # context manager bounding concurrent requests, e.g. shared by worker processes
+        self.limiter = None
+        # MetricsRecorder, a record is made for each call of generate
+        self.metrics = None
+
+        self.tokenizer = AutoTokenizer.from_pretrained(model_name)
+        # batched prompts are aligned at their ends, so generation starts at the same position
+        self.tokenizer.padding_side = 'left'
+        if self.tokenizer.pad_token == None:
+            self.tokenizer.pad_token = self.tokenizer.eos_token
+        self.model = AutoModelForCausalLM.from_pretrained(
+            model_name, torch_dtype=torch.float32)
+        self.model.eval()
+
+        self.batch_count = 0  # number of model.generate calls
+        self.batched_request_count = 0  # number of requests decoded in those calls
+
+        self.queue = queue.Queue()
+        self.worker = threading.Thread(target=self._run_worker, daemon=True)
+        self.worker.start()
+
+    def check_health(self) -> bool:
+        return self.worker.is_alive()
+
+    def count_tokens(self, text: str) -> int:
+        return len(self.tokenizer.encode(
+            text, add_special_tokens=False, padding=False, truncation=False))
+
+    def truncate(self, text: str, max_length: int) -> str:
+        encoded = self.tokenizer.encode(
+            text, add_special_tokens=False, padding=False, truncation=True, max_length=max_length)
+        return self.tokenizer.decode(encoded, skip_special_tokens=False)
+
+    def build_prompt(self, system_input_text: str, user_input_text: str) -> str:
+        '''Prompt in the chat template of the model, the format of CodeLlama if it has none.'''
+        if getattr(self.tokenizer, 'chat_template', None) == None:
+            return build_llama_prompt(system_input_text, user_input_text)
+
+        messages = [{'role': 'user', 'content': user_input_text}]
+        if system_input_text != "":
+            messages.insert(
+                0, {'role': 'system', 'content': system_input_text})
+
+        return self.tokenizer.apply_chat_template(
+            messages, tokenize=False, add_generation_prompt=True)
+
+    def generate(self, input_text: str, max_output_length: int) -> str:
+        '''raise Exception if error occurs.'''
+        # special tokens are part of the prompt made by build_prompt
+        input_ids = self.tokenizer.encode(
+            input_text, add_special_tokens=False, padding=False, truncation=False)
+        max_input_length = self.max_number_of_tokens - max_output_length
+        if len(input_ids) > max_input_length:
+            raise Exception(
+                f"Input length {len(input_ids)} exceeds the limit {max_input_length}.")
+
+        wait_start_time = time.time()
+        with self.limiter if self.limiter != None else nullcontext():
+            request = _GenerationRequest(input_ids, max_output_length)
+            self.queue.put(request)
+            try:
+                output_ids, batch_start_time = request.future.result()
+            except Exception as e:
+                if self.metrics != None:
+                    self.metrics.record('local_generate', status='error',
+                                        queue_wait=time.time() - wait_start_time)
+                raise e
+
+        if self.metrics != None:
+            self.metrics.record('local_generate', status='ok', queue_wait=batch_start_time - wait_start_time,
+                                latency=time.time() - batch_start_time, prompt_tokens=len(input_ids),
+                                completion_tokens=len(output_ids))
+
+        return self.tokenizer.decode(output_ids, skip_special_tokens=True)
+
+    def _collect_batch(self, first_request: _GenerationRequest) -> List[_GenerationRequest]:
+        '''Add requests arriving within batch_wait to the batch, up to max_batch_size.'''
+        requests = [first_request]
+        deadline = time.time() + self.batch_wait
+        while len(requests) < self.max_batch_size:
+            timeout = deadline - time.time()
+            try:
+                request = self.queue.get(timeout=timeout) if timeout > 0 \
+                    else self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if request == None:
+                self.queue.put(None)  # keep the stop signal for the worker loop
+                break
+            requests.append(request)
+
+        return requests
+
+    @torch.inference_mode()
+    def _generate_batch(self, requests: List[_GenerationRequest]) -> List[List[int]]:
+        '''Decode requests as one batch, return: generated token ids of each request.'''
+        batch = self.tokenizer.pad(
+            {'input_ids': [x.input_ids for x in requests]},
+            padding='longest', return_tensors="pt")
+        input_length = batch['input_ids'].shape[1]
+
+        outputs = self.model.generate(
+            input_ids=batch['input_ids'],
+            attention_mask=batch['attention_mask'],
+            max_new_tokens=max(x.max_output_length for x in requests),
+            do_sample=True,
+            temperature=0.2,
+            top_p=0.9,
+            use_cache=True,
+            pad_token_id=self.tokenizer.pad_token_id,
+        )
+
+        output_ids_list = []
+        for request, output in zip(requests, outputs):
+            output_ids = output[input_length:][:request.max_output_length].tolist()
+            # finished sequences are padded until the longest one ends
+            if self.tokenizer.eos_token_id in output_ids:
+                output_ids = output_ids[:output_ids.index(
+                    self.tokenizer.eos_token_id)]
+            output_ids_list.append(output_ids)
+
+        return output_ids_list
+
+    def _run_worker(self):
+        while True:
+            request = self.queue.get()
+            if request == None:
+                break
+
+            requests = self._collect_batch(request)
+            batch_start_time = time.time()
+            try:
+                output_ids_list = self._generate_batch(requests)
+                self.batch_count += 1
+                self.batched_request_count += len(requests)
+                for request, output_ids in zip(requests, output_ids_list):
+                    request.future.set_result((output_ids, batch_start_time))
+            except Exception as e:
+                for request in requests:
+                    request.future.set_exception(e)
+
+    def close(self):
+        '''Stop the worker after queued requests are done.'''
+        self.queue.put(None)
+        self.worker.join()
+
+
+if __name__ == '__main__':
+    load_dotenv()
+
+    try:
+        local_backend = LocalBackend()
+        prompt = local_backend.build_prompt(
+            "Summarize the method in one sentence.", "int add(int a, int b) { return a + b; }")
+        print(local_backend.generate(prompt, 32))
+        local_backend.close()
+    except Exception as e:
+        print(e)
+        exit(1)
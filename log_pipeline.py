@@ -0,0 +1,209 @@
+import gzip
+import hashlib
+import json
+import logging
+import os
+import queue
+import sys
+from logging.handlers import QueueHandler, QueueListener
+
+from constants import LOG_SEPARATOR
+
+
+LOG_VERBOSITIES = ['full', 'metadata']
+# fields holding prompts, stored once per content hash
+PROMPT_FIELDS = ['system_input', 'user_input', 'input']
+# fields holding long texts, dropped when verbosity is metadata
+TEXT_FIELDS = PROMPT_FIELDS + ['output', 'truncated_input', 'ignored']
+
+
+def get_log_verbosity(verbosity: str = None) -> str:
+    '''Verbosity given by argument, or by env LOG_VERBOSITY, default: full'''
+    if verbosity == None:
+        verbosity = os.getenv('LOG_VERBOSITY', 'full')
+    if verbosity not in LOG_VERBOSITIES:
+        raise Exception(f"Unknown log verbosity: {verbosity}")
+
+    return verbosity
+
+
+def get_text_hash(text: str) -> str:
+    return hashlib.sha1(text.encode()).hexdigest()[:16]
+
+
+class LogEvent:
+    '''
+        Log message whose fields are kept as they are, it is only rendered when written.
+        Usage: logger.info(LogEvent("METHOD", node_id=1, input=input_text, output=summary))
+    '''
+    __slots__ = ('event', 'fields')
+
+    def __init__(self, event: str, **fields):
+        self.event = event
+        self.fields = fields
+
+    def __str__(self) -> str:
+        lines = [f"{self.event}{LOG_SEPARATOR}"]
+        for key, value in self.fields.items():
+            title = key.replace('_', ' ').capitalize()
+            if key in TEXT_FIELDS:
+                lines.append(f"{title}:\n{value}")
+            else:
+                lines.append(f"{title}: {value}")
+
+        return "\n".join(lines)
+
+
+class LazyQueueHandler(QueueHandler):
+    '''Put records into the queue as they are, formatting is left to the listener thread.'''
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+class CompressedJsonlHandler(logging.Handler):
+    '''
+        Write records as gzip-compressed JSON lines:
+        {type: 'prompt', hash, text}: written the first time a prompt is seen
+        {type: 'event', event, level, time, context, ...fields}: prompt fields are replaced by their hash
+        {type: 'log', level, time, context, message}: plain messages
+        With metadata verbosity, texts are replaced by their length and no prompt is written.
+    '''
+
+    def __init__(self, file_path: str, verbosity: str = None, mode: str = "w"):
+        super().__init__()
+        self.verbosity = get_log_verbosity(verbosity)
+        # appending adds a gzip member, concatenated members are read as one file
+        self.f_log = gzip.open(file_path, f"{mode}t", encoding="utf-8")
+        self.prompt_hashes = set()
+
+    def _write(self, obj: dict):
+        self.f_log.write(json.dumps(obj, default=str) + '\n')
+
+    def _convert_fields(self, fields: dict) -> dict:
+        converted = {}
+        for key, value in fields.items():
+            if key not in TEXT_FIELDS:
+                converted[key] = value
+                continue
+
+            text = value if isinstance(value, str) else str(value)
+            if self.verbosity == 'metadata':
+                converted[f"{key}_length"] = len(text)
+            elif key in PROMPT_FIELDS:
+                text_hash = get_text_hash(text)
+                if text_hash not in self.prompt_hashes:
+                    self.prompt_hashes.add(text_hash)
+                    self._write(
+                        {'type': 'prompt', 'hash': text_hash, 'text': text})
+                converted[f"{key}_hash"] = text_hash
+            else:
+                converted[key] = text
+
+        return converted
+
+    def emit(self, record: logging.LogRecord):
+        try:
+            obj = {
+                'level': record.levelname,
+                'time': round(record.created, 3),
+            }
+            if hasattr(record, 'context'):
+                obj['context'] = record.context
+
+            if isinstance(record.msg, LogEvent):
+                obj['type'] = 'event'
+                obj['event'] = record.msg.event
+                obj.update(self._convert_fields(record.msg.fields))
+            else:
+                obj['type'] = 'log'
+                obj['message'] = record.getMessage()
+
+            self._write(obj)
+        except Exception:
+            self.handleError(record)
+
+    def close(self):
+        self.acquire()
+        try:
+            if self.f_log != None:
+                self.f_log.close()
+                self.f_log = None
+        finally:
+            self.release()
+        super().close()
+
+
+class AsyncLogPipeline:
+    '''
+        Logger whose records are written by a background thread, so logging does not block request dispatch.
+        Usage:
+            with AsyncLogPipeline(name, "sum_log.jsonl.gz") as log_pipeline:
+                log_pipeline.logger.info(LogEvent(...))
+    '''
+
+    def __init__(self, name: str, file_path: str, verbosity: str = None, mode: str = "w"):
+        self.queue = queue.SimpleQueue()
+        self.file_handler = CompressedJsonlHandler(file_path, verbosity, mode)
+        self.queue_handler = LazyQueueHandler(self.queue)
+
+        self.logger = logging.getLogger(name)
+        self.logger.setLevel(logging.INFO)
+        self.logger.addHandler(self.queue_handler)
+        self.logger.propagate = False  # prevent printing to console
+
+        self.listener = QueueListener(self.queue, self.file_handler)
+        self.listener.start()
+
+    def close(self):
+        '''Write remaining records and close the file.'''
+        if self.listener == None:
+            return
+
+        self.logger.removeHandler(self.queue_handler)
+        self.listener.stop()
+        self.listener = None
+        self.file_handler.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+
+def read_log(file_path: str):
+    '''Yield event and log records with prompts resolved from their hash.'''
+    prompts = {}
+    with gzip.open(file_path, "rt", encoding="utf-8") as f_log:
+        for line in f_log:
+            obj = json.loads(line)
+            if obj['type'] == 'prompt':
+                prompts[obj['hash']] = obj['text']
+                continue
+
+            for key in PROMPT_FIELDS:
+                if f"{key}_hash" in obj:
+                    obj[key] = prompts.get(obj.pop(f"{key}_hash"))
+            yield obj
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2:
+        print("Usage: python log_pipeline.py <log_file_path>")
+        exit(1)
+
+    # print the log in a readable form
+    for obj in read_log(sys.argv[1]):
+        header = f"{obj['time']} - {obj['level']}"
+        if 'context' in obj:
+            header += f" - {obj['context']}"
+        print(header)
+
+        if obj['type'] == 'log':
+            print(obj['message'])
+        else:
+            fields = {key: value for key, value in obj.items()
+                      if key not in ('type', 'event', 'level', 'time', 'context')}
+            print(LogEvent(obj['event'], **fields))
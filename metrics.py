@@ -0,0 +1,144 @@
+import json
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, List, Tuple
+
+
+# histogram buckets of fields, fields not listed here are only kept in records
+SECONDS_BUCKETS = [0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, 20, 40, 80]
+TOKENS_BUCKETS = [16, 32, 64, 128, 256, 512, 1024, 2048, 4096, 8192]
+HISTOGRAM_FIELDS = {
+    'queue_wait': ('seconds', SECONDS_BUCKETS),
+    'latency': ('seconds', SECONDS_BUCKETS),
+    'first_token_latency': ('seconds', SECONDS_BUCKETS),
+    'prompt_tokens': ('tokens', TOKENS_BUCKETS),
+    'completion_tokens': ('tokens', TOKENS_BUCKETS),
+}
+# fields summed as counters
+COUNTER_FIELDS = ['retries', 'truncated', 'collapsed', 'early_stopped']
+
+# labels of the current thread, e.g. node id, attached to every record
+_local = threading.local()
+
+
+@contextmanager
+def metrics_context(**labels):
+    '''Attach labels to records made by this thread inside the block.'''
+    if not hasattr(_local, 'stack'):
+        _local.stack = []
+    _local.stack.append(labels)
+    try:
+        yield
+    finally:
+        _local.stack.pop()
+
+
+def get_context() -> dict:
+    context = {}
+    for labels in getattr(_local, 'stack', []):
+        context.update(labels)
+    return context
+
+
+class Histogram:
+    def __init__(self, buckets: List[float]):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        for i, bucket in enumerate(self.buckets):
+            if value <= bucket:
+                self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+
+class MetricsRecorder:
+    '''
+        Record one structured record per call(LLM request, inference, node summarization).
+        Records are appended to a JSONL file as they come, and aggregated into Prometheus-style histograms.
+    '''
+
+    def __init__(self, jsonl_path: str = None, prefix: str = "rcr"):
+        self.jsonl_path = jsonl_path
+        self.prefix = prefix
+        self.lock = threading.Lock()
+
+        self.histograms: Dict[Tuple[str, str, str], Histogram] = {}  # (field, event, status) -> histogram
+        self.counters: Dict[Tuple[str, str, str], float] = {}  # (field, event, status) -> sum
+
+        self.f_jsonl = open(jsonl_path, "a") if jsonl_path != None else None
+
+    def record(self, event: str, **fields):
+        '''Record a call, labels of metrics_context are attached.'''
+        rec = {'event': event, 'time': round(time.time(), 3)}
+        rec.update(get_context())
+        rec.update(fields)
+        status = str(rec.get('status', 'ok'))
+
+        with self.lock:
+            for field, value in fields.items():
+                if not isinstance(value, (int, float)):
+                    continue
+                if field in HISTOGRAM_FIELDS:
+                    key = (field, event, status)
+                    if key not in self.histograms:
+                        self.histograms[key] = Histogram(
+                            HISTOGRAM_FIELDS[field][1])
+                    self.histograms[key].observe(value)
+                elif field in COUNTER_FIELDS:
+                    key = (field, event, status)
+                    self.counters[key] = self.counters.get(key, 0) + value
+
+            if self.f_jsonl != None:
+                self.f_jsonl.write(json.dumps(rec) + '\n')
+                self.f_jsonl.flush()
+
+    def to_prometheus(self) -> str:
+        '''Histograms and counters in Prometheus text exposition format.'''
+        lines = []
+        with self.lock:
+            for field in HISTOGRAM_FIELDS:
+                unit = HISTOGRAM_FIELDS[field][0]
+                name = f"{self.prefix}_{field}_{unit}"
+                keys = sorted(x for x in self.histograms if x[0] == field)
+                if len(keys) == 0:
+                    continue
+
+                lines.append(f"# TYPE {name} histogram")
+                for key in keys:
+                    histogram = self.histograms[key]
+                    labels = f'event="{key[1]}",status="{key[2]}"'
+                    for bucket, count in zip(histogram.buckets, histogram.counts):
+                        lines.append(
+                            f'{name}_bucket{{{labels},le="{bucket}"}} {count}')
+                    lines.append(
+                        f'{name}_bucket{{{labels},le="+Inf"}} {histogram.count}')
+                    lines.append(
+                        f'{name}_sum{{{labels}}} {round(histogram.sum, 6)}')
+                    lines.append(f'{name}_count{{{labels}}} {histogram.count}')
+
+            for field in COUNTER_FIELDS:
+                name = f"{self.prefix}_{field}_total"
+                keys = sorted(x for x in self.counters if x[0] == field)
+                if len(keys) == 0:
+                    continue
+
+                lines.append(f"# TYPE {name} counter")
+                for key in keys:
+                    lines.append(
+                        f'{name}{{event="{key[1]}",status="{key[2]}"}} {self.counters[key]}')
+
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, file_path: str):
+        with open(file_path, "w") as f:
+            f.write(self.to_prometheus())
+
+    def close(self):
+        if self.f_jsonl != None:
+            self.f_jsonl.close()
+            self.f_jsonl = None
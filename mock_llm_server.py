@@ -0,0 +1,304 @@
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Tuple
+
+from constants import EXP_QUERY, RET_DIR_SYSTEM_PROMPT, RET_FILE_SYSTEM_PROMPT
+
+
+class EndpointProfile:
+    '''
+        Behavior of a stand-in endpoint.
+        latency: lognormal distribution with median `latency_median` seconds and shape `latency_sigma`.
+        error_rate: probability that a request fails with 500.
+        max_concurrency: requests beyond it are rejected with 429, 0 means no limit.
+        token_latency: seconds to generate each word of the output after `latency`.
+    '''
+
+    def __init__(self, latency_median: float = 0.5, latency_sigma: float = 0.5,
+                 error_rate: float = 0.0, max_concurrency: int = 0, token_latency: float = 0.0):
+        self.latency_median = latency_median
+        self.latency_sigma = latency_sigma
+        self.error_rate = error_rate
+        self.max_concurrency = max_concurrency
+        self.token_latency = token_latency
+
+
+class EndpointStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.request_count = 0
+        self.error_count = 0  # failed on purpose
+        self.reject_count = 0  # exceeded max_concurrency
+        self.active_count = 0
+        self.peak_active_count = 0
+        self.stream_close_count = 0  # streams closed by the client before the end
+
+    def to_dict(self) -> dict:
+        with self.lock:
+            return {
+                'request_count': self.request_count,
+                'error_count': self.error_count,
+                'reject_count': self.reject_count,
+                'peak_concurrency': self.peak_active_count,
+                'stream_close_count': self.stream_close_count,
+            }
+
+
+def _make_summary(input_text: str, max_output_length: int) -> str:
+    '''A plausible summary made of identifiers in the input, about max_output_length * 0.75 words.'''
+    words = re.findall(r'[A-Za-z][A-Za-z0-9]{2,}', input_text)[-200:]
+    word_count = max(int(max_output_length * 0.75), 8)
+    picked = [words[(i * 7) % len(words)] for i in range(word_count - 4)] \
+        if len(words) > 0 else ["code"] * (word_count - 4)
+
+    return "This code handles " + " ".join(picked) + " for callers."
+
+
+def _make_retrieval_output(system_input_text: str, user_input_text: str) -> str:
+    '''
+        Answer the way a reasonable model would: items are listed by similarity,
+        so directories take the first ids, a method is picked if its name is in the description.
+        Inferences are followed by an explanation, as chat models tend to add one.
+    '''
+    if system_input_text == EXP_QUERY['system_prompt']:
+        query = re.search(r'Query: (.*)', user_input_text)
+        query = query.group(1) if query else ""
+        return json.dumps({'expanded_query': f"{query} and returns the result"})
+
+    EXPLANATION = "\nThe choice is based on how closely the summaries of the items match the description, " \
+        "items with shared identifiers and similar behavior are preferred."
+
+    infos = re.findall(r'"id":(-?\d+),"name":"([^"]*)"', user_input_text)
+    if system_input_text == RET_DIR_SYSTEM_PROMPT:
+        return json.dumps({'ids': [int(x[0]) for x in infos[:3]]}) + EXPLANATION
+
+    description = user_input_text.split('\n')[0].lower()
+    for info_id, name in infos:
+        if name.lower() in description:
+            return json.dumps({'id': int(info_id)}) + EXPLANATION
+
+    return json.dumps({'id': -1}) + EXPLANATION
+
+
+class MockLLMServer:
+    '''
+        Local stand-ins for Inference Endpoints(text-generation-inference API) and OpenAI chat completions,
+        used to measure the pipeline without API credit.
+        IE: POST <base_url>/ie, GET <base_url>/ie/health
+        OpenAI: POST <base_url>/v1/chat/completions, streamed as server-sent events if "stream" is set
+        Usage: with MockLLMServer(ie_profile, openai_profile) as server: ...
+    '''
+
+    def __init__(self, ie_profile: EndpointProfile, openai_profile: EndpointProfile,
+                 host: str = "127.0.0.1", port: int = 0, seed: int = 0):
+        self.profiles = {'ie': ie_profile, 'openai': openai_profile}
+        self.stats = {'ie': EndpointStats(), 'openai': EndpointStats()}
+        self.random = random.Random(seed)
+        self.random_lock = threading.Lock()
+
+        self.server = ThreadingHTTPServer((host, port), self._make_handler())
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    @property
+    def ie_url(self) -> str:
+        return f"{self.base_url}/ie"
+
+    @property
+    def openai_url(self) -> str:
+        return f"{self.base_url}/v1/chat/completions"
+
+    def _sample(self, name: str) -> Tuple[float, bool]:
+        '''return: (latency, is_error)'''
+        profile = self.profiles[name]
+        with self.random_lock:
+            latency = self.random.lognormvariate(0, profile.latency_sigma) * profile.latency_median
+            is_error = self.random.random() < profile.error_rate
+
+        return latency, is_error
+
+    def _handle(self, name: str, request_obj: dict, reply: Callable):
+        '''Apply the profile of the endpoint, and answer by reply(status code, response object).'''
+        profile = self.profiles[name]
+        stats = self.stats[name]
+
+        with stats.lock:
+            stats.request_count += 1
+            if profile.max_concurrency > 0 and stats.active_count >= profile.max_concurrency:
+                stats.reject_count += 1
+                reply(429, {'error': 'Model is overloaded'})
+                return
+            stats.active_count += 1
+            stats.peak_active_count = max(
+                stats.peak_active_count, stats.active_count)
+
+        try:
+            latency, is_error = self._sample(name)
+            time.sleep(latency)
+            if is_error:
+                with stats.lock:
+                    stats.error_count += 1
+                reply(500, {'error': 'Injected error'})
+                return
+
+            if name == 'ie':
+                response_obj = self._ie_response(request_obj)
+                output_text = response_obj[0]['generated_text']
+            else:
+                response_obj = self._openai_response(request_obj)
+                output_text = response_obj['choices'][0]['message']['content']
+
+            # streamed tokens are paced while they are written
+            if not request_obj.get('stream'):
+                time.sleep(profile.token_latency * len(output_text.split()))
+            reply(200, response_obj)
+        finally:
+            with stats.lock:
+                stats.active_count -= 1
+
+    def _ie_response(self, request_obj: dict) -> list:
+        max_output_length = request_obj['parameters']['max_new_tokens']
+
+        # packed methods, answer one line for each
+        method_texts = re.split(r'^Method \d+:\n', request_obj['inputs'], flags=re.M)[1:]
+        if len(method_texts) > 0:
+            output_text = "\n".join(
+                f"{idx + 1}: {_make_summary(text, max_output_length // len(method_texts))}"
+                for idx, text in enumerate(method_texts))
+        else:
+            output_text = _make_summary(
+                request_obj['inputs'], max_output_length)
+
+        return [{
+            'generated_text': output_text,
+            'details': {'generated_tokens': len(output_text.split())},
+        }]
+
+    def _openai_response(self, request_obj: dict) -> dict:
+        messages = request_obj['messages']
+        system_input_text = messages[0]['content'] if messages[0]['role'] == 'system' else ""
+        user_input_text = messages[-1]['content']
+
+        if system_input_text in (RET_DIR_SYSTEM_PROMPT, RET_FILE_SYSTEM_PROMPT, EXP_QUERY['system_prompt']):
+            output_text = _make_retrieval_output(
+                system_input_text, user_input_text)
+        else:
+            output_text = _make_summary(
+                user_input_text, request_obj['max_tokens'])
+
+        # rough token count, 4 characters per token
+        prompt_tokens = (len(system_input_text) + len(user_input_text)) // 4
+        completion_tokens = len(output_text) // 4
+        return {
+            'choices': [{'message': {'role': 'assistant', 'content': output_text}}],
+            'usage': {
+                'prompt_tokens': prompt_tokens,
+                'completion_tokens': completion_tokens,
+                'total_tokens': prompt_tokens + completion_tokens,
+            },
+        }
+
+    def _make_handler(self):
+        mock_server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            # chunked transfer encoding lets streamed events reach the client as they are written
+            protocol_version = "HTTP/1.1"
+
+            def _reply(self, status_code: int, obj):
+                body = json.dumps(obj).encode()
+                self.send_response(status_code)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                if self.path == '/ie/health':
+                    self._reply(200, {})
+                else:
+                    self._reply(404, {'error': 'Not found'})
+
+            def _reply_stream(self, response_obj: dict, request_obj: dict):
+                '''Write the completion word by word in the format of OpenAI streaming.'''
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/event-stream')
+                self.send_header('Cache-Control', 'no-cache')
+                self.send_header('Transfer-Encoding', 'chunked')
+                self.send_header('Connection', 'close')
+                self.end_headers()
+
+                def write_chunk(data: bytes):
+                    self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+                    self.wfile.flush()
+
+                def write_event(obj):
+                    write_chunk(f"data: {json.dumps(obj)}\n\n".encode())
+
+                token_latency = mock_server.profiles['openai'].token_latency
+                output_text = response_obj['choices'][0]['message']['content']
+                try:
+                    for piece in re.findall(r'\s*\S+', output_text):
+                        time.sleep(token_latency)
+                        write_event(
+                            {'choices': [{'index': 0, 'delta': {'content': piece}}]})
+                    if (request_obj.get('stream_options') or {}).get('include_usage'):
+                        write_event(
+                            {'choices': [], 'usage': response_obj['usage']})
+                    write_chunk(b"data: [DONE]\n\n")
+                    write_chunk(b"")
+                except (BrokenPipeError, ConnectionResetError):
+                    stats = mock_server.stats['openai']
+                    with stats.lock:
+                        stats.stream_close_count += 1
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length', 0))
+                request_obj = json.loads(self.rfile.read(length))
+
+                def reply(status_code: int, obj):
+                    if status_code == 200 and request_obj.get('stream'):
+                        self._reply_stream(obj, request_obj)
+                    else:
+                        self._reply(status_code, obj)
+
+                if self.path == '/ie':
+                    mock_server._handle('ie', request_obj, reply)
+                elif self.path == '/v1/chat/completions':
+                    mock_server._handle('openai', request_obj, reply)
+                else:
+                    self._reply(404, {'error': 'Not found'})
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def get_stats(self) -> dict:
+        return {name: stats.to_dict() for name, stats in self.stats.items()}
+
+    def start(self):
+        self.thread = threading.Thread(
+            target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+        return False
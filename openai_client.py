@@ -1,33 +1,129 @@
+import json
 import os
 import random
+import time
+from contextlib import nullcontext
 from time import sleep
 from typing import Tuple
 from dotenv import load_dotenv
 import requests
 
+from cassette import CassetteMissError, get_http_client
+from generation_backend import GenerationBackend
+
+
+class OpenAIClient(GenerationBackend):
+    '''Chat model of OpenAI API.'''
+
+    # tokens added by the chat format for each message
+    MESSAGE_TOKEN_NUM = 4
 
-class OpenAIClient:
     def __init__(self):
         token = os.getenv('OPENAI_TOKEN')
         model_name = os.getenv('OPENAI_MODEL_NAME')
         max_number_of_tokens = os.getenv('OPENAI_MAX_NUMBER_OF_TOKENS')
+        # optional, e.g. a local stand-in for benchmarks
+        url = os.getenv('OPENAI_URL',
+                        "https://api.openai.com/v1/chat/completions")
 
         if token == None or model_name == None or max_number_of_tokens == None:
             raise Exception("Cannot get value in .env file.")
 
         # get form openai login API, and used for account's credit checking
         self.token = token
+        self.url = url
         self.model_name = model_name
         # = context window = max_input_length + max_output_length
         self.max_number_of_tokens = int(max_number_of_tokens)
 
-    def generate(self, system_input_text: str, user_input_text: str, max_output_length: int) -> Tuple[int, str]:
+        # context manager bounding concurrent requests, e.g. shared by worker processes
+        self.limiter = None
+        # MetricsRecorder, a record is made for each request
+        self.metrics = None
+        # range of seconds waited before retrying a failed request
+        self.retry_wait_range = (5, 15)
+        # requests module, or a session replaying recorded responses, see cassette.py
+        self.http = get_http_client()
+
+        self._tokenizer = None
+
+    @property
+    def tokenizer(self):
+        '''tiktoken encoding of the model, loaded on first use'''
+        if self._tokenizer == None:
+            import tiktoken
+            self._tokenizer = tiktoken.encoding_for_model(self.model_name)
+        return self._tokenizer
+
+    def count_tokens(self, text: str) -> int:
+        return len(self.tokenizer.encode(text))
+
+    def truncate(self, text: str, max_length: int) -> str:
+        return self.tokenizer.decode(self.tokenizer.encode(text)[:max_length])
+
+    def build_prompt(self, system_input_text: str, user_input_text: str) -> str:
+        # no raw prompt format for chat models, the prompt is sent as a user message
+        return f"{system_input_text}\n{user_input_text}"
+
+    def generate(self, input_text: str, max_output_length: int) -> str:
+        '''raise Exception if error occurs.'''
+        return self.chat("", input_text, max_output_length)[1]
+
+    def chat(self, system_input_text: str, user_input_text: str, max_output_length: int) -> Tuple[int, str]:
+        '''
+            return: (total_tokens, output_text)
+            raise Exception if error occurs.
+        '''
+        return self._chat(system_input_text, user_input_text, max_output_length, None)
+
+    def chat_until(self, system_input_text: str, user_input_text: str, max_output_length: int,
+                   stop_detector) -> Tuple[int, str]:
         '''
+            Stream the completion and close it as soon as stop_detector is satisfied.
             return: (total_tokens, output_text)
             raise Exception if error occurs.
         '''
+        return self._chat(system_input_text, user_input_text, max_output_length, stop_detector)
+
+    def _read_stream(self, res: requests.Response, stop_detector) -> Tuple[dict, str, float, bool]:
+        '''
+            Read server-sent events of a streamed completion.
+            return: (usage or None if the server sent none, output_text, time of the first token,
+                     is_early_stopped: whether the stream was closed before it ended)
+        '''
+        usage = None
+        output_text = ""
+        first_token_time = None
+        # chunk_size None: events are handled as they arrive instead of filling a buffer
+        for line in res.iter_lines(chunk_size=None, decode_unicode=True):
+            if not line or not line.startswith("data: "):
+                continue
+            data = line[len("data: "):]
+            if data == "[DONE]":
+                break
+
+            obj = json.loads(data)
+            if obj.get('usage'):
+                usage = obj['usage']
+            for choice in obj.get('choices', []):
+                piece = (choice.get('delta') or {}).get('content') or ""
+                if piece == "":
+                    continue
+                if first_token_time == None:
+                    first_token_time = time.time()
+                output_text += piece
+                if stop_detector.feed(piece):
+                    # the rest of the completion is not needed
+                    return None, output_text, first_token_time, True
+
+        return usage, output_text, first_token_time, False
+
+    def _chat(self, system_input_text: str, user_input_text: str, max_output_length: int,
+              stop_detector) -> Tuple[int, str]:
+        '''Streams the completion if stop_detector is given.'''
         error_msg = ""
-        for _ in range(5):
+        queue_wait = 0.0
+        for retries in range(5):
             try:
                 messages = [{
                     "role": "user",
@@ -39,33 +135,85 @@ class OpenAIClient:
                         "content": system_input_text
                     })
 
-                res = requests.post("https://api.openai.com/v1/chat/completions",
-                                    timeout=20,
-                                    headers={
-                                        "Authorization": f"Bearer {self.token}",
-                                        "Content-Type": "application/json"
-                                    },
-                                    json={
-                                        "model": self.model_name,
-                                        "messages": messages,
-                                        "max_tokens": max_output_length,
-                                        "n": 1,
-                                        "temperature": 0.2,
-                                    })
-
-                if res.status_code != 200:
-                    raise Exception(
-                        f"OpenAI API error code: {res.status_code}\n{res.json()}")
-
-                return res.json()['usage']['total_tokens'], res.json()['choices'][0]['message']['content']
+                request_obj = {
+                    "model": self.model_name,
+                    "messages": messages,
+                    "max_tokens": max_output_length,
+                    "n": 1,
+                    "temperature": 0.2,
+                }
+                if stop_detector != None:
+                    stop_detector.reset()
+                    request_obj["stream"] = True
+                    request_obj["stream_options"] = {"include_usage": True}
+
+                wait_start_time = time.time()
+                with self.limiter if self.limiter != None else nullcontext():
+                    request_start_time = time.time()
+                    queue_wait += request_start_time - wait_start_time
+                    res = self.http.post(self.url,
+                                         timeout=20,
+                                         stream=stop_detector != None,
+                                         headers={
+                                             "Authorization": f"Bearer {self.token}",
+                                             "Content-Type": "application/json"
+                                         },
+                                         json=request_obj)
+
+                    # a streamed response holds its connection until it is closed, also on errors
+                    with res:
+                        if res.status_code != 200:
+                            raise Exception(
+                                f"OpenAI API error code: {res.status_code}\n{res.json()}")
+
+                        first_token_time = None
+                        is_early_stopped = False
+                        if stop_detector != None:
+                            usage, output_text, first_token_time, is_early_stopped = self._read_stream(
+                                res, stop_detector)
+                        else:
+                            usage = res.json()['usage']
+                            output_text = res.json()['choices'][0]['message']['content']
+                    latency = time.time() - request_start_time
+
+                if usage == None:
+                    # no usage is sent if the stream is closed early or the server ignores stream_options,
+                    # count tokens as the API does
+                    prompt_tokens = self.count_tokens(
+                        system_input_text + user_input_text) + self.MESSAGE_TOKEN_NUM * len(messages)
+                    completion_tokens = self.count_tokens(output_text)
+                    usage = {
+                        'prompt_tokens': prompt_tokens,
+                        'completion_tokens': completion_tokens,
+                        'total_tokens': prompt_tokens + completion_tokens,
+                    }
+
+                if self.metrics != None:
+                    fields = {}
+                    if first_token_time != None:
+                        fields['first_token_latency'] = first_token_time - request_start_time
+                    if stop_detector != None:
+                        fields['early_stopped'] = int(is_early_stopped)
+                    self.metrics.record('openai_generate', status='ok', queue_wait=queue_wait, latency=latency,
+                                        retries=retries, prompt_tokens=usage['prompt_tokens'],
+                                        completion_tokens=usage['completion_tokens'], **fields)
+
+                return usage['total_tokens'], output_text
+            except CassetteMissError as e:
+                # a response that was not recorded is not found by retrying
+                error_msg = e
+                break
             except Exception as e:
                 error_msg = e
                 # wait random time to reduce pressure on server
-                sleep(random.randint(5, 15))
+                sleep(random.uniform(*self.retry_wait_range))
                 continue
 
-        raise Exception(error_msg)
+        if self.metrics != None:
+            self.metrics.record('openai_generate', status='error',
+                                queue_wait=queue_wait, retries=5)
 
+        raise Exception(error_msg)
 
 if __name__ == '__main__':
     load_dotenv()
@@ -0,0 +1,170 @@
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterator, List, Tuple
+
+from parse_stream import ParseTreeBuilder, follow_records, iter_parse_records
+
+
+def get_file_hash(file_path: str) -> str:
+    hasher = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            hasher.update(chunk)
+
+    return hasher.hexdigest()
+
+
+class ParseCache:
+    '''
+        Store of java-repo-parser outputs keyed by (repo, sha, parser version),
+        shared by dataset filtering and summarization so that each repo is parsed once.
+        The parser version is the hash of the parser jar, so a rebuilt parser invalidates the cache.
+    '''
+
+    def __init__(self, cache_root_path: str, jar_path: str, timeout: int = 1800):
+        self.cache_root_path = cache_root_path
+        self.jar_path = jar_path
+        self.timeout = timeout
+        self._parser_version = None
+
+        os.makedirs(cache_root_path, exist_ok=True)
+
+    @property
+    def parser_version(self) -> str:
+        '''hash of the parser jar, computed on first use'''
+        if self._parser_version == None:
+            self._parser_version = get_file_hash(self.jar_path)[:16]
+        return self._parser_version
+
+    def get_path(self, repo: str, sha: str) -> str:
+        '''return: path of the parse output, it may not exist yet'''
+        key = hashlib.sha256(
+            f"{repo}@{sha}@{self.parser_version}".encode()).hexdigest()
+
+        return os.path.join(self.cache_root_path, key[:2], f"{key}.json")
+
+    def has(self, repo: str, sha: str) -> bool:
+        return os.path.exists(self.get_path(repo, sha))
+
+    def parse(self, repo: str, sha: str, repo_path: str) -> str:
+        '''
+            Parse the repo if it is not in cache.
+            return: path of the parse output
+            raise Exception if parsing failed.
+        '''
+        output_path = self.get_path(repo, sha)
+        if os.path.exists(output_path):
+            return output_path
+
+        if not os.path.exists(repo_path):
+            raise Exception(f"Repo's path does not exist: {repo_path}")
+
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+
+        # write to a temp file, so that a failed or concurrent run never leaves a partial output
+        temp_output_path = f"{output_path}.{os.getpid()}.tmp"
+        try:
+            res = subprocess.run(
+                ["java", "-jar", self.jar_path,
+                    f"-r={repo_path}", f"-o={temp_output_path}"],
+                stdout=subprocess.PIPE, stderr=subprocess.STDOUT, timeout=self.timeout)
+            if res.returncode != 0 or not os.path.exists(temp_output_path):
+                raise Exception(
+                    f"Failed to parse repo: {repo}\n{res.stdout.decode(errors='ignore')[-2000:]}")
+
+            os.replace(temp_output_path, output_path)
+        finally:
+            if os.path.exists(temp_output_path):
+                os.remove(temp_output_path)
+
+        return output_path
+
+    def parse_stream(self, repo: str, sha: str, repo_path: str) -> Iterator[dict]:
+        '''
+            Records of the parse output as they are produced, see ParseTreeBuilder,
+            so that consumers start before parsing ends. Cached outputs are replayed as records.
+            The output is cached once parsing succeeds.
+            raise Exception if parsing failed.
+        '''
+        output_path = self.get_path(repo, sha)
+        if os.path.exists(output_path):
+            with open(output_path, "r") as f_output:
+                yield from iter_parse_records(json.load(f_output))
+            return
+
+        if not os.path.exists(repo_path):
+            raise Exception(f"Repo's path does not exist: {repo_path}")
+
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+
+        temp_records_path = f"{output_path}.{os.getpid()}.jsonl.tmp"
+        temp_output_path = f"{output_path}.{os.getpid()}.tmp"
+        temp_log_path = f"{output_path}.{os.getpid()}.log.tmp"
+        builder = ParseTreeBuilder()
+        process = None
+        try:
+            # the parser prints a line for each file it cannot parse, a file keeps the pipe from filling up
+            with open(temp_log_path, "wb") as f_log:
+                process = subprocess.Popen(
+                    ["java", "-jar", self.jar_path,
+                        f"-r={repo_path}", f"-o={temp_records_path}", "-s"],
+                    stdout=f_log, stderr=subprocess.STDOUT)
+                try:
+                    for record in follow_records(temp_records_path, process, self.timeout):
+                        builder.add(record)
+                        yield record
+                except Exception as e:
+                    with open(temp_log_path, "rb") as f_log_read:
+                        log_text = f_log_read.read().decode(errors='ignore')[-2000:]
+                    raise Exception(f"Failed to parse repo: {repo}\n{e}\n{log_text}")
+
+            if builder.parse_obj == None:
+                raise Exception(f"Failed to parse repo: {repo}\nThe parse output is incomplete.")
+
+            with open(temp_output_path, "w") as f_output:
+                json.dump(builder.parse_obj, f_output)
+            os.replace(temp_output_path, output_path)
+        finally:
+            # the consumer may stop early, the parser is not needed anymore
+            if process != None and process.poll() == None:
+                process.kill()
+                process.wait()
+            for temp_path in [temp_records_path, temp_output_path, temp_log_path]:
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
+
+    def parse_many(self, items: List[Tuple[str, str, str]], workers: int = 4) -> Dict[Tuple[str, str], str]:
+        '''
+            Parse repos concurrently, each parser runs in its own JVM process.
+            items: a list of (repo, sha, repo_path)
+            return: {(repo, sha): path of the parse output | None if parsing failed}
+        '''
+        # deduplicate, the same repo may appear several times
+        unique_items = {}
+        for repo, sha, repo_path in items:
+            unique_items[(repo, sha)] = repo_path
+
+        def parse_item(key):
+            try:
+                return key, self.parse(key[0], key[1], unique_items[key])
+            except Exception as e:
+                print(e)
+                return key, None
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            return dict(executor.map(parse_item, list(unique_items.keys())))
+
+    def materialize(self, repo: str, sha: str, target_path: str):
+        '''Make the cached parse output available at target_path for tools that expect it there.'''
+        source_path = self.get_path(repo, sha)
+        if os.path.exists(target_path):
+            os.remove(target_path)
+
+        try:
+            os.link(source_path, target_path)
+        except OSError:
+            shutil.copyfile(source_path, target_path)
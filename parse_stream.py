@@ -0,0 +1,123 @@
+import json
+import subprocess
+import time
+from typing import Iterator
+
+
+class ParseTreeBuilder:
+    '''
+        Assemble the parse tree from records of java-repo-parser --stream, one JSON object per line:
+            {"type": "file", id, name, signature, methods: [{id, name, signature, body}]}
+            {"type": "directory", id, name, files: [file id], subdirectories: [directory id]}
+            {"type": "repo", mainDirectory: directory id, nodeCount, ...}
+        Children come before their parents, and the repo record is the last one.
+        Usage:
+            for record in records: builder.add(record)
+            builder.parse_obj  # same as the output without --stream, None before the repo record
+    '''
+
+    def __init__(self):
+        self.file_objs = {}  # id -> file not yet attached to a directory
+        self.dir_objs = {}  # id -> directory not yet attached to its parent
+        self.parse_obj = None
+
+    def add(self, record: dict) -> dict:
+        '''return: the file of a file record, None for other records'''
+        if record['type'] == 'file':
+            file_obj = {
+                'id': record['id'],
+                'name': record['name'],
+                'signature': record['signature'],
+                'methods': record['methods'],
+            }
+            self.file_objs[file_obj['id']] = file_obj
+            return file_obj
+
+        if record['type'] == 'directory':
+            self.dir_objs[record['id']] = {
+                'id': record['id'],
+                'name': record['name'],
+                'files': [self.file_objs.pop(x) for x in record['files']],
+                'subdirectories': [self.dir_objs.pop(x) for x in record['subdirectories']],
+            }
+        elif record['type'] == 'repo':
+            if record['mainDirectory'] == None:
+                raise Exception("No java file is found in the repo.")
+            self.parse_obj = {
+                **{k: v for k, v in record.items() if k != 'type'},
+                'mainDirectory': self.dir_objs.pop(record['mainDirectory']),
+            }
+        else:
+            raise Exception(f"Unknown parse record type: {record['type']}")
+
+        return None
+
+
+def iter_parse_records(parse_obj: dict) -> Iterator[dict]:
+    '''Records of a complete parse output, in the order java-repo-parser --stream writes them.'''
+    def iter_dir(dir_obj: dict) -> Iterator[dict]:
+        for sub_dir_obj in dir_obj['subdirectories']:
+            yield from iter_dir(sub_dir_obj)
+        for file_obj in dir_obj['files']:
+            yield {'type': 'file', **file_obj}
+        yield {
+            'type': 'directory',
+            'id': dir_obj['id'],
+            'name': dir_obj['name'],
+            'files': [x['id'] for x in dir_obj['files']],
+            'subdirectories': [x['id'] for x in dir_obj['subdirectories']],
+        }
+
+    yield from iter_dir(parse_obj['mainDirectory'])
+    yield {
+        'type': 'repo',
+        **{k: v for k, v in parse_obj.items() if k != 'mainDirectory'},
+        'mainDirectory': parse_obj['mainDirectory']['id'],
+    }
+
+
+def follow_records(file_path: str, process: subprocess.Popen, timeout: float,
+                   poll_interval: float = 0.05) -> Iterator[dict]:
+    '''
+        Records appended to file_path by the running process, yielded as soon as their line is complete.
+        raise Exception if the process fails or exceeds the timeout.
+    '''
+    deadline = time.time() + timeout
+    pending = ""
+    f_records = None
+    try:
+        while True:
+            if f_records == None:
+                try:
+                    f_records = open(file_path, "r", encoding="utf-8")
+                except FileNotFoundError:
+                    pass
+
+            # read all complete lines written so far
+            line = f_records.readline() if f_records != None else ""
+            if line != "":
+                pending += line
+                if pending.endswith("\n"):
+                    yield json.loads(pending)
+                    pending = ""
+                continue
+
+            # check the exit only after reading, so no line written before it is missed
+            if process.poll() != None:
+                if f_records != None:
+                    pending += f_records.read()
+                    for rest_line in pending.splitlines():
+                        if rest_line.strip() != "":
+                            yield json.loads(rest_line)
+                if process.returncode != 0:
+                    raise Exception(
+                        f"Parser exited with code {process.returncode}.")
+                return
+
+            if time.time() > deadline:
+                process.kill()
+                raise Exception(f"Parser timed out after {timeout} seconds.")
+            time.sleep(poll_interval)
+    finally:
+        if f_records != None:
+            f_records.close()
@@ -1,13 +1,18 @@
 import json
 import logging
 import re
+import time
 from enum import Enum
 from typing import List, Tuple
 
-import tiktoken
-from constants import EXP_MAX_REF_COUNT, EXP_QUERY, INPUT_SEPARATOR, LOG_SEPARATOR, RET_DIR_SYSTEM_PROMPT, RET_DIR_MAX_INFO_LENGTH, RET_FILE_MAX_INFO_LENGTH, RET_MAX_OUTPUT_LENGTH, RET_FILE_SYSTEM_PROMPT, RET_MAX_BACKTRACK_COUNT
+from constants import EXP_MAX_REF_COUNT, EXP_QUERY, INPUT_SEPARATOR, RET_DIR_SYSTEM_PROMPT, RET_DIR_MAX_INFO_LENGTH, RET_FILE_MAX_INFO_LENGTH, RET_MAX_OUTPUT_LENGTH, RET_FILE_SYSTEM_PROMPT, RET_MAX_BACKTRACK_COUNT, RET_LEXICAL_WEIGHT
 
-from openai_client import OpenAIClient
+from context_packer import ContextPacker, encode_info
+from generation_backend import GenerationBackend
+from json_stream import JsonObjectDetector
+from lexical_index import HybridSimilarityMixin
+from log_pipeline import LogEvent
+from metrics import MetricsRecorder, metrics_context
 from text_sim_calculator import TextSimCalculator
 
 
@@ -16,28 +21,84 @@ class InferType(Enum):
     DIR = 1  # retrieve in directory
 
 
-class Retriever:
-    def __init__(self, openai_client: OpenAIClient, text_sim_calculator: TextSimCalculator):
-        self.openai_tokenizer = tiktoken.encoding_for_model(
-            openai_client.model_name)
-        self.openai_client = openai_client
+class Retriever(HybridSimilarityMixin):
+    def __init__(self, chat_backend: GenerationBackend, text_sim_calculator: TextSimCalculator,
+                 lexical_weight: float = RET_LEXICAL_WEIGHT, metrics: MetricsRecorder = None):
+        self.chat_backend = chat_backend
+        # the answer is a small JSON object, generation stops once it is parsed
+        self.json_detector = JsonObjectDetector()
+        self.context_packer = ContextPacker(chat_backend)
         self.token_used_count = 0
 
         self.text_sim_calculator = text_sim_calculator
 
+        self._init_lexical_index(lexical_weight)
+
+        self.metrics = metrics  # a record is made for each query
+
     def _reset(self):
         '''Reset variables.'''
         self.result_path = []
         self.most_probable_path = []
         self.is_first_try = True
         self.ret_times = 0
+        self.embedding_time = 0.0
+        # serving cost of the query, similarity covers embeddings and the lexical index
+        self.cost = {
+            'wall_time': 0.0,
+            'llm_time': 0.0,
+            'embedding_time': 0.0,
+            'llm_call_count': 0,
+            'backtrack_count': 0,
+            'prompt_tokens': 0,
+            'completion_tokens': 0,
+        }
 
     def _is_legal_input(self, system_input_text: str, user_input_text: str, max_output_length: int) -> bool:
         '''Check if the input text length exceeds the model limit.'''
-        encoded_text = self.openai_tokenizer.encode(
+        input_length = self.chat_backend.count_tokens(
             system_input_text + user_input_text)
 
-        return len(encoded_text) <= self.openai_client.max_number_of_tokens - max_output_length
+        return input_length <= self.chat_backend.max_number_of_tokens - max_output_length
+
+    def _pack_infos(self, node_id: int, system_input_text: str, user_input_text: str, infos: List[dict]) -> str:
+        '''
+            Append infos ranked by similarity to user_input_text as compact JSON lines,
+            summaries are shortened and the least similar infos are left out to fit the token limit.
+            return: user input text, None if not even one info fits.
+        '''
+        budget = self.chat_backend.max_number_of_tokens - RET_MAX_OUTPUT_LENGTH - \
+            self.chat_backend.count_tokens(system_input_text + user_input_text)
+        context, packed_count, truncated_count = self.context_packer.pack(
+            infos, budget,
+            lambda info, text: encode_info({
+                'id': info['id'],
+                'name': info['name'],
+                'similarity': round(info['similarity'], 2),
+                'summary': text,
+            }))
+
+        if packed_count == 0:
+            return None
+        if packed_count < len(infos) or truncated_count > 0:
+            self.logger.info(LogEvent(
+                "CONTEXT PACKING", node_id=node_id, packed_count=packed_count,
+                ignored_count=len(infos) - packed_count, truncated_count=truncated_count))
+
+        return user_input_text + context
+
+    def _add_llm_cost(self, start_time: float, total_tokens: int, output_text: str):
+        '''Account a chat call, failed calls only add their time.'''
+        self.cost['llm_time'] += time.time() - start_time
+        self.cost['llm_call_count'] += 1
+        if output_text == None:
+            return
+
+        self.token_used_count += total_tokens
+        # the output is short, the prompt takes the rest of the reported total
+        completion_tokens = self.chat_backend.count_tokens(output_text)
+        self.cost['completion_tokens'] += completion_tokens
+        self.cost['prompt_tokens'] += max(0, total_tokens - completion_tokens)
 
     def _infer(self, node_id: int, type: InferType, user_input_text: str) -> dict:
         '''
@@ -53,25 +114,27 @@ class Retriever:
         else:
             system_input_text = RET_DIR_SYSTEM_PROMPT
 
+        start_time = time.time()
         try:
             # generate inference
-            total_tokens, output_text = self.openai_client.generate(
-                system_input_text, user_input_text, RET_MAX_OUTPUT_LENGTH)
-            self.token_used_count += total_tokens
+            with metrics_context(node_id=node_id, stage=f"infer_{type.name.lower()}"):
+                total_tokens, output_text = self.chat_backend.chat_until(
+                    system_input_text, user_input_text, RET_MAX_OUTPUT_LENGTH, self.json_detector)
+            self._add_llm_cost(start_time, total_tokens, output_text)
         except Exception as e:
-            self.logger.error(
-                f"GENERATION ERROR{LOG_SEPARATOR}\nNode ID: {node_id}\nSystem Input:\n{system_input_text}\nUser Input:\n{user_input_text}\n{e}")
+            self._add_llm_cost(start_time, 0, None)
+            self.logger.error(LogEvent(
+                "GENERATION ERROR", node_id=node_id, system_input=system_input_text, user_input=user_input_text,
+                error=str(e)))
             return None
 
         try:
             # get json object in output_text
-            match = re.search(r'\{.*\}', output_text, re.DOTALL)
-            if not match:
+            infer_obj = self.json_detector.obj
+            if infer_obj == None:
                 raise Exception()
-            json_text = match.group(0)
 
             # check if the result is formatted
-            infer_obj = json.loads(json_text)
             if type == InferType.FILE:
                 if 'id' not in infer_obj or \
                         not isinstance(infer_obj['id'], int):
@@ -82,13 +145,15 @@ class Retriever:
                         not all(isinstance(x, int) for x in infer_obj['ids']):
                     raise Exception()
 
-            self.logger.info(
-                f"INFERENCE{LOG_SEPARATOR}\nNode ID: {node_id}\nSystem Input:\n{system_input_text}\nUser Input:\n{user_input_text}\nOutput:\n{infer_obj}")
+            self.logger.info(LogEvent(
+                "INFERENCE", node_id=node_id, system_input=system_input_text, user_input=user_input_text,
+                output=infer_obj))
 
             return infer_obj
         except Exception as e:
-            self.logger.error(
-                f"GENERATION ERROR{LOG_SEPARATOR}\nNode ID: {node_id}\nSystem Input:\n{system_input_text}\nUser Input:\n{user_input_text}\nOutput:\n{output_text}\nThe inference result is not formatted")
+            self.logger.error(LogEvent(
+                "GENERATION ERROR", node_id=node_id, system_input=system_input_text, user_input=user_input_text,
+                output=output_text, error="The inference result is not formatted"))
             return None
 
     def _retrieve_in_file(self, file_sum_obj: dict) -> Tuple[bool, bool]:
@@ -100,8 +165,8 @@ class Retriever:
 
         # check number of valid context
         if len(file_sum_obj['methods']) == 0:
-            self.logger.info(
-                f"CONTEXT ERROR{LOG_SEPARATOR}\nNode ID: {file_sum_obj['id']}\nNo method in this file.")
+            self.logger.info(LogEvent(
+                "CONTEXT ERROR", node_id=file_sum_obj['id'], error="No method in this file."))
             return True, False
 
         # get information list of method
@@ -113,30 +178,16 @@ class Retriever:
                 'summary': method_sum_obj['summary'],
             })
 
-        # calculate similarity
-        summaries = [info['summary'] for info in infos]
-        similarities = self.text_sim_calculator.calc_similarities(
-            self.query, summaries)
-
-        for i, info in enumerate(infos):
-            info['similarity'] = similarities[i]
-        infos.sort(key=lambda x: x['similarity'], reverse=True)
-
-        # concat info list to context.
-        for info in infos[:RET_FILE_MAX_INFO_LENGTH]:
-            temp_obj = {
-                'id': info['id'],
-                'name': info['name'],
-                'similarity': info['similarity'],
-                'summary': info['summary'],
-            }
-            temp_str = f"{temp_obj}\n"
-            if not self._is_legal_input(RET_FILE_SYSTEM_PROMPT, user_input_text + temp_str, RET_MAX_OUTPUT_LENGTH):
-                self.logger.info(
-                    f"CONTEXT ERROR{LOG_SEPARATOR}\nNode ID: {file_sum_obj['id']}\nInput text length exceeds the model limit.")
-                return True, False
-
-            user_input_text += temp_str
+        # calculate similarity, and sort infos according to similarity
+        self._sort_by_similarity(infos)
+
+        # pack info list into context within the token limit
+        user_input_text = self._pack_infos(
+            file_sum_obj['id'], RET_FILE_SYSTEM_PROMPT, user_input_text, infos[:RET_FILE_MAX_INFO_LENGTH])
+        if user_input_text == None:
+            self.logger.info(LogEvent(
+                "CONTEXT ERROR", node_id=file_sum_obj['id'], error="Input text length exceeds the model limit."))
+            return True, False
 
         # infer the method
         infer_obj = self._infer(
@@ -155,8 +206,8 @@ class Retriever:
         method_sum_obj = next(
             filter(lambda x: x['id'] == infer_obj['id'], file_sum_obj['methods']), None)
         if method_sum_obj is None:
-            self.logger.info(
-                f"GENERATION ERROR{LOG_SEPARATOR}\nNode ID: {file_sum_obj['id']}\nThe method is not found in this class.")
+            self.logger.info(LogEvent(
+                "GENERATION ERROR", node_id=file_sum_obj['id'], error="The method is not found in this class."))
             return True, False
 
         # return the result of retrieval
@@ -172,8 +223,8 @@ class Retriever:
 
         # check number of valid context
         if len(dir_sum_obj['subdirectories']) == 0 and len(dir_sum_obj['files']) == 0:
-            self.logger.info(
-                f"CONTEXT ERROR{LOG_SEPARATOR}\nNode ID: {dir_sum_obj['id']}\nNo file or subdirectory in this directory.")
+            self.logger.info(LogEvent(
+                "CONTEXT ERROR", node_id=dir_sum_obj['id'], error="No file or subdirectory in this directory."))
             return True, False
 
         # get information list of subdirectory and file
@@ -183,6 +234,7 @@ class Retriever:
                 'id': sub_dir_sum_obj['id'],
                 'name': sub_dir_sum_obj['name'],
                 'summary': sub_dir_sum_obj['summary'],
+                'embedding': sub_dir_sum_obj.get('embedding'),
             })
         for file_sum_obj in dir_sum_obj['files']:
             infos.append({
@@ -191,30 +243,16 @@ class Retriever:
                 'summary': file_sum_obj['summary'],
             })
 
-        # calculate similarity
-        summaries = [info['summary'] for info in infos]
-        similarities = self.text_sim_calculator.calc_similarities(
-            self.query, summaries)
-
-        for i, info in enumerate(infos):
-            info['similarity'] = similarities[i]
-        infos.sort(key=lambda x: x['similarity'], reverse=True)
-
-        # concat info list to context.
-        for info in infos[:RET_DIR_MAX_INFO_LENGTH]:
-            temp_obj = {
-                'id': info['id'],
-                'name': info['name'],
-                'similarity': info['similarity'],
-                'summary': info['summary'],
-            }
-            temp_str = f"{temp_obj}\n"
-            if not self._is_legal_input(RET_DIR_SYSTEM_PROMPT, user_input_text + temp_str, RET_MAX_OUTPUT_LENGTH):
-                self.logger.info(
-                    f"CONTEXT ERROR{LOG_SEPARATOR}\nNode ID: {dir_sum_obj['id']}\nInput text length exceeds the model limit.")
-                return True, False
-
-            user_input_text += temp_str
+        # calculate similarity, and sort infos according to similarity
+        self._sort_by_similarity(infos)
+
+        # pack info list into context within the token limit
+        user_input_text = self._pack_infos(
+            dir_sum_obj['id'], RET_DIR_SYSTEM_PROMPT, user_input_text, infos[:RET_DIR_MAX_INFO_LENGTH])
+        if user_input_text == None:
+            self.logger.info(LogEvent(
+                "CONTEXT ERROR", node_id=dir_sum_obj['id'], error="Input text length exceeds the model limit."))
+            return True, False
 
         # infer the subdirectiry or file
         infer_obj = self._infer(
@@ -225,7 +263,9 @@ class Retriever:
             return True, False
 
         # try ids in turn
-        for infer_id in infer_obj['ids'][:RET_MAX_BACKTRACK_COUNT]:
+        for idx, infer_id in enumerate(infer_obj['ids'][:RET_MAX_BACKTRACK_COUNT]):
+            if idx > 0:
+                self.cost['backtrack_count'] += 1
             file_sum_obj = None
             sub_dir_sum_obj = None
             next_sum_obj = None
@@ -240,8 +280,9 @@ class Retriever:
 
             if file_sum_obj is None and sub_dir_sum_obj is None:
                 # can't find next_sum_obj
-                self.logger.info(
-                    f"GENERATION ERROR{LOG_SEPARATOR}\nNode ID: {dir_sum_obj['id']}\nThe file or subdirectory is not found in this directory.")
+                self.logger.info(LogEvent(
+                    "GENERATION ERROR", node_id=dir_sum_obj['id'],
+                    error="The file or subdirectory is not found in this directory."))
                 return True, False
 
             if file_sum_obj is not None:
@@ -278,6 +319,7 @@ class Retriever:
             infos.append({
                 'id': sub_dir_sum_obj['id'],
                 'summary': sub_dir_sum_obj['summary'],
+                'embedding': sub_dir_sum_obj.get('embedding'),
             })
 
         for file_sum_obj in dir_sum_obj['files']:
@@ -287,13 +329,7 @@ class Retriever:
             })
 
         # calculate similarity, and sort infos according to similarity
-        summaries = [info['summary'] for info in infos]
-        similarities = self.text_sim_calculator.calc_similarities(
-            self.query, summaries)
-
-        for i, info in enumerate(infos):
-            info['similarity'] = similarities[i]
-        infos.sort(key=lambda x: x['similarity'], reverse=True)
+        self._sort_by_similarity(infos)
 
         # collect the summary of subdirectory or file with the highest similarity
         for info in infos[:EXP_MAX_REF_COUNT]:
@@ -302,7 +338,7 @@ class Retriever:
             if sub_dir_sum_obj is not None:
                 result.extend(self._collect_in_dir(sub_dir_sum_obj))
 
-            result.append(info)
+            result.append({'id': info['id'], 'summary': info['summary']})
 
         return result
 
@@ -339,12 +375,15 @@ class Retriever:
             selected_sum_ids.append(sum_obj['id'])
 
         # expand the query
+        start_time = time.time()
         try:
-            total_tokens, output_text = self.openai_client.generate(
-                SYSTEM_PROMPT, user_input_text, MAX_OUTPUT_LENGTH)
-            self.token_used_count += total_tokens
+            with metrics_context(stage='expand_query'):
+                total_tokens, output_text = self.chat_backend.chat(
+                    SYSTEM_PROMPT, user_input_text, MAX_OUTPUT_LENGTH)
+            self._add_llm_cost(start_time, total_tokens, output_text)
         except Exception as e:
-            self.logger.error(f"QUERY EXPANSION ERROR{LOG_SEPARATOR}\n{e}")
+            self._add_llm_cost(start_time, 0, None)
+            self.logger.error(LogEvent("QUERY EXPANSION ERROR", error=str(e)))
             return True, ""
 
         # check if the result is formatted
@@ -359,26 +398,28 @@ class Retriever:
                     not isinstance(res_obj['expanded_query'], str):
                 raise Exception("The result is not formatted.")
         except Exception as e:
-            self.logger.error(f"QUERY EXPANSION ERROR{LOG_SEPARATOR}\n{e}")
+            self.logger.error(LogEvent("QUERY EXPANSION ERROR", error=str(e)))
             return True, ""
 
-        self.logger.info(
-            f"QUERY EXPANSION{LOG_SEPARATOR}\nCollected IDs: {selected_sum_ids}\nSystem Input:\n{SYSTEM_PROMPT}\nUser Input:\n{user_input_text}\nOutput:\n{output_text}")
-        if ignore_start_idx != -1:
-            self.logger.info(
-                f"Ignored Summaries: {collected_sum_objs[ignore_start_idx:]}")
+        self.logger.info(LogEvent(
+            "QUERY EXPANSION", collected_ids=selected_sum_ids, system_input=SYSTEM_PROMPT, user_input=user_input_text,
+            output=output_text, ignored=collected_sum_objs[ignore_start_idx:] if ignore_start_idx != -1 else []))
 
         return False, res_obj['expanded_query']
 
     def retrieve(self, query: str, repo_sum_obj: dict, logger: logging.Logger) -> Tuple[bool, dict]:
         '''
             Retrieve the method according to its description and the information of the entire repo.
-            return: (is_error: bool, {is_found: bool, is_query_expanded: bool, path: List[str], ret_times: int}).
+            return: (is_error: bool, {is_found: bool, is_query_expanded: bool, path: List[str], ret_times: int, cost: dict}).
             If is_found is False, path is the search path of the most probability.
+            cost: {wall_time, llm_time, embedding_time(seconds), llm_call_count, backtrack_count, prompt_tokens, completion_tokens}
         '''
+        start_time = time.time()
+        start_token_used_count = self.token_used_count
         self.query = query
         self.logger = logger
         self._reset()
+        self._load_lexical_index(repo_sum_obj)
 
         is_query_expanded = False
 
@@ -394,8 +435,8 @@ class Retriever:
                 self.query = expanded_query
                 is_error, is_found = self._retrieve_in_dir(repo_sum_obj)
 
-        self.logger.info(f"RETRIEVAL COMPLETION{LOG_SEPARATOR}")
-        self.logger.info(f"Token Used: {self.token_used_count}")
+        self.logger.info(LogEvent("RETRIEVAL COMPLETION",
+                         token_used_count=self.token_used_count))
 
         # assemble result
         res = {'is_found': is_found, 'is_query_expanded': is_query_expanded}
@@ -407,4 +448,16 @@ class Retriever:
 
         res['ret_times'] = self.ret_times
 
+        self.cost['wall_time'] = time.time() - start_time
+        self.cost['embedding_time'] = self.embedding_time
+        for key in ['wall_time', 'llm_time', 'embedding_time']:
+            self.cost[key] = round(self.cost[key], 4)
+        res['cost'] = self.cost
+
+        if self.metrics != None:
+            self.metrics.record('retrieve', status='error' if is_error else 'ok',
+                                latency=self.cost['wall_time'], ret_times=self.ret_times,
+                                total_tokens=self.token_used_count - start_token_used_count,
+                                is_found=is_found, is_query_expanded=is_query_expanded)
+
         return is_error, res
@@ -10,6 +10,9 @@ import torch
 from transformers import AutoTokenizer, AutoModel
 from torch.utils.data import DataLoader, Dataset
 
+from body_store import BodyStore
+from code_encoder import CodeEncoder
+
 
 class TextDataset(Dataset):
     def __init__(self, test_data_objs, code_data_objs):
@@ -111,8 +114,18 @@ def get_eos_vec(hidden_state, source_ids, eos_token_id):
     return dec_vec
 
 
+def get_rerank_batches(pairs, code_lens, text_lens, batch_size):
+    '''
+        Pack (text idx, code idx) pairs of all queries into batches.
+        Pairs are sorted by real length so that each batch only pads to its own longest item.
+    '''
+    pairs = sorted(pairs, key=lambda x: (code_lens[x[1]], text_lens[x[0]]))
+
+    return [pairs[i:i + batch_size] for i in range(0, len(pairs), batch_size)]
+
+
 @torch.no_grad()
-def match_evaluation(model, text_feats, code_feats, tokenizer, device, top_k, img2txt):
+def match_evaluation(model, text_feats, code_feats, tokenizer, device, top_k, img2txt, batch_size):
     start_time = time.time()
 
     text_ids, text_atts, text_embeds, text_outputs = text_feats
@@ -123,21 +136,39 @@ def match_evaluation(model, text_feats, code_feats, tokenizer, device, top_k, im
     score_matrix_i2t = torch.full(
         (text_ids.size(0), code_ids.size(0)), -100.0).to(device)
 
-    for i, sims in enumerate(tqdm(sims_matrix, desc=f'Evaluate text-code matching with top {top_k} candidates:')):
-        topk_sim, topk_idx = sims.topk(k=top_k, dim=0)
-        encoder_output = text_outputs[i].repeat(top_k, 1, 1).to(device)
-        encoder_att = text_atts[i].repeat(top_k, 1).to(device)
-        code_ids[:, 0] = tokenizer.enc_token_id
-        output = model.decoder(code_ids[topk_idx],
-                               attention_mask=code_atts[topk_idx],
+    # collect top k candidates of all queries
+    top_k = min(top_k, code_ids.size(0))
+    _, topk_idxs = sims_matrix.topk(k=top_k, dim=1)
+    pairs = [(i, j) for i, idxs in enumerate(topk_idxs.tolist()) for j in idxs]
+
+    # real length of each sequence, padding is on the right side
+    code_lens = code_atts.sum(dim=1).tolist()
+    text_lens = text_atts.sum(dim=1).tolist()
+
+    batches = get_rerank_batches(pairs, code_lens, text_lens, batch_size)
+    for batch in tqdm(batches, desc=f'Evaluate text-code matching with top {top_k} candidates:'):
+        text_idx = torch.tensor([x[0] for x in batch])
+        code_idx = torch.tensor([x[1] for x in batch])
+        code_len = max(code_lens[x[1]] for x in batch)
+        text_len = max(text_lens[x[0]] for x in batch)
+
+        batch_code_ids = code_ids[code_idx, :code_len].to(device)
+        encoder_output = text_outputs[text_idx, :text_len].to(device)
+        encoder_att = text_atts[text_idx, :text_len].to(device)
+        output = model.decoder(batch_code_ids,
+                               attention_mask=code_atts[code_idx, :code_len].to(
+                                   device),
                                encoder_hidden_states=encoder_output,
                                encoder_attention_mask=encoder_att,
                                return_dict=True,
                                )
         output_vec = get_eos_vec(
-            output.last_hidden_state, code_ids[topk_idx], tokenizer.eos_token_id)
+            output.last_hidden_state, batch_code_ids, tokenizer.eos_token_id)
         score = model.itm_head(output_vec)[:, 1]
-        score_matrix_i2t[i, topk_idx] = score + topk_sim
+        text_idx = text_idx.to(device)
+        code_idx = code_idx.to(device)
+        score_matrix_i2t[text_idx, code_idx] = score + \
+            sims_matrix[text_idx, code_idx]
 
     total_time = time.time() - start_time
     total_time_str = str(datetime.timedelta(seconds=int(total_time)))
@@ -164,19 +195,11 @@ def match_evaluation(model, text_feats, code_feats, tokenizer, device, top_k, im
 
 
 
-@torch.no_grad()
-def get_contrast_feats(model, tokenizer, data_loader, max_length, device):
-    embeds = []
-
-    for text in tqdm(data_loader, total=len(data_loader)):
-        text_input = tokenizer(text, padding='max_length', truncation=True, max_length=max_length,
-                               return_tensors="pt").to(device)
-        embed = model(text_input.input_ids, attention_mask=text_input.attention_mask)
-        embeds.append(embed)
+def get_contrast_feats(code_encoder, dataset, max_length):
+    texts = [dataset[i] for i in range(len(dataset))]
 
-    embeds = torch.cat(embeds, dim=0)
+    return code_encoder.encode(texts, max_length)
 
-    return embeds
 
 @torch.no_grad()
 def contrast_evaluation(text_embeds, code_embeds, img2txt):
@@ -201,13 +224,19 @@ def contrast_evaluation(text_embeds, code_embeds, img2txt):
     return eval_result
 
 
-def get_code_data_objs(parse_out_path):
+def get_code_data_objs(tree_path: str, body_store_path: str = None):
+    '''
+        Code of each method with its path relative to the repo root.
+        tree_path: parse output, or summary tree whose method bodies are read from the body store at body_store_path
+    '''
     def traverse_file(file_obj, path_arr):
         for method_obj in file_obj['methods']:
             path_arr.append(method_obj['name'])
+            body = method_obj['body'] if 'body' in method_obj \
+                else body_store.get(method_obj['id'])
             data_objs.append({
                 'path': "/".join(path_arr),
-                'code': method_obj['signature'] + method_obj['body']
+                'code': method_obj['signature'] + body
             })
             path_arr.pop()
 
@@ -223,10 +252,20 @@ def get_code_data_objs(parse_out_path):
             path_arr.pop()
 
     data_objs = []
-    with open(parse_out_path, "r") as f_parse_out:
-        parse_obj = json.load(f_parse_out)
-        # does not include repo name
-        traverse_dir(parse_obj['mainDirectory'], [])
+    body_store = BodyStore(body_store_path) if body_store_path != None else None
+    try:
+        with open(tree_path, "r") as f_tree:
+            tree_obj = json.load(f_tree)
+
+        if 'mainDirectory' in tree_obj:
+            # does not include repo name
+            traverse_dir(tree_obj['mainDirectory'], [])
+        else:
+            # a root with a single subdirectory is merged with it in the summary tree, e.g. "<repo>/src"
+            traverse_dir(tree_obj, tree_obj['name'].split('/')[1:])
+    finally:
+        if body_store != None:
+            body_store.close()
 
     return data_objs
 
@@ -261,18 +300,29 @@ def main(args):
     model = model.to(device)
     model.eval()
 
+    # batched encoder shared by all repos
+    code_encoder = CodeEncoder(model, tokenizer, device, args.batch_size,
+                               embed_fn=lambda ids, att: model(ids, attention_mask=att))
+
     # calc recall
     r1s = []
     for idx, repo_name in enumerate(data_dict):
         test_data_objs = data_dict[repo_name]
         pipeline_logger.info(f"Start evaluating {idx}th repo: {repo_name}")
 
-        # get code data objs from parse output
+        # get code data objs from the summary tree and body store, or from parse output of older results
+        sum_out_path = os.path.join(
+            sum_result_root_path, repo_name, f"sum_out_{repo_name}.json")
+        body_store_path = os.path.join(
+            sum_result_root_path, repo_name, f"bodies_{repo_name}.bin")
         parse_out_path = os.path.join(
             sum_result_root_path, repo_name, f"parse_out_{repo_name}.json")
-        if not os.path.exists(parse_out_path):
+        if os.path.exists(sum_out_path) and os.path.exists(body_store_path):
+            code_data_objs = get_code_data_objs(sum_out_path, body_store_path)
+        elif os.path.exists(parse_out_path):
+            code_data_objs = get_code_data_objs(parse_out_path)
+        else:
             raise Exception("Parse output path does not exist.")
-        code_data_objs = get_code_data_objs(parse_out_path)
 
         # load data
         test_dataset, code_dataset = create_dataset(
@@ -281,16 +331,21 @@ def main(args):
             [test_dataset, code_dataset], args.batch_size, 4)
 
         # evaluate
-        # text_feats = get_match_feats(model, tokenizer, test_loader,
-        #                        args.max_text_len, device, modality='text')
-        # code_feats = get_match_feats(model, tokenizer, code_loader,
-        #                        args.max_code_len, device, modality='code')
-        # test_result = match_evaluation(model, text_feats, code_feats, tokenizer, device, args.top_k,
-        #                                test_loader.dataset.text2code)
-        
-        text_embeds = get_contrast_feats(model, tokenizer, test_loader, args.max_text_len, device)
-        code_embeds = get_contrast_feats(model, tokenizer, code_loader, args.max_code_len, device)
-        test_result = contrast_evaluation(text_embeds, code_embeds, test_loader.dataset.text2code)
+        if args.match:
+            # rerank top k candidates with ITM head
+            text_feats = get_match_feats(model, tokenizer, test_loader,
+                                         args.max_text_len, device, modality='text')
+            code_feats = get_match_feats(model, tokenizer, code_loader,
+                                         args.max_code_len, device, modality='code')
+            test_result = match_evaluation(model, text_feats, code_feats, tokenizer, device, args.top_k,
+                                           test_loader.dataset.text2code, args.rerank_batch_size)
+        else:
+            text_embeds = get_contrast_feats(
+                code_encoder, test_dataset, args.max_text_len)
+            code_embeds = get_contrast_feats(
+                code_encoder, code_dataset, args.max_code_len)
+            test_result = contrast_evaluation(
+                text_embeds, code_embeds, test_loader.dataset.text2code)
         print(f'Test result of {repo_name}: {test_result}')
         r1s.append(test_result['r1'])
 
@@ -305,6 +360,9 @@ if __name__ == '__main__':
         '--model_name', default='Salesforce/codet5p-220m-bimodal', type=str)
     parser.add_argument('--batch_size', default=256, type=int)
     parser.add_argument('--top_k', default=32, type=int)
+    parser.add_argument('--rerank_batch_size', default=64, type=int)
+    parser.add_argument('--match', action='store_true',
+                        help='rerank top k candidates with ITM head')
     parser.add_argument('--max_text_len', default=128, type=int)
     parser.add_argument('--max_code_len', default=512, type=int)
     parser.add_argument('--device', default='cuda', type=str)
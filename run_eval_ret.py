@@ -1,95 +1,189 @@
+import argparse
 import json
 import logging
 import os
-import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from dotenv import load_dotenv
 from tqdm import tqdm
 
-from openai_client import OpenAIClient
+from cassette import close_cassettes
+from generation_backend import create_backend, get_backend_name
+from log_pipeline import AsyncLogPipeline
+from metrics import MetricsRecorder, metrics_context
 from retriever import Retriever
 from text_sim_calculator import TextSimCalculator
 from sim_retriever import SimRetriever
 
 
-if __name__ == "__main__":
-    start_idx = int(sys.argv[1]) if len(sys.argv) > 1 else 0
+def load_finished_ids(ret_result_file_path: str) -> set:
+    '''Ids of queries that already have a result, used to resume.'''
+    finished_ids = set()
+    if not os.path.exists(ret_result_file_path):
+        return finished_ids
 
-    load_dotenv()
+    with open(ret_result_file_path, "r") as f_ret_result:
+        for line in f_ret_result:
+            try:
+                finished_ids.add(json.loads(line)['id'])
+            except Exception:
+                # ignore a partially written last line
+                continue
+
+    return finished_ids
 
-    data_file_path = "./eval_data/filtered/data_final.jsonl"
-    sum_result_root_path = "./eval_data/sum_result"
-    ret_log_dir_path = "./eval_data/ret_log"
-    ret_result_file_path = "./eval_data/ret_result.jsonl"
 
-    if not os.path.exists(ret_log_dir_path):
-        os.mkdir(ret_log_dir_path)
+def group_by_repo(data_objs: list) -> dict:
+    '''return: {repo_name: [data_obj]}'''
+    repo_dict = {}
+    for data_obj in data_objs:
+        repo_name = data_obj['repo'].split('/')[-1]
+        if repo_name not in repo_dict:
+            repo_dict[repo_name] = []
+        repo_dict[repo_name].append(data_obj)
+
+    return repo_dict
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--workers', default=4, type=int,
+                        help='number of queries retrieved concurrently')
+    parser.add_argument('--sim', action='store_true',
+                        help='use SimRetriever(ablation experiment)')
+    parser.add_argument('--data_file_path',
+                        default="./eval_data/filtered/data_final.jsonl", type=str)
+    parser.add_argument('--sum_result_root_path',
+                        default="./eval_data/sum_result", type=str)
+    parser.add_argument('--ret_log_file_path',
+                        default="./eval_data/ret_log.jsonl.gz", type=str,
+                        help='log of all queries, read it with log_pipeline.py')
+    parser.add_argument('--log_verbosity', default=None, choices=['full', 'metadata'],
+                        help='metadata keeps no prompt or output, default: env LOG_VERBOSITY or full')
+    parser.add_argument('--ret_result_file_path',
+                        default="./eval_data/ret_result.jsonl", type=str)
+    parser.add_argument('--ret_metrics_file_path',
+                        default="./eval_data/ret_metrics.jsonl", type=str,
+                        help='per-call records, histograms are written next to it(.prom)')
+    args = parser.parse_args()
+
+    load_dotenv()
 
     logging.basicConfig(level=logging.INFO,
                         format='%(name)s - %(asctime)s - %(levelname)s - %(message)s',
                         datefmt='%m/%d/%Y %H:%M:%S')
     pipeline_logger = logging.getLogger("pipeline")
 
-    # create client for OpenAI
+    # create generation backend, selected by env CHAT_BACKEND
     try:
-        openai_client = OpenAIClient()
+        chat_backend = create_backend(get_backend_name('chat', 'openai'))
     except Exception as e:
         pipeline_logger.error(e)
         exit(1)
 
-    # create similarity caculator
+    # record latency and tokens of each API call and query, labeled with query id
+    metrics = MetricsRecorder(args.ret_metrics_file_path)
+    chat_backend.metrics = metrics
+
+    # create similarity caculator, shared by all threads
     text_sim_calculator = TextSimCalculator()
-    # create retriever
-    retriever = Retriever(
-        openai_client, text_sim_calculator)
 
-    # create sim_retriever(ablation experiment)
-    # retriever = SimRetriever(text_sim_calculator)
+    # retriever keeps per-query state, so each thread has its own one
+    thread_local = threading.local()
+
+    def get_retriever():
+        if not hasattr(thread_local, 'retriever'):
+            if args.sim:
+                thread_local.retriever = SimRetriever(text_sim_calculator)
+            else:
+                thread_local.retriever = Retriever(
+                    chat_backend, text_sim_calculator, metrics=metrics)
+        return thread_local.retriever
 
-    with open(data_file_path, "r") as f_data, open(ret_result_file_path, "a") as f_ret_result:
+    with open(args.data_file_path, "r") as f_data:
         data_objs = [json.loads(line) for line in f_data.readlines()]
 
-        for idx, data_obj in enumerate(tqdm(data_objs[start_idx:])):
-            try:
-                query = data_obj['query']
-                repo_name = data_obj['repo'].split('/')[-1]
-
-                sum_out_path = os.path.join(
-                    sum_result_root_path, repo_name, f"sum_out_{repo_name}.json")
-                if not os.path.exists(sum_out_path):
-                    raise Exception("Summary output path does not exist.")
-
-                # create logger
-                ret_log_path = os.path.join(
-                    ret_log_dir_path, f"ret_log_{data_obj['id']}.txt")
-                ret_logger = logging.getLogger(ret_log_path)
-                ret_logger.addHandler(
-                    logging.FileHandler(ret_log_path, "w", "utf-8")
-                )
-                ret_logger.propagate = False  # prevent printing to console
-
-                with open(sum_out_path, "r") as f_sum_out:
-                    repo_sum_obj = json.load(f_sum_out)
-
-                    # retrieve the result
-                    is_error, res_obj = retriever.retrieve(
-                        query, repo_sum_obj, ret_logger)
-                    if is_error:
-                        raise Exception("An error occurred during retrieval.")
-
-                    # write result to file
-                    obj = {
-                        'id': data_obj['id'],
-                        'is_found': res_obj['is_found'],
-                        'is_query_expanded': res_obj['is_query_expanded'],
-                        'path': res_obj['path'],
-                        'ret_times': res_obj['ret_times'],
-                    }
-                    f_ret_result.write(json.dumps(obj) + '\n')
-                    f_ret_result.flush()
-
-            except Exception as e:
-                pipeline_logger.error(e)
-                pipeline_logger.warning(f'Stop at {idx + start_idx}')
-                break
+    # skip queries which already have a result
+    finished_ids = load_finished_ids(args.ret_result_file_path)
+    data_objs = [x for x in data_objs if x['id'] not in finished_ids]
+    pipeline_logger.info(
+        f"{len(finished_ids)} queries have been retrieved, {len(data_objs)} queries left.")
+
+    write_lock = threading.Lock()
+    error_count = 0
+
+    # one log for the run, appended when resuming, records are written by a background thread
+    ret_log_pipeline = AsyncLogPipeline(
+        "retrieval", args.ret_log_file_path, args.log_verbosity, mode="a")
+
+    def retrieve_one(data_obj: dict, repo_sum_obj: dict, f_ret_result):
+        # records of the query are labeled with its id
+        ret_logger = logging.LoggerAdapter(
+            ret_log_pipeline.logger, {'context': {'query_id': data_obj['id']}})
+
+        # retrieve the result
+        with metrics_context(query_id=data_obj['id']):
+            is_error, res_obj = get_retriever().retrieve(
+                data_obj['query'], repo_sum_obj, ret_logger)
+        if is_error:
+            raise Exception(
+                f"An error occurred during retrieval of query {data_obj['id']}.")
+
+        # write result to file, results are identified by id so the order does not matter
+        obj = {
+            'id': data_obj['id'],
+            'is_found': res_obj['is_found'],
+            'is_query_expanded': res_obj.get('is_query_expanded', False),
+            'path': res_obj['path'],
+            'ret_times': res_obj['ret_times'],
+            # serving cost: wall_time, llm_time, embedding_time, llm_call_count, backtrack_count, prompt_tokens, completion_tokens
+            **res_obj['cost'],
+        }
+        with write_lock:
+            f_ret_result.write(json.dumps(obj) + '\n')
+            f_ret_result.flush()
+
+    with open(args.ret_result_file_path, "a") as f_ret_result, \
+            ThreadPoolExecutor(max_workers=args.workers) as executor, \
+            tqdm(total=len(data_objs)) as pbar:
+        for repo_name, repo_data_objs in group_by_repo(data_objs).items():
+            sum_out_path = os.path.join(
+                args.sum_result_root_path, repo_name, f"sum_out_{repo_name}.json")
+            if not os.path.exists(sum_out_path):
+                pipeline_logger.error(
+                    f"Summary output path does not exist: {sum_out_path}")
+                error_count += len(repo_data_objs)
+                pbar.update(len(repo_data_objs))
+                continue
+
+            # load summary tree once for all queries of this repo
+            with open(sum_out_path, "r") as f_sum_out:
+                repo_sum_obj = json.load(f_sum_out)
+
+            futures = {
+                executor.submit(retrieve_one, data_obj, repo_sum_obj, f_ret_result): data_obj
+                for data_obj in repo_data_objs
+            }
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                except Exception as e:
+                    # failed queries have no result, they are retried when resuming
+                    pipeline_logger.error(e)
+                    error_count += 1
+                pbar.update(1)
+
+    ret_log_pipeline.close()
+    # recorded or replayed responses, see env LLM_CASSETTE_PATH
+    for stats in close_cassettes():
+        pipeline_logger.info(f"Cassette: {stats}")
+    metrics.write_prometheus(
+        os.path.splitext(args.ret_metrics_file_path)[0] + ".prom")
+    metrics.close()
+
+    if error_count != 0:
+        pipeline_logger.warning(
+            f"{error_count} queries failed, run again to retry them.")
 
     logging.shutdown()
@@ -2,29 +2,221 @@ import json
 import logging
 import os
 import sys
+import time
 from dotenv import load_dotenv
-from ie_client import IEClient
-from openai_client import OpenAIClient
-from summarizer import Summarizer
+from body_store import write_body_store
+from cassette import close_cassettes
+from generation_backend import GenerationBackend, create_backend, get_backend_name
+from log_pipeline import AsyncLogPipeline
+from metrics import MetricsRecorder
+from parse_cache import ParseCache
+from summarizer import Summarizer, count_no_summary, get_no_body_method_ids
 
 
-def parse_repo(repo_path, output_path) -> int:
-    return os.system(
-        f"java -jar ./java-repo-parser.jar -r={repo_path} -o={output_path}")
+def create_dir_text_sim_calculator():
+    '''Embedding model of fast tier directories, None if env SUM_FAST_DIR_DEPTHS selects no depth.'''
+    if os.getenv('SUM_FAST_DIR_DEPTHS', '') == '':
+        return None
+
+    from text_sim_calculator import TextSimCalculator
+    return TextSimCalculator()
+
+
+def summarize_one_repo(repo_obj: dict, method_backend: GenerationBackend, chat_backend: GenerationBackend,
+                       parse_cache: ParseCache, repo_root_path: str, result_root_path: str,
+                       text_sim_calculator=None, stream_parse: bool = None) -> dict:
+    '''
+        Parse a repo and build its summary tree, write results to its result directory.
+        text_sim_calculator: embeds directories of the fast tier, see Summarizer
+        stream_parse: summarize files while the repo is being parsed, default: env SUM_STREAM_PARSE
+        return: {node_count, token_used_count, gen_err_count, truncation_count, collapsed_request_count, pack_saved_request_count, pack_saved_token_count, extractive_dir_count, start_time, end_time}, None if already summarized.
+        raise Exception if error occurs.
+    '''
+    repo_name = repo_obj['repo'].split('/')[-1]
+    repo_path = os.path.join(
+        repo_root_path, f"{repo_name}-{repo_obj['sha']}")
+
+    result_dir_path = os.path.join(result_root_path, repo_name)
+    os.makedirs(result_dir_path, exist_ok=True)
+
+    parse_out_path = os.path.join(
+        result_dir_path, f"parse_out_{repo_name}.json")
+    sum_log_path = os.path.join(
+        result_dir_path, f"sum_log_{repo_name}.jsonl.gz")
+    sum_out_path = os.path.join(
+        result_dir_path, f"sum_out_{repo_name}.json")
+    body_store_path = os.path.join(
+        result_dir_path, f"bodies_{repo_name}.bin")
+    metrics_path = os.path.join(
+        result_dir_path, f"metrics_{repo_name}.jsonl")
+    prom_path = os.path.join(
+        result_dir_path, f"metrics_{repo_name}.prom")
+
+    # if repo was already summarized, skip it
+    if os.path.exists(sum_out_path):
+        return None
+
+    # check if existence of path
+    if not os.path.exists(repo_path):
+        raise Exception(f"Repo's path does not exist.")
+
+    if stream_parse == None:
+        stream_parse = os.getenv('SUM_STREAM_PARSE', '0').lower() in ('1', 'true')
+
+    start_time = time.time()
+
+    # create logger, records are written by a background thread
+    sum_log_pipeline = AsyncLogPipeline(sum_log_path, sum_log_path)
+
+    # record latency and tokens of each API call, labeled with node id
+    metrics = MetricsRecorder(metrics_path)
+    method_backend.metrics = metrics
+    chat_backend.metrics = metrics
+
+    try:
+        summarizer = Summarizer(
+            sum_log_pipeline.logger, method_backend, chat_backend, metrics,
+            text_sim_calculator=text_sim_calculator)
+
+        if stream_parse:
+            # summarize files as the parser emits them, the complete output is cached when parsing ends
+            result, parse_obj = summarizer.summarize_records(parse_cache.parse_stream(
+                repo_obj['repo'], repo_obj['sha'], repo_path))
+            parse_cache.materialize(
+                repo_obj['repo'], repo_obj['sha'], parse_out_path)
+        else:
+            # parse entire repo using java-repo-parser tool, reuse the output if it was parsed before
+            parse_cache.parse(repo_obj['repo'], repo_obj['sha'], repo_path)
+            parse_cache.materialize(
+                repo_obj['repo'], repo_obj['sha'], parse_out_path)
+
+            # build summary tree for entire repo
+            with open(parse_out_path, "r") as f_parse_out:
+                parse_obj = json.loads(f_parse_out.read())
+                result = summarizer.summarize_repo(parse_obj)
+
+        # method bodies are kept out of the summary tree, consumers of code read them by method id
+        write_body_store(parse_obj, body_store_path)
+
+        # write result to file, rename to make sure no partial file is left
+        temp_sum_out_path = f"{sum_out_path}.tmp"
+        with open(temp_sum_out_path, "w") as f_sum_out:
+            f_sum_out.write(json.dumps(result))
+        os.replace(temp_sum_out_path, sum_out_path)
+    finally:
+        sum_log_pipeline.close()
+
+        method_backend.metrics = None
+        chat_backend.metrics = None
+        metrics.write_prometheus(prom_path)
+        metrics.close()
+
+    return {
+        'node_count': parse_obj['nodeCount'],
+        'token_used_count': summarizer.token_used_count,
+        'gen_err_count': summarizer.gen_err_count,
+        'truncation_count': summarizer.truncation_count,
+        'collapsed_request_count': summarizer.single_flight.collapsed_count,
+        'pack_saved_request_count': summarizer.packed_method_count - summarizer.pack_request_count,
+        'pack_saved_token_count': summarizer.pack_saved_token_count,
+        'extractive_dir_count': summarizer.extractive_dir_count,
+        'start_time': start_time,
+        'end_time': time.time(),
+    }
+
+
+def repair_one_repo(repo_obj: dict, method_backend: GenerationBackend, chat_backend: GenerationBackend,
+                    result_root_path: str, text_sim_calculator=None) -> dict:
+    '''
+        Summarize again the nodes without summary in the summary tree of a repo, and their ancestors,
+        replace the summary tree when done. The log of the repo is appended.
+        return: {no_summary_count_before, no_summary_count_after, no_body_method_count, reused_node_count, token_used_count,
+                 gen_err_count, start_time, end_time}, None if not summarized yet.
+        Methods without body never have summary, they are counted in no_body_method_count only.
+        raise Exception if error occurs.
+    '''
+    repo_name = repo_obj['repo'].split('/')[-1]
+    result_dir_path = os.path.join(result_root_path, repo_name)
+
+    parse_out_path = os.path.join(
+        result_dir_path, f"parse_out_{repo_name}.json")
+    sum_log_path = os.path.join(
+        result_dir_path, f"sum_log_{repo_name}.jsonl.gz")
+    sum_out_path = os.path.join(
+        result_dir_path, f"sum_out_{repo_name}.json")
+    metrics_path = os.path.join(
+        result_dir_path, f"repair_metrics_{repo_name}.jsonl")
+    prom_path = os.path.join(
+        result_dir_path, f"repair_metrics_{repo_name}.prom")
+
+    if not os.path.exists(sum_out_path):
+        return None
+    # node ids of the summary tree are those of its parse tree
+    if not os.path.exists(parse_out_path):
+        raise Exception(f"Parse output does not exist: {parse_out_path}")
+
+    start_time = time.time()
+
+    with open(parse_out_path, "r") as f_parse_out:
+        parse_obj = json.load(f_parse_out)
+    no_body_method_ids = get_no_body_method_ids(parse_obj['mainDirectory'])
+
+    with open(sum_out_path, "r") as f_sum_out:
+        repo_sum_obj = json.load(f_sum_out)
+    no_summary_count_before = count_no_summary(repo_sum_obj, no_body_method_ids)
+
+    sum_log_pipeline = AsyncLogPipeline(sum_log_path, sum_log_path, mode="a")
+    metrics = MetricsRecorder(metrics_path)
+    method_backend.metrics = metrics
+    chat_backend.metrics = metrics
+
+    try:
+        summarizer = Summarizer(
+            sum_log_pipeline.logger, method_backend, chat_backend, metrics,
+            text_sim_calculator=text_sim_calculator)
+        result = summarizer.repair_repo(parse_obj, repo_sum_obj)
+
+        # replace the summary tree at once, an interrupted repair leaves the previous one
+        temp_sum_out_path = f"{sum_out_path}.tmp"
+        with open(temp_sum_out_path, "w") as f_sum_out:
+            f_sum_out.write(json.dumps(result))
+        os.replace(temp_sum_out_path, sum_out_path)
+    finally:
+        sum_log_pipeline.close()
+
+        method_backend.metrics = None
+        chat_backend.metrics = None
+        metrics.write_prometheus(prom_path)
+        metrics.close()
+
+    return {
+        'no_summary_count_before': no_summary_count_before,
+        'no_summary_count_after': count_no_summary(result, no_body_method_ids),
+        'no_body_method_count': len(no_body_method_ids),
+        'reused_node_count': summarizer.reused_node_count,
+        'token_used_count': summarizer.token_used_count,
+        'gen_err_count': summarizer.gen_err_count,
+        'start_time': start_time,
+        'end_time': time.time(),
+    }
 
 
 if __name__ == "__main__":
-    if len(sys.argv) != 3:
-        print("Usage: python run_eval_sum.py <start_idx> <end_idx>")
+    if len(sys.argv) not in (3, 4) or (len(sys.argv) == 4 and sys.argv[3] != "repair"):
+        print("Usage: python run_eval_sum.py <start_idx> <end_idx> [repair]")
+        print("repair: summarize again only the nodes without summary in existing summary trees")
         exit(1)
     start_idx = int(sys.argv[1])
     end_idx = int(sys.argv[2])
+    is_repair = len(sys.argv) == 4
 
     load_dotenv()
 
     repo_root_path = "./eval_data/repo"
     repo_list_file_path = "./eval_data/filtered/repo_final.json"
     result_root_path = "./eval_data/sum_result"
+    parse_cache_root_path = "./eval_data/parse_cache"
+    parser_jar_path = "./java-repo-parser.jar"
 
     if not os.path.exists(result_root_path):
         os.mkdir(result_root_path)
@@ -34,13 +226,15 @@ if __name__ == "__main__":
                         datefmt='%m/%d/%Y %H:%M:%S')
     pipeline_logger = logging.getLogger("pipeline")
 
-    # create clients
+    # create generation backends, selected by env METHOD_BACKEND and CHAT_BACKEND
     try:
-        ie_client = IEClient()
-        openie_client = OpenAIClient()
+        method_backend = create_backend(get_backend_name('method', 'ie'))
+        chat_backend = create_backend(get_backend_name('chat', 'openai'))
+        parse_cache = ParseCache(parse_cache_root_path, parser_jar_path)
+        text_sim_calculator = create_dir_text_sim_calculator()
 
-        if not ie_client.check_health():
-            raise Exception("Inference Endpoints is not available.")
+        if not method_backend.check_health():
+            raise Exception("Generation backend of methods is not available.")
     except Exception as e:
         pipeline_logger.error(e)
         exit(1)
@@ -51,54 +245,33 @@ if __name__ == "__main__":
         for idx, repo_obj in enumerate(repo_objs[start_idx:end_idx]):
             try:
                 repo_name = repo_obj['repo'].split('/')[-1]
-                repo_path = os.path.join(
-                    repo_root_path, f"{repo_name}-{repo_obj['sha']}")
-
-                result_dir_path = os.path.join(result_root_path, repo_name)
 
-                if not os.path.exists(result_dir_path):
-                    os.mkdir(result_dir_path)
-
-                parse_out_path = os.path.join(
-                    result_dir_path, f"parse_out_{repo_name}.json")
-                sum_log_path = os.path.join(
-                    result_dir_path, f"sum_log_{repo_name}.txt")
-                sum_out_path = os.path.join(
-                    result_dir_path, f"sum_out_{repo_name}.json")
-
-                # if repo was already summarized, skip it
-                if os.path.exists(sum_out_path):
+                if is_repair:
                     pipeline_logger.info(
-                        f"{idx + start_idx}th repo: {repo_name} has been summarized.")
+                        f"Repairing {idx + start_idx}th repo: {repo_name}...")
+                    stats = repair_one_repo(
+                        repo_obj, method_backend, chat_backend, result_root_path, text_sim_calculator)
+                    if stats == None:
+                        pipeline_logger.info(
+                            f"{idx + start_idx}th repo: {repo_name} has not been summarized.")
+                    else:
+                        pipeline_logger.info(
+                            f"Finished repairing {idx + start_idx}th repo: {repo_name}, failed nodes: "
+                            f"{stats['no_summary_count_before']} -> {stats['no_summary_count_after']}, "
+                            f"methods without body: {stats['no_body_method_count']}")
                     continue
 
-                # create logger
-                sum_logger = logging.getLogger(sum_log_path)
-                sum_logger.addHandler(
-                    logging.FileHandler(sum_log_path, "w", "utf-8")
-                )
-                sum_logger.propagate = False  # prevent printing to console
-
                 pipeline_logger.info(
                     f"Summarizing {idx + start_idx}th repo: {repo_name}...")
 
-                # check if existence of path
-                if not os.path.exists(repo_path):
-                    raise Exception(f"Repo's path does not exist.")
-
-                # parse entire repo using java-repo-parser tool
-                if (0 != parse_repo(repo_path, parse_out_path)):
-                    raise Exception("Failed to parse repo.")
+                stats = summarize_one_repo(
+                    repo_obj, method_backend, chat_backend, parse_cache, repo_root_path, result_root_path,
+                    text_sim_calculator)
 
-                # build summary tree for entire repo
-                summarizer = Summarizer(sum_logger, ie_client, openie_client)
-                with open(parse_out_path, "r") as f_parse_out:
-                    repo_obj = json.loads(f_parse_out.read())
-                    result = summarizer.summarize_repo(repo_obj)
-
-                    # write result to file
-                    with open(sum_out_path, "w") as f_sum_out:
-                        f_sum_out.write(json.dumps(result))
+                if stats == None:
+                    pipeline_logger.info(
+                        f"{idx + start_idx}th repo: {repo_name} has been summarized.")
+                    continue
 
                 pipeline_logger.info(
                     f"Finished summarizing {idx + start_idx}th repo: {repo_name}")
@@ -108,4 +281,8 @@ if __name__ == "__main__":
                 pipeline_logger.warning(f'Stop at {idx + start_idx}')
                 break
 
+    # recorded or replayed responses, see env LLM_CASSETTE_PATH
+    for stats in close_cassettes():
+        pipeline_logger.info(f"Cassette: {stats}")
+
     logging.shutdown()
@@ -0,0 +1,175 @@
+import argparse
+import json
+import logging
+import os
+import socket
+from multiprocessing import Process
+from dotenv import load_dotenv
+
+from generation_backend import create_backend, get_backend_name
+from parse_cache import ParseCache
+from run_eval_sum import create_dir_text_sim_calculator, summarize_one_repo
+from work_queue import FileSemaphore, WorkQueue
+
+
+def get_repo_name(repo_obj: dict) -> str:
+    return repo_obj['repo'].split('/')[-1]
+
+
+def load_repo_objs(args) -> list:
+    with open(args.repo_list_file_path, "r") as f_repo_list:
+        repo_objs = json.load(f_repo_list)
+
+    return repo_objs[args.start_idx:args.end_idx]
+
+
+def run_worker(worker_name: str, args):
+    '''Claim repos from the shared work directory and summarize them until none is left.'''
+    load_dotenv()
+
+    logging.basicConfig(level=logging.INFO,
+                        format='%(name)s - %(asctime)s - %(levelname)s - %(message)s',
+                        datefmt='%m/%d/%Y %H:%M:%S')
+    pipeline_logger = logging.getLogger(worker_name)
+
+    # create generation backends, concurrent requests are bounded across all workers
+    try:
+        method_backend = create_backend(get_backend_name('method', 'ie'))
+        chat_backend = create_backend(get_backend_name('chat', 'openai'))
+        parse_cache = ParseCache(
+            args.parse_cache_root_path, args.parser_jar_path)
+        text_sim_calculator = create_dir_text_sim_calculator()
+
+        if not method_backend.check_health():
+            raise Exception("Generation backend of methods is not available.")
+    except Exception as e:
+        pipeline_logger.error(e)
+        return
+
+    slot_dir_path = os.path.join(args.work_dir, "slots")
+    ie_concurrency = args.ie_concurrency if args.ie_concurrency > 0 else method_backend.max_batch_size
+    method_backend.limiter = FileSemaphore(
+        os.path.join(slot_dir_path, "ie"), ie_concurrency)
+    chat_backend.limiter = FileSemaphore(
+        os.path.join(slot_dir_path, "openai"), args.openai_concurrency)
+
+    repo_objs = load_repo_objs(args)
+    repo_dict = {get_repo_name(repo_obj): repo_obj for repo_obj in repo_objs}
+    work_queue = WorkQueue(args.work_dir, list(repo_dict.keys()),
+                           args.max_attempts)
+
+    while True:
+        repo_name = work_queue.claim()
+        if repo_name == None:
+            break
+
+        try:
+            pipeline_logger.info(f"Summarizing repo: {repo_name}...")
+            stats = summarize_one_repo(repo_dict[repo_name], method_backend, chat_backend, parse_cache,
+                                       args.repo_root_path, args.result_root_path, text_sim_calculator)
+            if stats == None:
+                stats = {'skipped': True}
+            work_queue.complete(repo_name, stats)
+            pipeline_logger.info(f"Finished summarizing repo: {repo_name}")
+        except Exception as e:
+            # record the failure, the repo will be retried after pending repos
+            pipeline_logger.error(f"Failed to summarize repo: {repo_name}\n{e}")
+            work_queue.fail(repo_name, str(e))
+
+    logging.shutdown()
+
+
+def report(args):
+    '''Print status counts and aggregate throughput of all workers.'''
+    repo_objs = load_repo_objs(args)
+    work_queue = WorkQueue(args.work_dir, [get_repo_name(repo_obj) for repo_obj in repo_objs],
+                           args.max_attempts)
+    statuses = work_queue.get_statuses()
+
+    done_stats = [status['stats'] for status in statuses
+                  if status != None and status['status'] == 'done' and 'skipped' not in status['stats']]
+    failed_statuses = [status for status in statuses
+                       if status != None and status['status'] == 'failed']
+
+    print(f"Done: {len([x for x in statuses if x != None and x['status'] == 'done'])}")
+    print(f"Failed: {len(failed_statuses)} "
+          f"(gave up: {len([x for x in failed_statuses if x['attempts'] >= args.max_attempts])})")
+    print(f"Pending: {len([x for x in statuses if x == None])}")
+    for status in failed_statuses:
+        print(f"\t{status['key']} ({status['attempts']} attempts): {status['error']}")
+
+    if len(done_stats) == 0:
+        return
+
+    node_count = sum(x['node_count'] for x in done_stats)
+    token_used_count = sum(x['token_used_count'] for x in done_stats)
+    wall_time = max(x['end_time'] for x in done_stats) - \
+        min(x['start_time'] for x in done_stats)
+    repo_time = sum(x['end_time'] - x['start_time'] for x in done_stats)
+
+    print(f"Summarized nodes: {node_count}")
+    print(f"Tokens used: {token_used_count}")
+    print(f"Generation errors: {sum(x['gen_err_count'] for x in done_stats)}")
+    print(
+        f"Collapsed requests: {sum(x.get('collapsed_request_count', 0) for x in done_stats)}")
+    print(f"Requests saved by packing: {sum(x.get('pack_saved_request_count', 0) for x in done_stats)}, "
+          f"prompt tokens saved: {sum(x.get('pack_saved_token_count', 0) for x in done_stats)}")
+    print(f"Wall time: {round(wall_time, 2)}s, total repo time: {round(repo_time, 2)}s")
+    print(f"Throughput: {round(node_count / wall_time, 2)} nodes/s, "
+          f"{round(token_used_count / wall_time, 2)} tokens/s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Summarize repos with several worker processes. "
+        "Run it on several machines with the same --work_dir on a shared file system to distribute further.")
+
+    parser.add_argument('--start_idx', default=0, type=int)
+    parser.add_argument('--end_idx', default=None, type=int)
+    parser.add_argument('--workers', default=4, type=int)
+    parser.add_argument('--max_attempts', default=3, type=int)
+    parser.add_argument('--ie_concurrency', default=0, type=int,
+                        help='max concurrent requests to Inference Endpoints across all workers, '
+                        '0 to use IE_MAX_BATCH_SIZE')
+    parser.add_argument('--openai_concurrency', default=8, type=int,
+                        help='max concurrent requests to OpenAI across all workers')
+    parser.add_argument('--work_dir', default="./eval_data/sum_work", type=str)
+    parser.add_argument('--repo_root_path',
+                        default="./eval_data/repo", type=str)
+    parser.add_argument('--repo_list_file_path',
+                        default="./eval_data/filtered/repo_final.json", type=str)
+    parser.add_argument('--result_root_path',
+                        default="./eval_data/sum_result", type=str)
+    parser.add_argument('--parse_cache_root_path',
+                        default="./eval_data/parse_cache", type=str)
+    parser.add_argument('--parser_jar_path',
+                        default="./java-repo-parser.jar", type=str)
+    parser.add_argument('--parse_workers', default=0, type=int,
+                        help='parse all repos with this many concurrent parsers before summarizing, 0 to parse on demand')
+    parser.add_argument('--report', action='store_true',
+                        help='only print status and throughput')
+    args = parser.parse_args()
+
+    if not args.report:
+        os.makedirs(args.result_root_path, exist_ok=True)
+
+        if args.parse_workers > 0:
+            parse_cache = ParseCache(
+                args.parse_cache_root_path, args.parser_jar_path)
+            parse_cache.parse_many([
+                (repo_obj['repo'], repo_obj['sha'], os.path.join(
+                    args.repo_root_path, f"{get_repo_name(repo_obj)}-{repo_obj['sha']}"))
+                for repo_obj in load_repo_objs(args)
+            ], args.parse_workers)
+
+        workers = []
+        for idx in range(args.workers):
+            worker = Process(target=run_worker,
+                             args=(f"{socket.gethostname()}-worker-{idx}", args))
+            worker.start()
+            workers.append(worker)
+
+        for worker in workers:
+            worker.join()
+
+    report(args)
@@ -0,0 +1,146 @@
+import os
+from typing import Callable, Tuple
+import torch
+
+
+SIM_BACKENDS = ['eager', 'torchscript', 'onnx']
+
+
+class MeanPoolingEmbedder(torch.nn.Module):
+    '''Sentence embedding of a transformer by mean pooling and normalization, same as all-MiniLM-L6-v2.'''
+
+    def __init__(self, transformer):
+        super().__init__()
+        self.transformer = transformer
+
+    def forward(self, input_ids: torch.Tensor, attention_mask: torch.Tensor) -> torch.Tensor:
+        output = self.transformer(input_ids=input_ids, attention_mask=attention_mask,
+                                  return_dict=False)[0]
+        mask = attention_mask.unsqueeze(-1).to(output.dtype)
+        embeds = (output * mask).sum(dim=1) / mask.sum(dim=1).clamp(min=1e-9)
+        return torch.nn.functional.normalize(embeds, dim=-1)
+
+
+class BimodalEmbedder(torch.nn.Module):
+    '''Text / code embedding of CodeT5+ bimodal model: encoder + projection of the first token.'''
+
+    def __init__(self, model):
+        super().__init__()
+        self.encoder = model.encoder
+        self.proj = model.proj
+
+    def forward(self, input_ids: torch.Tensor, attention_mask: torch.Tensor) -> torch.Tensor:
+        output = self.encoder(input_ids, attention_mask=attention_mask,
+                              return_dict=False)[0]
+        return torch.nn.functional.normalize(self.proj(output[:, 0, :]), dim=-1)
+
+
+def get_backend_config(backend: str = None, quantize: bool = None) -> Tuple[str, bool]:
+    '''Fill unspecified backend config from .env, default to eager PyTorch without quantization.'''
+    if backend == None:
+        backend = os.getenv('SIM_BACKEND', 'eager')
+    if quantize == None:
+        quantize = os.getenv('SIM_QUANTIZE', 'false').lower() == 'true'
+
+    if backend not in SIM_BACKENDS:
+        raise Exception(
+            f"Unknown similarity backend: {backend}, available: {SIM_BACKENDS}")
+
+    return backend, quantize
+
+
+def _quantize_module(module: torch.nn.Module) -> torch.nn.Module:
+    '''Int8 dynamic quantization of linear layers.'''
+    return torch.quantization.quantize_dynamic(
+        module, {torch.nn.Linear}, dtype=torch.qint8)
+
+
+def _create_eager_backend(module: torch.nn.Module, quantize: bool) -> Callable:
+    if quantize:
+        module = _quantize_module(module)
+
+    @torch.inference_mode()
+    def embed(input_ids, attention_mask):
+        return module(input_ids, attention_mask)
+
+    return embed
+
+
+def _create_torchscript_backend(module: torch.nn.Module, example_inputs: tuple, quantize: bool) -> Callable:
+    if quantize:
+        module = _quantize_module(module)
+
+    with torch.no_grad():
+        traced = torch.jit.trace(module, example_inputs, strict=False)
+        traced = torch.jit.freeze(traced)
+
+    @torch.inference_mode()
+    def embed(input_ids, attention_mask):
+        return traced(input_ids, attention_mask)
+
+    return embed
+
+
+def _create_onnx_backend(module: torch.nn.Module, example_inputs: tuple, name: str,
+                         cache_dir: str, quantize: bool) -> Callable:
+    try:
+        import onnxruntime
+    except ImportError:
+        raise Exception("onnxruntime is required for the onnx backend.")
+
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+
+    # export once, reuse the exported model afterwards
+    model_path = os.path.join(cache_dir, f"{name}.onnx")
+    if not os.path.exists(model_path):
+        with torch.no_grad():
+            torch.onnx.export(module, example_inputs, model_path,
+                              input_names=['input_ids', 'attention_mask'],
+                              output_names=['embeds'],
+                              dynamic_axes={
+                                  'input_ids': {0: 'batch', 1: 'sequence'},
+                                  'attention_mask': {0: 'batch', 1: 'sequence'},
+                                  'embeds': {0: 'batch'},
+                              },
+                              opset_version=14)
+
+    if quantize:
+        from onnxruntime.quantization import quantize_dynamic, QuantType
+
+        quantized_model_path = os.path.join(cache_dir, f"{name}-int8.onnx")
+        if not os.path.exists(quantized_model_path):
+            quantize_dynamic(model_path, quantized_model_path,
+                             weight_type=QuantType.QInt8)
+        model_path = quantized_model_path
+
+    options = onnxruntime.SessionOptions()
+    options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+    session = onnxruntime.InferenceSession(
+        model_path, options, providers=['CPUExecutionProvider'])
+
+    def embed(input_ids, attention_mask):
+        embeds = session.run(['embeds'], {
+            'input_ids': input_ids.cpu().numpy().astype('int64'),
+            'attention_mask': attention_mask.cpu().numpy().astype('int64'),
+        })[0]
+        return torch.from_numpy(embeds)
+
+    return embed
+
+
+def create_embed_backend(module: torch.nn.Module, name: str, example_inputs: tuple,
+                         backend: str = 'eager', quantize: bool = False,
+                         cache_dir: str = "./sim_backend_cache") -> Callable:
+    '''
+        Wrap an embedding module(input_ids, attention_mask) -> embeddings into a CPU inference backend.
+        return: embed(input_ids, attention_mask) -> embeddings
+    '''
+    module = module.cpu().eval()
+
+    if backend == 'torchscript':
+        return _create_torchscript_backend(module, example_inputs, quantize)
+    elif backend == 'onnx':
+        return _create_onnx_backend(module, example_inputs, name, cache_dir, quantize)
+
+    return _create_eager_backend(module, quantize)
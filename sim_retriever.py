@@ -1,12 +1,17 @@
 import logging
+import time
 from typing import Tuple
+from constants import RET_LEXICAL_WEIGHT
+from lexical_index import HybridSimilarityMixin
 from text_sim_calculator import TextSimCalculator
 
 
-class SimRetriever:
-    def __init__(self, text_sim_calculator: TextSimCalculator):
+class SimRetriever(HybridSimilarityMixin):
+    def __init__(self, text_sim_calculator: TextSimCalculator, lexical_weight: float = RET_LEXICAL_WEIGHT):
         self.text_sim_calculator = text_sim_calculator
 
+        self._init_lexical_index(lexical_weight)
+
     def _retrieve_in_file(self, file_sum_obj: dict):
         '''Retrieve the method according to its description and the summary of the class.'''
         # get information list of method
@@ -19,13 +24,7 @@ class SimRetriever:
             })
 
         # calculate similarity, and sort infos according to similarity
-        summaries = [info['summary'] for info in infos]
-        similarities = self.text_sim_calculator.calc_similarities(
-            self.query, summaries)
-
-        for i, info in enumerate(infos):
-            info['similarity'] = similarities[i]
-        infos.sort(key=lambda x: x['similarity'], reverse=True)
+        self._sort_by_similarity(infos)
 
         # select the method with the highest similarity
         self.ret_times += 1
@@ -40,6 +39,7 @@ class SimRetriever:
                 'id': sub_dir_sum_obj['id'],
                 'name': sub_dir_sum_obj['name'],
                 'summary': sub_dir_sum_obj['summary'],
+                'embedding': sub_dir_sum_obj.get('embedding'),
             })
 
         for file_sum_obj in dir_sum_obj['files']:
@@ -50,13 +50,7 @@ class SimRetriever:
             })
 
         # calculate similarity, and sort infos according to similarity
-        summaries = [info['summary'] for info in infos]
-        similarities = self.text_sim_calculator.calc_similarities(
-            self.query, summaries)
-
-        for i, info in enumerate(infos):
-            info['similarity'] = similarities[i]
-        infos.sort(key=lambda x: x['similarity'], reverse=True)
+        self._sort_by_similarity(infos)
 
         # select the subdirectory or file with the highest similarity
         infer_id = infos[0]['id']
@@ -82,13 +76,16 @@ class SimRetriever:
     def retrieve(self, query: str, repo_sum_obj: dict, logger: logging.Logger) -> Tuple[bool, dict]:
         '''
             Retrieve the method according to its description and the summary of the entire repo.
-            return (is_error: bool, {is_found: bool, path: List[str], ret_times: int}).
+            return (is_error: bool, {is_found: bool, path: List[str], ret_times: int, cost: dict}), cost as of Retriever.
         '''
+        start_time = time.time()
         self.query = query
         self.logger = logger
+        self._load_lexical_index(repo_sum_obj)
 
         self.result_path = []
         self.ret_times = 0
+        self.embedding_time = 0.0
 
         self._retrieve_in_dir(repo_sum_obj)
         self.result_path.reverse()
@@ -97,4 +94,13 @@ class SimRetriever:
             'is_found': True,
             'path': self.result_path,
             'ret_times': self.ret_times,
+            'cost': {
+                'wall_time': round(time.time() - start_time, 4),
+                'llm_time': 0.0,
+                'embedding_time': round(self.embedding_time, 4),
+                'llm_call_count': 0,
+                'backtrack_count': 0,
+                'prompt_tokens': 0,
+                'completion_tokens': 0,
+            },
         }
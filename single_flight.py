@@ -0,0 +1,68 @@
+import hashlib
+import threading
+from concurrent.futures import Future
+from typing import Callable, Tuple
+
+
+def get_request_key(*parts) -> str:
+    '''Key of a request made of its parts, e.g. the prompt and max output length.'''
+    hasher = hashlib.sha1()
+    for part in parts:
+        hasher.update(str(part).encode())
+        hasher.update(b"\0")
+
+    return hasher.hexdigest()
+
+
+class SingleFlight:
+    '''
+        Calls with the same key share one execution:
+        a call whose key is in flight waits for it, a call whose key has completed reuses its result.
+        Failed executions are not kept, so a later call with the same key executes again.
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.futures = {}  # key -> Future
+
+        self.inflight_join_count = 0  # calls that waited for an execution in flight
+        self.completed_hit_count = 0  # calls that reused a completed execution
+
+    @property
+    def collapsed_count(self) -> int:
+        return self.inflight_join_count + self.completed_hit_count
+
+    def fork(self):
+        '''New SingleFlight which starts with the completed results of this one, and shares nothing later.'''
+        single_flight = SingleFlight()
+        with self.lock:
+            single_flight.futures = {key: future for key, future in self.futures.items()
+                                     if future.done()}
+
+        return single_flight
+
+    def do(self, key: str, fn: Callable) -> Tuple[object, bool]:
+        '''
+            return: (result of fn, is_shared), is_shared is True if fn was executed by another call.
+            raise the exception of fn if the execution failed.
+        '''
+        with self.lock:
+            future = self.futures.get(key)
+            is_owner = future == None
+            if is_owner:
+                future = Future()
+                self.futures[key] = future
+            elif future.done():
+                self.completed_hit_count += 1
+            else:
+                self.inflight_join_count += 1
+
+        if is_owner:
+            try:
+                future.set_result(fn())
+            except Exception as e:
+                with self.lock:
+                    del self.futures[key]
+                future.set_exception(e)
+
+        return future.result(), not is_owner
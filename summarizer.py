@@ -1,90 +1,228 @@
 from concurrent.futures import ThreadPoolExecutor
 import logging
+import os
+import re
 import time
-from typing import List
-import tiktoken
+from typing import Iterable, List, Tuple
 from tqdm import tqdm
-from transformers import CodeLlamaTokenizer
 
-from ie_client import IEClient
-from constants import INPUT_SEPARATOR, LOG_SEPARATOR, NO_SUMMARY, SUM_DIR, SUM_FILE, SUM_METHOD
-from openai_client import OpenAIClient
+from constants import INPUT_SEPARATOR, NO_SUMMARY, SUM_DIR, SUM_DIR_EXTRACTIVE, SUM_FILE, SUM_METHOD, SUM_METHOD_PACKED
+from context_packer import ContextPacker, encode_info
+from generation_backend import GenerationBackend
+from log_pipeline import LogEvent
+from metrics import MetricsRecorder, metrics_context
+from parse_stream import ParseTreeBuilder
+from single_flight import SingleFlight, get_request_key
+
+
+# a line of packed output, e.g. "2: Returns the ..." or "Method 2: Returns the ..."
+PACKED_OUTPUT_PATTERN = re.compile(r'^\s*(?:Method\s*)?(\d+)\s*[:.)]\s*(.*\S)')
+
+
+def is_depth_selected(depth_spec: str, depth: int) -> bool:
+    '''depth_spec: comma-separated depths, "<N>+" selects N and deeper, e.g. "0,3+", the root is at depth 0'''
+    for part in depth_spec.split(','):
+        part = part.strip()
+        if part.endswith('+') and depth >= int(part[:-1]):
+            return True
+        if part != "" and not part.endswith('+') and depth == int(part):
+            return True
+
+    return False
+
+
+def get_first_sentence(text: str, max_length: int) -> str:
+    '''First sentence of text, cut at max_length words.'''
+    match = re.match(r'(.+?[.!?])(\s|$)', text, re.DOTALL)
+    sentence = match.group(1) if match else text
+    words = sentence.split()
+    if len(words) > max_length:
+        return " ".join(words[:max_length]) + " ..."
+
+    return " ".join(words)
+
+
+def index_sum_nodes(dir_node: dict, index: dict = None) -> dict:
+    '''return: {node id: node} of directories, files and methods in a summary tree'''
+    if index == None:
+        index = {}
+
+    index[dir_node['id']] = dir_node
+    for sub_dir_node in dir_node['subdirectories']:
+        index_sum_nodes(sub_dir_node, index)
+    for file_node in dir_node['files']:
+        index[file_node['id']] = file_node
+        for method_node in file_node['methods']:
+            index[method_node['id']] = method_node
+
+    return index
+
+
+def get_no_body_method_ids(dir_obj: dict, ids: set = None) -> set:
+    '''return: ids of methods without body in a parse tree, they are never summarized'''
+    if ids == None:
+        ids = set()
+
+    for sub_dir_obj in dir_obj['subdirectories']:
+        get_no_body_method_ids(sub_dir_obj, ids)
+    for file_obj in dir_obj['files']:
+        ids.update(x['id'] for x in file_obj['methods'] if x['body'] == "")
+
+    return ids
+
+
+def count_no_summary(dir_node: dict, no_body_method_ids: set = None) -> int:
+    '''
+        Number of nodes without summary in a summary tree.
+        no_body_method_ids: methods not counted, e.g. get_no_body_method_ids of the parse tree,
+            so the count is of failed nodes only
+    '''
+    if no_body_method_ids == None:
+        no_body_method_ids = set()
+
+    return sum(x['summary'] == NO_SUMMARY and node_id not in no_body_method_ids
+               for node_id, x in index_sum_nodes(dir_node).items())
 
 
 class Summarizer:
-    def __init__(self, logger: logging.Logger, ie_client: IEClient, openai_client: OpenAIClient):
+    def __init__(self, logger: logging.Logger, method_backend: GenerationBackend, chat_backend: GenerationBackend,
+                 metrics: MetricsRecorder = None, pack_methods: bool = None,
+                 fast_dir_depths: str = None, text_sim_calculator=None):
+        '''
+            method_backend: completes raw prompts of method summarization, e.g. CodeLlama on Inference Endpoints
+            chat_backend: summarizes files and directories, e.g. GPT
+            fast_dir_depths: depths of directories summarized without GPT, e.g. "2+", see is_depth_selected,
+                default: env SUM_FAST_DIR_DEPTHS, none if empty
+            text_sim_calculator: embeds child summaries of fast tier directories, their embeddings are not stored if None
+        '''
         self.logger = logger
-        self.codellama_tokenizer = CodeLlamaTokenizer.from_pretrained(
-            ie_client.model_name)
-        self.openai_tokenizer = tiktoken.encoding_for_model(
-            openai_client.model_name)
+        # records of API calls are labeled with the node they are made for
+        self.metrics = metrics
 
-        self.ie_client = ie_client
-        self.openai_client = openai_client
+        self.method_backend = method_backend
+        self.chat_backend = chat_backend
+        # fits summaries of children into prompts of files and directories
+        self.context_packer = ContextPacker(chat_backend)
 
         self.gen_err_count = 0  # number of generation error
         self.total_ignore_count = 0  # number of ignored nodes
         self.truncation_count = 0  # number of truncated nodes
         self.token_used_count = 0  # number of tokens used in openai
 
-        self.CODELLAMA_SPECIAL_TOKEN_NUM = 30
+        # identical prompts in this run share one generation, e.g. copy-pasted method bodies
+        self.single_flight = SingleFlight()
 
-    def _is_legal_gpt_input(self, system_input_text: str, user_input_text: str, max_output_length: int) -> bool:
-        '''Check if the input text length exceeds the model limit.'''
-        encoded_text = self.openai_tokenizer.encode(
-            system_input_text + user_input_text)
+        # summarize small methods of one class in one request, default: env SUM_PACK_METHODS
+        if pack_methods == None:
+            pack_methods = os.getenv('SUM_PACK_METHODS', '0').lower() in ('1', 'true')
+        self.pack_methods = pack_methods
+        self.pack_request_count = 0  # number of packed requests answered in the expected format
+        self.packed_method_count = 0  # number of methods summarized by packed requests
+        self.pack_fallback_count = 0  # number of methods summarized alone since their pack failed
+        self.pack_saved_token_count = 0  # number of prompt tokens not repeated thanks to packing
+        self.single_method_prompt_length = None
+
+        if fast_dir_depths == None:
+            fast_dir_depths = os.getenv('SUM_FAST_DIR_DEPTHS', '')
+        self.fast_dir_depths = fast_dir_depths
+        self.text_sim_calculator = text_sim_calculator
+        self.extractive_dir_count = 0  # number of directories summarized without GPT
 
-        return len(encoded_text) <= self.openai_client.max_number_of_tokens - max_output_length
+        # repair mode: {node id: node} of the previous summary tree, whose valid summaries are reused
+        self.previous_nodes = None
+        self.reused_node_count = 0  # number of nodes whose previous summary is reused
+
+        # {file id: file node} summarized while the repo was being parsed, see summarize_records
+        self.streamed_file_nodes = {}
+
+        self.CODELLAMA_SPECIAL_TOKEN_NUM = method_backend.PROMPT_SPECIAL_TOKEN_NUM
 
     def _is_legal_codellama_input(self, system_input_text: str, user_input_text: str, max_output_length: int) -> bool:
         '''Check if the input text length is less than model limit.'''
-        encoded = self.codellama_tokenizer.encode(
-            system_input_text + user_input_text,
-            add_special_tokens=False, padding=False, truncation=False)
+        input_length = self._get_codellama_length(
+            system_input_text + user_input_text)
 
-        return len(encoded) <= self.ie_client.max_number_of_tokens - self.CODELLAMA_SPECIAL_TOKEN_NUM - max_output_length
+        return input_length <= self.method_backend.max_number_of_tokens - self.CODELLAMA_SPECIAL_TOKEN_NUM - max_output_length
 
     def _build_codellama_input(self, node_id: int, system_input_text: str, user_input_text: str, max_output_length: int) -> str:
         '''Concat promp and context, add special tokens, truncate if exceeds the token limit'''
         if not self._is_legal_codellama_input(system_input_text, user_input_text, max_output_length):
-            encoded_system_input = self.codellama_tokenizer.encode(
-                system_input_text,
-                add_special_tokens=False,
-                padding=False, truncation=False
-            )
-            max_user_input_length = self.ie_client.max_number_of_tokens - len(encoded_system_input) - \
+            max_user_input_length = self.method_backend.max_number_of_tokens - \
+                self._get_codellama_length(system_input_text) - \
                 self.CODELLAMA_SPECIAL_TOKEN_NUM - max_output_length
-            encoded_user_input = self.codellama_tokenizer.encode(
-                user_input_text,
-                add_special_tokens=False,
-                padding=False, truncation=True,
-                max_length=max_user_input_length
-            )
-            truncated_user_input_text = self.codellama_tokenizer.decode(
-                encoded_user_input, skip_special_tokens=False)
+            truncated_user_input_text = self.method_backend.truncate(
+                user_input_text, max_user_input_length)
 
-            self.logger.warning(
-                f"TRUNCATION{LOG_SEPARATOR}\nNode ID: {node_id}\nInput text exceeds the token limit, truncates user input text from:\n{user_input_text}\nto:\n{truncated_user_input_text}")
+            self.logger.warning(LogEvent(
+                "TRUNCATION", node_id=node_id, message="Input text exceeds the token limit, truncates user input text.",
+                input=user_input_text, truncated_input=truncated_user_input_text))
+            self.truncation_count += 1
+            if self.metrics != None:
+                self.metrics.record('truncation', node_id=node_id, truncated=1)
 
             user_input_text = truncated_user_input_text
 
-        return f"<s>[INST]<<SYS>>\n{system_input_text}\n<</SYS>>\n{user_input_text}\n[/INST]"
+        return self.method_backend.build_prompt(system_input_text, user_input_text)
+
+    def _get_context_budget(self, system_input_text: str, user_input_text: str, max_output_length: int) -> int:
+        '''Number of tokens left for context in a prompt of GPT.'''
+        return self.chat_backend.max_number_of_tokens - max_output_length - \
+            self.chat_backend.count_tokens(system_input_text + user_input_text)
+
+    def _get_reusable_node(self, node_id: int, child_nodes: List[dict]) -> dict:
+        '''
+            In repair mode, the previous node if it has a summary and the summaries of its children,
+            which were in its prompt, are unchanged. None otherwise.
+        '''
+        if self.previous_nodes == None:
+            return None
+
+        previous_node = self.previous_nodes.get(node_id)
+        if previous_node == None or previous_node['summary'] == NO_SUMMARY:
+            return None
+        for child_node in child_nodes:
+            previous_child_node = self.previous_nodes.get(child_node['id'])
+            if previous_child_node == None or previous_child_node['summary'] != child_node['summary']:
+                return None
+
+        self.reused_node_count += 1
+        return previous_node
+
+    def _record_collapsed(self, node_id: int):
+        if self.metrics != None:
+            self.metrics.record('single_flight', node_id=node_id, collapsed=1)
 
     def _gpt_summarize(self, node_id: int, system_input_text: str, user_input_text: str, max_output_length: int) -> str:
         '''Generate summary through API calls.'''
         try:
-            total_tokens, output_text = self.openai_client.generate(
-                system_input_text, user_input_text, max_output_length)
-            self.token_used_count += total_tokens
+            with metrics_context(node_id=node_id):
+                (total_tokens, output_text), is_shared = self.single_flight.do(
+                    get_request_key('chat', system_input_text,
+                                    user_input_text, max_output_length),
+                    lambda: self.chat_backend.chat(system_input_text, user_input_text, max_output_length))
+            if is_shared:
+                self._record_collapsed(node_id)
+            else:
+                self.token_used_count += total_tokens
 
             return output_text
         except Exception as e:
             self.gen_err_count += 1
-            self.logger.error(
-                f"GENERATION ERROR{LOG_SEPARATOR}\nNode ID: {node_id}\n{e}")
+            self.logger.error(LogEvent(
+                "GENERATION ERROR", node_id=node_id, error=str(e)))
 
             return NO_SUMMARY
 
+    def _clean_codellama_output(self, output_text: str) -> str:
+        output_text = output_text.strip()
+        output_text = output_text.replace('\n', ' ')
+        # if the last sentence is not complete, truncate it
+        last_dot_index = output_text.rfind('.')
+        if last_dot_index != -1:
+            output_text = output_text[:last_dot_index + 1]
+
+        return output_text
+
     def _codellama_summarize(self, node_id: int, input_text: str, max_output_length: int) -> dict:
         '''
             Generate summary through API calls.
@@ -92,25 +230,23 @@ class Summarizer:
             the purpose of returning input_text is to facilitate logging
         '''
         try:
-            output_text = self.ie_client.generate(
-                input_text, max_output_length)
-
-            output_text = output_text.strip()
-            output_text = output_text.replace('\n', ' ')
-            # if the last sentence is not complete, truncate it
-            last_dot_index = output_text.rfind('.')
-            if last_dot_index != -1:
-                output_text = output_text[:last_dot_index + 1]
+            # runs in a worker thread, so the label is attached here
+            with metrics_context(node_id=node_id, node_type='method'):
+                output_text, is_shared = self.single_flight.do(
+                    get_request_key('method', input_text, max_output_length),
+                    lambda: self.method_backend.generate(input_text, max_output_length))
+            if is_shared:
+                self._record_collapsed(node_id)
 
             return {
                 'id': node_id,
                 'input_text': input_text,
-                'output_text': output_text
+                'output_text': self._clean_codellama_output(output_text)
             }
         except Exception as e:
             self.gen_err_count += 1
-            self.logger.error(
-                f"GENERATION ERROR{LOG_SEPARATOR}\nNode ID: {node_id}\n{e}")
+            self.logger.error(LogEvent(
+                "GENERATION ERROR", node_id=node_id, error=str(e)))
             return {
                 'id': node_id,
                 'input_text': input_text,
@@ -126,7 +262,7 @@ class Summarizer:
         if len(input_dicts) == 0:
             return []
 
-        max_bs = self.ie_client.max_batch_size
+        max_bs = self.method_backend.max_batch_size
         bs = min(len(input_dicts), max_bs)
 
         with ThreadPoolExecutor(max_workers=bs) as executor:
@@ -155,6 +291,136 @@ class Summarizer:
 
             return res_dicts
 
+    def _get_codellama_length(self, text: str) -> int:
+        return self.method_backend.count_tokens(text)
+
+    def _pack_methods(self, method_objs: List[dict]) -> Tuple[List[List[dict]], List[dict]]:
+        '''
+            Group small methods into packs within the token limit of CodeLlama.
+            return: (packs: a list of method lists, methods to be summarized alone)
+        '''
+        MAX_METHOD_LENGTH = SUM_METHOD_PACKED['max_method_length']
+        MAX_METHOD_COUNT = SUM_METHOD_PACKED['max_method_count']
+        OUTPUT_LENGTH_PER_METHOD = SUM_METHOD_PACKED['max_output_length_per_method']
+        METHOD_HEADER_LENGTH = 8  # tokens of "Method <NUMBER>:"
+
+        max_pack_length = self.method_backend.max_number_of_tokens - self.CODELLAMA_SPECIAL_TOKEN_NUM - \
+            self._get_codellama_length(SUM_METHOD_PACKED['system_prompt'])
+
+        packs = []
+        single_method_objs = []
+        pack = []
+        pack_length = 0
+        for method_obj in method_objs:
+            length = self._get_codellama_length(
+                method_obj["signature"] + method_obj["body"]) + METHOD_HEADER_LENGTH
+            if length > MAX_METHOD_LENGTH:
+                single_method_objs.append(method_obj)
+                continue
+
+            if len(pack) == MAX_METHOD_COUNT or \
+                    pack_length + length + (len(pack) + 1) * OUTPUT_LENGTH_PER_METHOD > max_pack_length:
+                packs.append(pack)
+                pack = []
+                pack_length = 0
+
+            pack.append(method_obj)
+            pack_length += length
+
+        if len(pack) > 0:
+            packs.append(pack)
+
+        # a pack of one method is an ordinary request
+        for pack in packs:
+            if len(pack) == 1:
+                single_method_objs.append(pack[0])
+
+        return [x for x in packs if len(x) > 1], single_method_objs
+
+    def _codellama_summarize_pack(self, method_objs: List[dict]) -> List[dict]:
+        '''
+            Summarize several methods in one request.
+            return: a list of {id: int, input_text: str, output_text: str},
+            None if an error occurred or the output is not in the expected format.
+        '''
+        SYSTEM_PROMPT = SUM_METHOD_PACKED['system_prompt']
+        MAX_OUTPUT_LENGTH = SUM_METHOD_PACKED['max_output_length_per_method'] * \
+            len(method_objs)
+
+        user_input_text = "\n".join(
+            f"Method {idx + 1}:\n{method_obj['signature']}{method_obj['body']}"
+            for idx, method_obj in enumerate(method_objs))
+        input_text = self._build_codellama_input(
+            method_objs[0]['id'], SYSTEM_PROMPT, user_input_text, MAX_OUTPUT_LENGTH)
+        node_ids = [x['id'] for x in method_objs]
+
+        try:
+            with metrics_context(node_id=method_objs[0]['id'], node_type='method_pack'):
+                output_text, is_shared = self.single_flight.do(
+                    get_request_key('method', input_text, MAX_OUTPUT_LENGTH),
+                    lambda: self.method_backend.generate(input_text, MAX_OUTPUT_LENGTH))
+            if is_shared:
+                self._record_collapsed(method_objs[0]['id'])
+        except Exception as e:
+            self.logger.error(LogEvent(
+                "GENERATION ERROR", node_ids=node_ids, error=str(e)))
+            return None
+
+        # one line for each method: <NUMBER>: <SUMMARY>
+        summaries = {}
+        for line in output_text.split('\n'):
+            match = PACKED_OUTPUT_PATTERN.match(line)
+            if match and int(match.group(1)) not in summaries:
+                summaries[int(match.group(1))] = self._clean_codellama_output(
+                    match.group(2))
+
+        if any(summaries.get(idx + 1, "") == "" for idx in range(len(method_objs))):
+            self.logger.warning(LogEvent(
+                "PACK FORMAT ERROR", node_ids=node_ids, input=input_text, output=output_text))
+            return None
+
+        return [{
+            'id': method_obj['id'],
+            'input_text': input_text,
+            'output_text': summaries[idx + 1],
+        } for idx, method_obj in enumerate(method_objs)]
+
+    def _codellama_batch_summarize_packs(self, packs: List[List[dict]]) -> Tuple[List[dict], List[dict]]:
+        '''
+            Summarize packs of methods concurrently in max batch size.
+            return: (a list of {id: int, input_text: str, output_text: str}, methods of failed packs)
+        '''
+        if len(packs) == 0:
+            return [], []
+
+        if self.single_method_prompt_length == None:
+            self.single_method_prompt_length = self._get_codellama_length(
+                SUM_METHOD['system_prompt']) + self.CODELLAMA_SPECIAL_TOKEN_NUM
+
+        with ThreadPoolExecutor(max_workers=min(len(packs), self.method_backend.max_batch_size)) as executor:
+            pack_output_dicts = list(
+                executor.map(self._codellama_summarize_pack, packs))
+
+        output_dicts = []
+        fallback_method_objs = []
+        for pack, pack_output_dict in zip(packs, pack_output_dicts):
+            if pack_output_dict == None:
+                fallback_method_objs.extend(pack)
+                self.pack_fallback_count += len(pack)
+            else:
+                output_dicts.extend(pack_output_dict)
+                self.pack_request_count += 1
+                self.packed_method_count += len(pack)
+                # the prompt is sent once instead of once per method
+                self.pack_saved_token_count += (len(pack) - 1) * \
+                    self.single_method_prompt_length
+
+            if self.metrics != None:
+                self.metrics.record('method_pack', node_id=pack[0]['id'], method_count=len(pack),
+                                    status='fallback' if pack_output_dict == None else 'ok')
+
+        return output_dicts, fallback_method_objs
+
     def _summarize_methods(self, method_objs: List[dict]) -> List[dict]:
         '''
             Summarize for methods in one class, methods can be processed in batch.
@@ -167,19 +433,37 @@ class Summarizer:
         if len(method_objs) == 0:
             return []
 
+        # in repair mode, methods which have a summary are not summarized again
+        reused_nodes = {}
+        for method_obj in method_objs:
+            previous_node = self._get_reusable_node(method_obj['id'], [])
+            if previous_node != None:
+                reused_nodes[method_obj['id']] = previous_node
+
+        # ignore methods that have no body
+        single_method_objs = [x for x in method_objs
+                              if x["body"] != "" and x['id'] not in reused_nodes]
+
+        # small methods are summarized in packs, methods of failed packs are summarized alone
+        output_dicts = []
+        if self.pack_methods:
+            packs, single_method_objs = self._pack_methods(single_method_objs)
+            output_dicts, fallback_method_objs = self._codellama_batch_summarize_packs(
+                packs)
+            single_method_objs.extend(fallback_method_objs)
+
         # assemble input dicts
         input_dicts = []
-        for method_obj in method_objs:
-            if method_obj["body"] != "":  # ignore methods that have no body
-                user_input_text = method_obj["signature"] + method_obj["body"]
-                input_dicts.append({
-                    'id': method_obj['id'],
-                    'input_text': self._build_codellama_input(method_obj['id'], SYSTEM_PROMPT, user_input_text, MAX_OUTPUT_LENGTH)
-                })
+        for method_obj in single_method_objs:
+            user_input_text = method_obj["signature"] + method_obj["body"]
+            input_dicts.append({
+                'id': method_obj['id'],
+                'input_text': self._build_codellama_input(method_obj['id'], SYSTEM_PROMPT, user_input_text, MAX_OUTPUT_LENGTH)
+            })
 
         # generate summary
-        output_dicts = self._codellama_batch_summarize(
-            input_dicts, MAX_OUTPUT_LENGTH)
+        output_dicts.extend(self._codellama_batch_summarize(
+            input_dicts, MAX_OUTPUT_LENGTH))
 
         # assemble method nodes
         method_nodes = []
@@ -187,7 +471,14 @@ class Summarizer:
             output_dict = next(
                 filter(lambda x: x['id'] == method_obj['id'], output_dicts), None)
 
-            if output_dict != None:
+            if method_obj['id'] in reused_nodes:
+                method_nodes.append({
+                    'id': method_obj['id'],
+                    'name': method_obj['name'],
+                    'summary': reused_nodes[method_obj['id']]['summary'],
+                    'signature': method_obj['signature'],
+                })
+            elif output_dict != None:
                 summary = output_dict['output_text']
 
                 method_nodes.append({
@@ -195,20 +486,18 @@ class Summarizer:
                     'name': method_obj['name'],
                     'summary': summary,
                     'signature': method_obj['signature'],
-                    'body': method_obj['body'],
                 })
-                self.logger.info(
-                    f"METHOD{LOG_SEPARATOR}\nNode ID: {method_obj['id']}\nInput:\n{output_dict['input_text']}\nOutput:\n{summary}")
+                self.logger.info(LogEvent(
+                    "METHOD", node_id=method_obj['id'], input=output_dict['input_text'], output=summary))
             else:
                 method_nodes.append({
                     'id': method_obj['id'],
                     'name': method_obj['name'],
                     'summary': NO_SUMMARY,
                     'signature': method_obj['signature'],
-                    'body': method_obj['body'],
                 })
-                self.logger.info(
-                    f"METHOD{LOG_SEPARATOR}\nNode ID: {method_obj['id']}\nOutput:\n{NO_SUMMARY}")
+                self.logger.info(LogEvent(
+                    "METHOD", node_id=method_obj['id'], output=NO_SUMMARY))
 
         self.pbar.update(len(method_objs))
 
@@ -223,36 +512,41 @@ class Summarizer:
         SYSTEM_PROMPT = SUM_FILE['system_prompt']
         MAX_OUTPUT_LENGTH = SUM_FILE['max_output_length']
 
-        ignore_method_count = 0
         user_input_text = file_obj["signature"] + " {\n"
 
         # handle all methods
         method_nodes = self._summarize_methods(file_obj["methods"])
 
-        # concat summary of methods to user_input_text
-        for idx, method_node in enumerate(method_nodes):
-            tmp_str = f"\t{method_node['signature']};\n"
-
-            if method_node['summary'] != NO_SUMMARY:
-                tmp_str = f"\t{method_node['signature']}; // {method_node['summary']}\n"
-
-            # ignore methods that exceed the token limit
-            if not self._is_legal_gpt_input(SYSTEM_PROMPT, user_input_text + tmp_str, MAX_OUTPUT_LENGTH):
-                ignore_method_count = len(method_nodes) - idx
-                break
+        previous_node = self._get_reusable_node(file_obj['id'], method_nodes)
+        if previous_node != None:
+            self.pbar.update(1)
+            return {
+                "id": file_obj["id"],
+                "name": file_obj["name"],
+                "summary": previous_node['summary'],
+                "methods": method_nodes,
+            }
 
-            user_input_text += tmp_str
+        # pack summary of methods into user_input_text, shorten summaries or ignore methods to fit the token limit
+        context, packed_count, truncated_count = self.context_packer.pack(
+            [{
+                'signature': x['signature'],
+                'summary': x['summary'] if x['summary'] != NO_SUMMARY else "",
+            } for x in method_nodes],
+            self._get_context_budget(
+                SYSTEM_PROMPT, user_input_text + "}", MAX_OUTPUT_LENGTH),
+            lambda x, text: f"\t{x['signature']}; // {text}\n" if text != "" else f"\t{x['signature']};\n")
+        ignore_method_count = len(method_nodes) - packed_count
 
-        user_input_text += "}"
+        user_input_text += context + "}"
 
-        summary = self._gpt_summarize(
-            file_obj['id'], SYSTEM_PROMPT, user_input_text, MAX_OUTPUT_LENGTH)
+        with metrics_context(node_type='file'):
+            summary = self._gpt_summarize(
+                file_obj['id'], SYSTEM_PROMPT, user_input_text, MAX_OUTPUT_LENGTH)
 
-        self.logger.info(
-            f"FILE{LOG_SEPARATOR}\nNode ID: {file_obj['id']}\nSystem Input:\n{SYSTEM_PROMPT}\nUser Input:\n{user_input_text}\nOutput:\n{summary}")
-        if ignore_method_count != 0:
-            self.logger.info(
-                f"Number of ignored method: {ignore_method_count}")
+        self.logger.info(LogEvent(
+            "FILE", node_id=file_obj['id'], system_input=SYSTEM_PROMPT, user_input=user_input_text, output=summary,
+            ignored_method_count=ignore_method_count, truncated_summary_count=truncated_count))
         self.pbar.update(1)
 
         return {
@@ -262,7 +556,62 @@ class Summarizer:
             "methods": method_nodes,
         }
 
-    def _summarize_dir(self, dir_obj: dict) -> dict:
+    def _extract_dir_summary(self, dir_obj: dict, sub_dir_nodes: List[dict], file_nodes: List[dict]) -> Tuple[str, List[float]]:
+        '''
+            Summary of the fast tier: names of children and first sentences of the most representative child summaries.
+            Children are ranked by similarity to the mean of their embeddings, which represents the directory in retrieval.
+            return: (summary, normalized embedding | None)
+        '''
+        MAX_NAME_COUNT = SUM_DIR_EXTRACTIVE['max_name_count']
+        MAX_SUMMARY_COUNT = SUM_DIR_EXTRACTIVE['max_summary_count']
+        MAX_SENTENCE_LENGTH = SUM_DIR_EXTRACTIVE['max_sentence_length']
+
+        if len(sub_dir_nodes) == 0 and len(file_nodes) == 0:
+            return NO_SUMMARY, None
+
+        def list_names(nodes: List[dict]) -> str:
+            names = [x['name'] for x in nodes[:MAX_NAME_COUNT]]
+            if len(nodes) > MAX_NAME_COUNT:
+                names.append(f"and {len(nodes) - MAX_NAME_COUNT} more")
+            return ", ".join(names)
+
+        parts = []
+        if len(sub_dir_nodes) > 0:
+            parts.append(f"{len(sub_dir_nodes)} subdirectories ({list_names(sub_dir_nodes)})")
+        if len(file_nodes) > 0:
+            parts.append(f"{len(file_nodes)} files ({list_names(file_nodes)})")
+        summary = f"Directory {dir_obj['name']} contains {' and '.join(parts)}."
+
+        # without embeddings, written summaries are preferred to extractive ones, which repeat names
+        child_nodes = sorted([x for x in file_nodes + sub_dir_nodes if x['summary'] != NO_SUMMARY],
+                             key=lambda x: x.get('summary_tier') == 'extractive')
+        if len(child_nodes) == 0:
+            return summary, None
+
+        embedding = None
+        if self.text_sim_calculator != None:
+            # extractive subdirectories already carry the embedding of their children
+            idxs = [i for i, x in enumerate(child_nodes) if 'embedding' not in x]
+            embeddings = [x.get('embedding') for x in child_nodes]
+            for i, child_embedding in zip(idxs, self.text_sim_calculator.calc_embeddings(
+                    [child_nodes[i]['summary'] for i in idxs])):
+                embeddings[i] = child_embedding
+
+            mean = [sum(x) / len(embeddings) for x in zip(*embeddings)]
+            norm = max(sum(x * x for x in mean) ** 0.5, 1e-9)
+            embedding = [round(x / norm, 5) for x in mean]
+
+            scores = [sum(x * y for x, y in zip(child_embedding, embedding))
+                      for child_embedding in embeddings]
+            order = sorted(range(len(child_nodes)), key=lambda x: scores[x], reverse=True)
+            child_nodes = [child_nodes[i] for i in order]
+
+        sentences = [get_first_sentence(x['summary'], MAX_SENTENCE_LENGTH)
+                     for x in child_nodes[:MAX_SUMMARY_COUNT]]
+
+        return f"{summary} {' '.join(sentences)}", embedding
+
+    def _summarize_dir(self, dir_obj: dict, depth: int = 0) -> dict:
         '''Summarize for directory according to its subdirectories and files.'''
         SYSTEM_PROMPT = SUM_DIR['system_prompt']
         MAX_OUTPUT_LENGTH = SUM_DIR['max_output_length']
@@ -272,70 +621,79 @@ class Summarizer:
         if (len(dir_obj["subdirectories"]) == 1 and len(dir_obj["files"]) == 0):
             child_dir_obj = dir_obj['subdirectories'][0]
             child_dir_obj['name'] = f"{dir_obj['name']}/{child_dir_obj['name']}"
-            return self._summarize_dir(child_dir_obj)
+            return self._summarize_dir(child_dir_obj, depth)
 
-        valid_context_count = 0
         summary = NO_SUMMARY
-        ignore_sub_dir_count = 0
-        ignore_file_count = 0
         user_input_text = f"Directory name: {dir_obj['name']}.\n{INPUT_SEPARATOR}\nInformation list:\n"
 
         # handle all subdirectories recursively
         sub_dir_nodes = []
         for sub_dir_obj in dir_obj["subdirectories"]:
-            sub_dir_nodes.append(self._summarize_dir(sub_dir_obj))
-
-        # concat summary of subdirectories to user_input_text
-        if len(sub_dir_nodes) > 0:
-            for idx, sub_dir_node in enumerate(sub_dir_nodes):
-                temp_obj = {
-                    'id': sub_dir_node['id'],
-                    'type': 'directory',
-                    'name': sub_dir_node['name'],
-                    'summary': sub_dir_node['summary'],
-                }
-                temp_str = f"{temp_obj}\n"
-                if not self._is_legal_gpt_input(SYSTEM_PROMPT, user_input_text + temp_str, MAX_OUTPUT_LENGTH):
-                    ignore_sub_dir_count = len(sub_dir_nodes) - idx
-                    break
-
-                user_input_text += temp_str
-                valid_context_count += 1
+            sub_dir_nodes.append(self._summarize_dir(sub_dir_obj, depth + 1))
 
         # handle all files
         file_nodes = []
         for file_obj in dir_obj["files"]:
-            file_nodes.append(self._summarize_file(file_obj))
+            file_node = self.streamed_file_nodes.get(file_obj['id'])
+            file_nodes.append(file_node if file_node != None
+                              else self._summarize_file(file_obj))
+
+        previous_node = self._get_reusable_node(
+            dir_obj['id'], sub_dir_nodes + file_nodes)
+        if previous_node != None:
+            self.pbar.update(1)
+            return {
+                **{k: v for k, v in previous_node.items() if k not in ('subdirectories', 'files')},
+                "name": dir_obj["name"],
+                "subdirectories": sub_dir_nodes,
+                "files": file_nodes,
+            }
 
-        # concat summary of files to user_input_text
-        if len(file_nodes) > 0:
-            for idx, file_node in enumerate(file_nodes):
-                temp_obj = {
-                    'id': file_node['id'],
-                    'type': 'file',
-                    'name': file_node['name'],
-                    'summary': file_node['summary'],
-                }
-                temp_str = f"{temp_obj}\n"
-                if not self._is_legal_gpt_input(SYSTEM_PROMPT, user_input_text + temp_str, MAX_OUTPUT_LENGTH):
-                    ignore_file_count = len(file_nodes) - idx
-                    break
-
-                user_input_text += temp_str
-                valid_context_count += 1
+        # fast tier, no GPT call
+        if is_depth_selected(self.fast_dir_depths, depth):
+            summary, embedding = self._extract_dir_summary(
+                dir_obj, sub_dir_nodes, file_nodes)
+            self.extractive_dir_count += 1
+            self.logger.info(LogEvent(
+                "DIRECTORY", node_id=dir_obj['id'], tier='extractive', output=summary))
+            self.pbar.update(1)
+
+            dir_node = {
+                "id": dir_obj["id"],
+                "name": dir_obj["name"],
+                "summary": summary,
+                "summary_tier": "extractive",
+                "subdirectories": sub_dir_nodes,
+                "files": file_nodes,
+            }
+            if embedding != None:
+                dir_node["embedding"] = embedding
+            return dir_node
+
+        # pack summary of subdirectories and files into user_input_text,
+        # shorten summaries or ignore the last items to fit the token limit
+        infos = [{'id': x['id'], 'type': 'directory', 'name': x['name'], 'summary': x['summary']}
+                 for x in sub_dir_nodes]
+        infos.extend({'id': x['id'], 'type': 'file', 'name': x['name'], 'summary': x['summary']}
+                     for x in file_nodes)
+        context, valid_context_count, truncated_count = self.context_packer.pack(
+            infos, self._get_context_budget(
+                SYSTEM_PROMPT, user_input_text, MAX_OUTPUT_LENGTH),
+            lambda x, text: encode_info({**x, 'summary': text}))
+        ignore_sub_dir_count = max(0, len(sub_dir_nodes) - valid_context_count)
+        ignore_file_count = len(infos) - valid_context_count - ignore_sub_dir_count
+        user_input_text += context
 
         if valid_context_count != 0:
-            summary = self._gpt_summarize(
-                dir_obj['id'], SYSTEM_PROMPT, user_input_text, MAX_OUTPUT_LENGTH)
+            with metrics_context(node_type='directory'):
+                summary = self._gpt_summarize(
+                    dir_obj['id'], SYSTEM_PROMPT, user_input_text, MAX_OUTPUT_LENGTH)
             summary = summary.strip()
 
-        self.logger.info(
-            f"DIRECTORY{LOG_SEPARATOR}\nNode ID: {dir_obj['id']}\nSystem Input:\n{SYSTEM_PROMPT}\nUser Input:\n{user_input_text}\nOutput:\n{summary}")
-        if ignore_file_count != 0:
-            self.logger.info(f"Number of ignored file: {ignore_file_count}")
-        if ignore_sub_dir_count != 0:
-            self.logger.info(
-                f"Number of ignored subdirectory: {ignore_sub_dir_count}")
+        self.logger.info(LogEvent(
+            "DIRECTORY", node_id=dir_obj['id'], system_input=SYSTEM_PROMPT, user_input=user_input_text, output=summary,
+            ignored_file_count=ignore_file_count, ignored_sub_dir_count=ignore_sub_dir_count,
+            truncated_summary_count=truncated_count))
         self.pbar.update(1)
 
         return {
@@ -346,6 +704,25 @@ class Summarizer:
             "files": file_nodes,
         }
 
+    def _log_completion(self, start_time: float):
+        self.logger.info(LogEvent(
+            "COMPLETION",
+            gen_err_count=self.gen_err_count,
+            ignored_node_count=self.total_ignore_count,
+            truncated_node_count=self.truncation_count,
+            token_used_count=self.token_used_count,
+            collapsed_request_count=self.single_flight.collapsed_count,
+            inflight_join_count=self.single_flight.inflight_join_count,
+            completed_hit_count=self.single_flight.completed_hit_count,
+            pack_request_count=self.pack_request_count,
+            packed_method_count=self.packed_method_count,
+            pack_fallback_count=self.pack_fallback_count,
+            pack_saved_request_count=self.packed_method_count - self.pack_request_count,
+            pack_saved_token_count=self.pack_saved_token_count,
+            extractive_dir_count=self.extractive_dir_count,
+            reused_node_count=self.reused_node_count,
+            time_cost=time.strftime('%H:%M:%S', time.gmtime(time.time() - start_time))))
+
     def summarize_repo(self, repo_obj: dict) -> dict:
         '''Generate the summary tree for the entire repo.'''
         start_time = time.time()
@@ -355,17 +732,70 @@ class Summarizer:
             self.pbar = pbar
 
             result = self._summarize_dir(repo_obj['mainDirectory'])
+            self._log_completion(start_time)
 
-            self.logger.info(f"COMPLETION{LOG_SEPARATOR}")
-            self.logger.info(
-                f"Number of generation error: {self.gen_err_count}")
-            self.logger.info(
-                f"Number of ignored node: {self.total_ignore_count}")
-            self.logger.info(
-                f"Number of truncated node: {self.truncation_count}")
-            self.logger.info(f"Token Used: {self.token_used_count}")
+            return result
 
-            self.logger.info(
-                f"Summarization time cost: {time.strftime('%H:%M:%S', time.gmtime(time.time() - start_time))}")
+    def summarize_records(self, records: Iterable[dict]) -> Tuple[dict, dict]:
+        '''
+            Generate the summary tree from parse records as they are produced, e.g. by ParseCache.parse_stream:
+            each file with its methods is summarized as soon as its record arrives, while parsing goes on,
+            directories are summarized once the tree is complete, since collapsing depends on their parents.
+            Files are summarized one by one, as in summarize_repo, so the load of the endpoints is the same.
+            return: (summary tree, parse tree)
+        '''
+        start_time = time.time()
+        builder = ParseTreeBuilder()
+        first_file_time = None
 
-            return result
+        with tqdm() as pbar:
+            pbar.set_description("Summarizing repo...")
+            self.pbar = pbar
+
+            futures = {}
+            executor = ThreadPoolExecutor(max_workers=1)
+            try:
+                for record in records:
+                    file_obj = builder.add(record)
+                    if file_obj != None:
+                        if first_file_time == None:
+                            first_file_time = time.time()
+                        futures[file_obj['id']] = executor.submit(
+                            self._summarize_file, file_obj)
+                parse_time = time.time() - start_time
+                if builder.parse_obj == None:
+                    raise Exception("The parse records are incomplete.")
+
+                self.streamed_file_nodes = {
+                    file_id: future.result() for file_id, future in futures.items()}
+            finally:
+                # parsing may fail, files not started yet are not summarized
+                executor.shutdown(wait=True, cancel_futures=True)
+
+            pbar.total = builder.parse_obj['nodeCount']
+            pbar.refresh()
+            self.logger.info(LogEvent(
+                "PARSE STREAM", file_count=len(futures), parse_time=round(parse_time, 2),
+                first_file_latency=round(first_file_time - start_time, 2) if first_file_time != None else None,
+                file_done_latency=round(time.time() - start_time, 2)))
+
+            try:
+                result = self._summarize_dir(builder.parse_obj['mainDirectory'])
+            finally:
+                self.streamed_file_nodes = {}
+            self._log_completion(start_time)
+
+        return result, builder.parse_obj
+
+    def repair_repo(self, repo_obj: dict, repo_sum_obj: dict) -> dict:
+        '''
+            Summarize again the nodes of a summary tree of the repo which have no summary, e.g. after generation errors,
+            and the ancestors whose prompts change with them. Other summaries are reused.
+            repo_obj: the parse tree the summary tree was built from, so that node ids match
+            return: the repaired summary tree, repo_sum_obj is not modified.
+        '''
+        self.previous_nodes = index_sum_nodes(repo_sum_obj)
+        try:
+            return self.summarize_repo(repo_obj)
+        finally:
+            self.previous_nodes = None
@@ -0,0 +1,249 @@
+import argparse
+import json
+import os
+import random
+from typing import List, Tuple
+
+
+NOUNS = ["user", "order", "account", "session", "token", "cache", "config", "message", "event", "record",
+         "request", "response", "client", "server", "channel", "buffer", "stream", "file", "node", "graph",
+         "index", "query", "result", "task", "job", "worker", "queue", "schedule", "policy", "rule",
+         "route", "handler", "filter", "codec", "parser", "writer", "reader", "entry", "table", "column",
+         "schema", "field", "value", "key", "metric", "report", "invoice", "payment", "item", "product"]
+VERBS = ["get", "find", "load", "save", "update", "delete", "create", "build", "parse", "format",
+         "validate", "check", "compute", "resolve", "register", "remove", "merge", "split", "convert", "send"]
+TYPES = ["int", "long", "boolean", "String", "void", "double", "List<String>", "Map<String, Object>"]
+PARAM_TYPES = ["int", "long", "boolean", "String", "double", "List<String>"]
+ROLES = ["Manager", "Service", "Factory", "Helper", "Util", "Handler", "Repository", "Controller", "Provider", "Builder"]
+VERB_PHRASES = {
+    "get": "Gets", "find": "Finds", "load": "Loads", "save": "Saves", "update": "Updates",
+    "delete": "Deletes", "create": "Creates", "build": "Builds", "parse": "Parses", "format": "Formats",
+    "validate": "Validates", "check": "Checks", "compute": "Computes", "resolve": "Resolves",
+    "register": "Registers", "remove": "Removes", "merge": "Merges", "split": "Splits",
+    "convert": "Converts", "send": "Sends",
+}
+
+
+class SyntheticRepoGenerator:
+    '''
+        Generate a tree in the format of java-repo-parser output(parse_out),
+        ids are numbered in post-order as the parser does.
+        Each count is a (min, max) range, values are drawn uniformly with a fixed seed.
+    '''
+
+    def __init__(self, depth: int = 4, dir_count: Tuple[int, int] = (3, 5), file_count: Tuple[int, int] = (4, 8),
+                 method_count: Tuple[int, int] = (4, 10), body_length: Tuple[int, int] = (20, 120), seed: int = 0):
+        self.depth = depth
+        self.dir_count = dir_count
+        self.file_count = file_count
+        self.method_count = method_count
+        self.body_length = body_length
+        self.random = random.Random(seed)
+
+        self.node_count = 0
+        self.max_sub_dir_count = 0
+        self.max_file_count = 0
+        self.max_sub_dir_and_file_count = 0
+        self.total_dir_count = 0
+        self.total_file_count = 0
+
+    def _next_id(self) -> int:
+        self.node_count += 1
+        return self.node_count
+
+    def _unique_names(self, count: int, make_name) -> List[str]:
+        '''Names of siblings, none is a prefix of another so that paths are unambiguous.'''
+        names = []
+        for _ in range(count * 20):
+            if len(names) == count:
+                break
+            name = make_name()
+            if all(not x.startswith(name) and not name.startswith(x) for x in names):
+                names.append(name)
+
+        return names
+
+    def _gen_body(self, name: str) -> str:
+        '''A one-line body made of statements on random identifiers, formatted as the parser does.'''
+        length = self.random.randint(*self.body_length)
+        statements = []
+        word_count = 0
+        while word_count < length:
+            noun = self.random.choice(NOUNS)
+            kind = self.random.random()
+            if kind < 0.4:
+                statement = f"{noun}Count = {noun}Count + {self.random.randint(1, 9)};"
+            elif kind < 0.7:
+                statement = f"if ({noun} == null) {{ throw new IllegalArgumentException(\"{noun} is null\"); }}"
+            elif kind < 0.9:
+                statement = f"for ({noun.capitalize()} item : {noun}s) {{ {self.random.choice(VERBS)}{noun.capitalize()}(item); }}"
+            else:
+                statement = f"LOGGER.debug(\"{name} {noun}\");"
+            statements.append(statement)
+            word_count += len(statement.split())
+
+        return "{ " + " ".join(statements) + " return result; }"
+
+    def _gen_method(self, name: str) -> dict:
+        param_nouns = self.random.sample(NOUNS, self.random.randint(0, 3))
+        params = ", ".join(
+            f"{self.random.choice(PARAM_TYPES)} {noun}" for noun in param_nouns)
+        return {
+            'id': self._next_id(),
+            'name': name,
+            'signature': f"{self.random.choice(TYPES)} {name}({params})",
+            'body': self._gen_body(name),
+        }
+
+    def _gen_file(self, class_name: str) -> dict:
+        method_names = self._unique_names(
+            self.random.randint(*self.method_count),
+            lambda: self.random.choice(VERBS) + self.random.choice(NOUNS).capitalize() +
+            self.random.choice(NOUNS).capitalize())
+        methods = [self._gen_method(name) for name in method_names]
+
+        signature = f"class {class_name}"
+        if self.random.random() < 0.3:
+            signature += f" extends Abstract{self.random.choice(ROLES)}"
+
+        self.total_file_count += 1
+        return {
+            'id': self._next_id(),
+            'name': f"{class_name}.java",
+            'signature': signature,
+            'methods': methods,
+        }
+
+    def _gen_dir(self, name: str, level: int) -> dict:
+        sub_dir_names = []
+        if level < self.depth:
+            sub_dir_names = self._unique_names(
+                self.random.randint(*self.dir_count),
+                lambda: self.random.choice(NOUNS) + (self.random.choice(NOUNS) if self.random.random() < 0.5 else ""))
+        subdirectories = [self._gen_dir(x, level + 1) for x in sub_dir_names]
+
+        class_names = self._unique_names(
+            self.random.randint(*self.file_count),
+            lambda: self.random.choice(NOUNS).capitalize() + self.random.choice(NOUNS).capitalize() +
+            self.random.choice(ROLES))
+        files = [self._gen_file(x) for x in class_names]
+
+        self.total_dir_count += 1
+        self.max_sub_dir_count = max(self.max_sub_dir_count, len(subdirectories))
+        self.max_file_count = max(self.max_file_count, len(files))
+        self.max_sub_dir_and_file_count = max(
+            self.max_sub_dir_and_file_count, len(subdirectories) + len(files))
+
+        return {
+            'id': self._next_id(),
+            'name': name,
+            'files': files,
+            'subdirectories': subdirectories,
+        }
+
+    def generate(self, repo_name: str) -> dict:
+        '''return: object in the format of parse_out'''
+        main_directory = self._gen_dir(repo_name, 0)
+
+        return {
+            'mainDirectory': main_directory,
+            'nodeCount': self.node_count,
+            'maxSubDirCount': self.max_sub_dir_count,
+            'maxFileCount': self.max_file_count,
+            'maxSubDirAndFileCount': self.max_sub_dir_and_file_count,
+            'totalDirCount': self.total_dir_count,
+            'totalFileCount': self.total_file_count,
+        }
+
+
+def split_camel_case(name: str) -> List[str]:
+    words = []
+    word = ""
+    for c in name:
+        if c.isupper() and word != "":
+            words.append(word)
+            word = ""
+        word += c.lower()
+    if word != "":
+        words.append(word)
+
+    return words
+
+
+def generate_queries(repo_obj: dict, repo_name: str, count: int, seed: int = 0) -> List[dict]:
+    '''
+        Pair methods with a description in the format of data_final.jsonl,
+        path is relative to the repo root, e.g. core/user/UserManager.java/getUserCount
+    '''
+    def collect(dir_obj: dict, dir_path: str) -> List[Tuple[str, dict]]:
+        items = []
+        for file_obj in dir_obj['files']:
+            for method_obj in file_obj['methods']:
+                items.append(
+                    (f"{dir_path}{file_obj['name']}/{method_obj['name']}", method_obj))
+        for sub_dir_obj in dir_obj['subdirectories']:
+            items.extend(collect(sub_dir_obj, f"{dir_path}{sub_dir_obj['name']}/"))
+        return items
+
+    items = collect(repo_obj['mainDirectory'], "")
+    rand = random.Random(seed)
+    items = rand.sample(items, min(count, len(items)))
+
+    data_objs = []
+    for idx, (path, method_obj) in enumerate(items):
+        words = split_camel_case(method_obj['name'])
+        query = f"{VERB_PHRASES.get(words[0], words[0].capitalize())} the {' '.join(words[1:])}"
+        params = method_obj['signature'].split('(', 1)[1].rstrip(')')
+        if params != "":
+            query += f" according to the given {' and '.join(x.split(' ')[-1] for x in params.split(', '))}"
+        query += "."
+
+        data_objs.append({
+            'id': idx,
+            'repo': f"synthetic/{repo_name}",
+            'query': query,
+            'path': path,
+            'sha': "synthetic",
+        })
+
+    return data_objs
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Generate a synthetic repo in the format of java-repo-parser output, and queries paired with its methods.")
+
+    parser.add_argument('--repo_name', default="synthetic", type=str)
+    parser.add_argument('--output_root_path', default="./eval_data/synthetic", type=str,
+                        help='<output_root_path>/<repo_name>/parse_out_<repo_name>.json and queries_<repo_name>.jsonl are written')
+    parser.add_argument('--depth', default=4, type=int,
+                        help='levels of subdirectories below the root')
+    parser.add_argument('--dir_count', nargs=2, default=[3, 5], type=int,
+                        help='range of subdirectories in a directory')
+    parser.add_argument('--file_count', nargs=2, default=[4, 8], type=int,
+                        help='range of files in a directory')
+    parser.add_argument('--method_count', nargs=2, default=[4, 10], type=int,
+                        help='range of methods in a file')
+    parser.add_argument('--body_length', nargs=2, default=[20, 120], type=int,
+                        help='range of words in a method body')
+    parser.add_argument('--query_count', default=200, type=int)
+    parser.add_argument('--seed', default=0, type=int)
+    args = parser.parse_args()
+
+    generator = SyntheticRepoGenerator(args.depth, tuple(args.dir_count), tuple(args.file_count),
+                                       tuple(args.method_count), tuple(args.body_length), args.seed)
+    repo_obj = generator.generate(args.repo_name)
+    data_objs = generate_queries(
+        repo_obj, args.repo_name, args.query_count, args.seed)
+
+    output_dir_path = os.path.join(args.output_root_path, args.repo_name)
+    os.makedirs(output_dir_path, exist_ok=True)
+
+    with open(os.path.join(output_dir_path, f"parse_out_{args.repo_name}.json"), "w") as f_parse_out:
+        json.dump(repo_obj, f_parse_out)
+    with open(os.path.join(output_dir_path, f"queries_{args.repo_name}.jsonl"), "w") as f_queries:
+        for data_obj in data_objs:
+            f_queries.write(json.dumps(data_obj) + '\n')
+
+    print(f"Node count: {repo_obj['nodeCount']}, directories: {repo_obj['totalDirCount']}, "
+          f"files: {repo_obj['totalFileCount']}, queries: {len(data_objs)}")
@@ -0,0 +1,243 @@
+import json
+import os
+import random
+import socket
+import threading
+import time
+import uuid
+from typing import List, Tuple
+
+
+def _write_json_atomic(path: str, obj: dict):
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    with open(temp_path, "w") as f:
+        f.write(json.dumps(obj))
+    os.replace(temp_path, path)
+
+
+def _restore_lock(tombstone_path: str, path: str):
+    '''Put back a lock renamed to tombstone_path by mistake, unless a new lock has been created meanwhile.'''
+    try:
+        os.link(tombstone_path, path)
+    except FileExistsError:
+        pass
+    os.remove(tombstone_path)
+
+
+def _try_create_lock(path: str, stale_timeout: float) -> str:
+    '''
+        Create lock file exclusively, a lock file not touched for stale_timeout seconds is taken over.
+        The stale lock is renamed to a unique tombstone first, so only one worker can take it over.
+        return: owner token written into the lock file, None if the lock is held by others
+    '''
+    token = f"{socket.gethostname()}:{os.getpid()}:{threading.get_ident()}:{uuid.uuid4().hex}"
+    tombstone_path = f"{path}.{uuid.uuid4().hex}.stale"
+    try:
+        fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        try:
+            stat = os.stat(path)
+            if time.time() - stat.st_mtime < stale_timeout:
+                return None
+            os.rename(path, tombstone_path)
+        except FileNotFoundError:
+            # released by its owner or taken over by another worker
+            return None
+
+        # the lock may have been taken over and created again between stat and rename,
+        # or touched by its owner, then it is not stale and is put back
+        tombstone_stat = os.stat(tombstone_path)
+        if tombstone_stat.st_ino != stat.st_ino or time.time() - tombstone_stat.st_mtime < stale_timeout:
+            _restore_lock(tombstone_path, path)
+            return None
+
+        # owner is gone, its lock is removed and created again
+        os.remove(tombstone_path)
+        try:
+            fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return None
+
+    with os.fdopen(fd, "w") as f:
+        f.write(token)
+
+    return token
+
+
+def _remove_lock(path: str, token: str):
+    '''
+        Remove lock file if it still holds token, a lock taken over by another worker is kept.
+        An own lock is renamed to a unique tombstone before removal, and put back if it was taken over meanwhile.
+    '''
+    try:
+        with open(path, "r") as f:
+            stat = os.fstat(f.fileno())
+            if f.read() != token:
+                return
+
+        tombstone_path = f"{path}.{uuid.uuid4().hex}.released"
+        os.rename(path, tombstone_path)
+    except FileNotFoundError:
+        return
+
+    if os.stat(tombstone_path).st_ino != stat.st_ino:
+        _restore_lock(tombstone_path, path)
+        return
+
+    os.remove(tombstone_path)
+
+
+class FileSemaphore:
+    '''
+        Counting semaphore shared by processes (or machines) through lock files in a shared directory,
+        used to bound concurrent requests to an endpoint across workers.
+        Usage: with semaphore: ...
+    '''
+
+    def __init__(self, dir_path: str, size: int, stale_timeout: float = 120, poll_interval: float = 0.05):
+        self.dir_path = dir_path
+        self.size = size
+        self.stale_timeout = stale_timeout
+        self.poll_interval = poll_interval
+        # slots held by each thread of this process
+        self.local = threading.local()
+
+        os.makedirs(dir_path, exist_ok=True)
+
+    def acquire(self) -> Tuple[str, str]:
+        '''return: (path, owner token) of the acquired slot'''
+        while True:
+            slot_idxs = list(range(self.size))
+            random.shuffle(slot_idxs)
+
+            for slot_idx in slot_idxs:
+                slot_path = os.path.join(self.dir_path, f"{slot_idx}.lock")
+                token = _try_create_lock(slot_path, self.stale_timeout)
+                if token != None:
+                    return slot_path, token
+
+            time.sleep(self.poll_interval * (1 + random.random()))
+
+    def release(self, slot_path: str, token: str):
+        _remove_lock(slot_path, token)
+
+    def __enter__(self):
+        if not hasattr(self.local, 'slots'):
+            self.local.slots = []
+        self.local.slots.append(self.acquire())
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release(*self.local.slots.pop())
+        return False
+
+
+class WorkQueue:
+    '''
+        Work items shared by worker processes (or machines) through a shared directory.
+        <work_dir>/locks/<key>.lock: the item is being processed, kept fresh by a heartbeat.
+        <work_dir>/status/<key>.json: {key, status: 'done' | 'failed', attempts, error, stats}
+        Items without status are claimed first, failed items are retried later up to max_attempts.
+    '''
+
+    def __init__(self, work_dir: str, keys: List[str], max_attempts: int = 3,
+                 stale_timeout: float = 600, heartbeat_interval: float = 60):
+        self.keys = keys
+        self.max_attempts = max_attempts
+        self.stale_timeout = stale_timeout
+        self.heartbeat_interval = heartbeat_interval
+
+        self.lock_dir_path = os.path.join(work_dir, "locks")
+        self.status_dir_path = os.path.join(work_dir, "status")
+        os.makedirs(self.lock_dir_path, exist_ok=True)
+        os.makedirs(self.status_dir_path, exist_ok=True)
+
+        self.heartbeat_stops = {}  # key -> threading.Event
+        self.lock_tokens = {}  # key -> owner token of the lock held by this process
+
+    def _lock_path(self, key: str) -> str:
+        return os.path.join(self.lock_dir_path, f"{key}.lock")
+
+    def _status_path(self, key: str) -> str:
+        return os.path.join(self.status_dir_path, f"{key}.json")
+
+    def get_status(self, key: str) -> dict:
+        '''return: status object, None if the item has not been processed'''
+        try:
+            with open(self._status_path(key), "r") as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+    def get_statuses(self) -> List[dict]:
+        return [self.get_status(key) for key in self.keys]
+
+    def _is_claimable(self, status: dict) -> bool:
+        return status == None or \
+            (status['status'] == 'failed' and status['attempts'] < self.max_attempts)
+
+    def _heartbeat(self, key: str, stop: threading.Event):
+        while not stop.wait(self.heartbeat_interval):
+            try:
+                os.utime(self._lock_path(key))
+            except FileNotFoundError:
+                return
+
+    def claim(self) -> str:
+        '''return: key of the claimed item, None if no item is left to claim'''
+        statuses = self.get_statuses()
+        pending_keys = [key for key, status in zip(
+            self.keys, statuses) if status == None]
+        failed_keys = [key for key, status in zip(
+            self.keys, statuses) if status != None and self._is_claimable(status)]
+
+        for key in pending_keys + failed_keys:
+            token = _try_create_lock(self._lock_path(key), self.stale_timeout)
+            if token == None:
+                continue
+
+            # another worker may have finished it after statuses were read
+            if not self._is_claimable(self.get_status(key)):
+                _remove_lock(self._lock_path(key), token)
+                continue
+
+            self.lock_tokens[key] = token
+
+            stop = threading.Event()
+            self.heartbeat_stops[key] = stop
+            threading.Thread(target=self._heartbeat, args=(key, stop),
+                             daemon=True).start()
+
+            return key
+
+        return None
+
+    def _release(self, key: str):
+        stop = self.heartbeat_stops.pop(key, None)
+        if stop != None:
+            stop.set()
+        token = self.lock_tokens.pop(key, None)
+        if token != None:
+            _remove_lock(self._lock_path(key), token)
+
+    def complete(self, key: str, stats: dict):
+        status = self.get_status(key)
+        _write_json_atomic(self._status_path(key), {
+            'key': key,
+            'status': 'done',
+            'attempts': (status['attempts'] if status != None else 0) + 1,
+            'error': None,
+            'stats': stats,
+        })
+        self._release(key)
+
+    def fail(self, key: str, error: str):
+        status = self.get_status(key)
+        _write_json_atomic(self._status_path(key), {
+            'key': key,
+            'status': 'failed',
+            'attempts': (status['attempts'] if status != None else 0) + 1,
+            'error': error,
+            'stats': None,
+        })
+        self._release(key)